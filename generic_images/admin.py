@@ -1,28 +1,313 @@
+import json
+
 from django import forms
+from django.conf.urls.defaults import patterns, url
 from django.contrib import admin
-from django.contrib.contenttypes.generic import GenericTabularInline
+from django.contrib.admin.views.main import ChangeList
+from django.contrib.contenttypes.generic import GenericTabularInline,\
+                                               BaseGenericInlineFormSet
+from django.core.exceptions import PermissionDenied
+from django.core.urlresolvers import reverse, NoReverseMatch
+from django.db import connection, models
+from django.db.models import Max
+from django.http import HttpResponse, Http404
 from django.utils.translation import ugettext_lazy as _
 
+from generic_images.managers import REORDER_GAP
 from generic_images.models import AttachedImage
-
-admin.site.register(AttachedImage)
-
-def attachedimage_form_factory(lang='en', debug=False):
+from generic_images.uploads import ChunkedUploadStore, InvalidUpload
+from generic_images.usage import QuotaExceeded, check_quota
+from generic_utils.contenttypes import content_types
+from generic_utils.managers import fetch_content_objects
+
+
+class AttachedImageChangeList(ChangeList):
+    ''' ChangeList that fetches objects images are attached to using
+        1 query per content type for the whole page. '''
+
+    def get_results(self, request):
+        super(AttachedImageChangeList, self).get_results(request)
+        self.result_list = fetch_content_objects(list(self.result_list))
+
+
+class AttachedImageAdmin(admin.ModelAdmin):
+    ''' ModelAdmin for AttachedImage. Changelist page is rendered with
+        constant number of queries: users and content types are selected
+        using JOIN, objects images are attached to are fetched in batch and
+        thumbnail URLs are computed without storage requests. '''
+
+    list_display = ['thumbnail', 'id', 'content_type', 'target', 'user',
+                    'caption', 'is_main', 'order']
+    list_display_links = ['thumbnail', 'id']
+    list_filter = ['content_type', 'is_main']
+    raw_id_fields = ['user']
+    ordering = ['-id'] # primary key index is used for paging
+    thumbnail_name = '100x100'
+    new_images_limit = 500
+
+    def queryset(self, request):
+        qs = super(AttachedImageAdmin, self).queryset(request)
+        # 'user' is nullable so it isn't followed by list_select_related
+        return qs.select_related('user', 'content_type')
+
+    def get_changelist(self, request, **kwargs):
+        return AttachedImageChangeList
+
+    def thumbnail(self, obj):
+        if not obj.image:
+            return ''
+        return '<img src="%s" style="max-width:100px;max-height:100px">' % \
+                obj.image.generate_url(self.thumbnail_name)
+    thumbnail.short_description = _('Image')
+    thumbnail.allow_tags = True
+
+    def target(self, obj):
+        return obj.content_object
+    target.short_description = _('Attached to')
+
+    def get_urls(self):
+        urls = patterns('',
+            url(r'^for/(?P<content_type_id>\d+)/(?P<object_id>\d+)/$',
+                self.admin_site.admin_view(self.images_page_view),
+                name='generic_images_attachedimage_page'),
+            url(r'^for/(?P<content_type_id>\d+)/(?P<object_id>\d+)/new/$',
+                self.admin_site.admin_view(self.new_images_view),
+                name='generic_images_attachedimage_new'),
+            url(r'^for/(?P<content_type_id>\d+)/(?P<object_id>\d+)/reorder/$',
+                self.admin_site.admin_view(self.reorder_view),
+                name='generic_images_attachedimage_reorder'),
+            url(r'^upload/(?P<content_type_id>\d+)/(?P<object_id>\d+)/$',
+                self.admin_site.admin_view(self.upload_chunk_view),
+                name='generic_images_attachedimage_upload'),
+            url(r'^upload/(?P<content_type_id>\d+)/(?P<object_id>\d+)/complete/$',
+                self.admin_site.admin_view(self.upload_complete_view),
+                name='generic_images_attachedimage_upload_complete'),
+        )
+        return urls + super(AttachedImageAdmin, self).get_urls()
+
+    def image_data(self, image):
+        ''' Returns dict with image data for admin JS. '''
+        return {
+            'id': image.pk,
+            'title': unicode(image.image.name),
+            'url': image.image.url if image.image else '',
+            'thumbnail': image.image.generate_url(self.thumbnail_name) \
+                                                    if image.image else '',
+            'thumbnails': dict((name, image.image.generate_url(name))
+                               for name, options in image.image.field.thumbs)\
+                                                    if image.image else {},
+            'fields': {
+                'caption': image.caption or '',
+                'order': image.order,
+                'is_main': image.is_main,
+                'user': image.user_id or '',
+            },
+        }
+
+    def images_page_view(self, request, content_type_id, object_id):
+        ''' Returns JSON with a page of images attached to the object.
+            It is used by paginated inline (see
+            :func:`attachedimages_inline_factory`). '''
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        try:
+            offset = max(int(request.GET.get('offset', 0)), 0)
+            limit = min(max(int(request.GET.get('limit', 20)), 1), 100)
+        except ValueError:
+            offset, limit = 0, 20
+
+        images = self.model.objects.filter(content_type=content_type_id,
+                                           object_id=object_id).\
+                        order_by(*inline_ordering(self.model))
+        data = {
+            'images': [self.image_data(image) for image
+                                        in images[offset:offset+limit]],
+        }
+        return HttpResponse(json.dumps(data), mimetype='application/json')
+
+    def _upload_target(self, request, content_type_id, object_id):
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        try:
+            ctype = content_types.get_for_id(content_type_id)
+            return ctype.get_object_for_this_type(pk=object_id)
+        except models.ObjectDoesNotExist:
+            raise Http404
+
+    def _json(self, data, status=200):
+        return HttpResponse(json.dumps(data), mimetype='application/json',
+                            status=status)
+
+    def upload_chunk_view(self, request, content_type_id, object_id):
+        ''' Receives one chunk of the file uploaded by HTML5 uploader
+            (POST) or returns numbers of received chunks so interrupted
+            upload can be resumed (GET). '''
+        obj = self._upload_target(request, content_type_id, object_id)
+        store = ChunkedUploadStore(request.user.pk)
+        try:
+            if request.method == 'POST':
+                chunk = request.FILES.get('chunk')
+                if chunk is None:
+                    raise InvalidUpload('No chunk')
+                # reject early instead of after the whole file is sent
+                check_quota(request.user, obj, chunk.size)
+                store.write_chunk(request.POST.get('upload_id'),
+                                  int(request.POST.get('index')),
+                                  int(request.POST.get('total')), chunk)
+            upload_id = request.REQUEST.get('upload_id')
+            return self._json({'received': store.received(upload_id),
+                               'total': store.total(upload_id)})
+        except QuotaExceeded, e:
+            return self._json({'error': unicode(e)}, status=403)
+        except (InvalidUpload, TypeError, ValueError), e:
+            return self._json({'error': unicode(e)}, status=400)
+
+    def upload_complete_view(self, request, content_type_id, object_id):
+        ''' Creates images from completely uploaded files. POST contains
+            ``upload_id`` and ``name`` lists. Images are created using
+            :meth:`~generic_images.managers.AttachedImageManager.bulk_attach`.
+            Returns JSON with data of created images. '''
+        if request.method != 'POST':
+            return self._json({'error': 'POST is required'}, status=405)
+        obj = self._upload_target(request, content_type_id, object_id)
+        store = ChunkedUploadStore(request.user.pk)
+        upload_ids = request.POST.getlist('upload_id')
+        names = request.POST.getlist('name')
+        files = []
+        try:
+            for upload_id, name in zip(upload_ids, names):
+                files.append(store.assemble(upload_id, name))
+            check_quota(request.user, obj,
+                        sum(content.size for content in files))
+            images = self.model.objects.bulk_attach(obj, files,
+                                                    user=request.user)
+        except QuotaExceeded, e:
+            return self._json({'error': unicode(e)}, status=403)
+        except InvalidUpload, e:
+            return self._json({'error': unicode(e)}, status=400)
+        finally:
+            for content in files:
+                content.close()
+        for upload_id in upload_ids:
+            store.delete(upload_id)
+        return self._json({'images': [self.image_data(image)
+                                      for image in images]})
+
+    def new_images_view(self, request, content_type_id, object_id):
+        ''' Returns JSON with images attached to the object after image
+            with pk=``after`` GET parameter. Uploaders use it to insert
+            just created images into the inline instead of reloading the
+            page. '''
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        try:
+            after = int(request.GET.get('after', 0))
+        except ValueError:
+            after = 0
+        images = self.model.objects.filter(content_type=content_type_id,
+                                           object_id=object_id,
+                                           pk__gt=after).order_by('pk')
+        return self._json({'images': [self.image_data(image) for image
+                                      in images[:self.new_images_limit]]})
+
+    def reorder_view(self, request, content_type_id, object_id):
+        ''' Changes order of images attached to the object. POST contains
+            either ``image`` and ``after`` (id of the image ``image`` is
+            moved after, empty for the top), this is what drag-and-drop in
+            the inline sends, or the list of ``ids`` in display order.
+            Returns JSON with new orders of changed images. '''
+        if request.method != 'POST':
+            return self._json({'error': 'POST is required'}, status=405)
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        images = self.model.objects.filter(content_type=content_type_id,
+                                           object_id=object_id)
+        try:
+            if 'image' in request.POST:
+                image = images.get(pk=int(request.POST['image']))
+                after = request.POST.get('after')
+                after = images.get(pk=int(after)) if after else None
+                orders = self.model.objects.move(image, after)
+            else:
+                ctype = content_types.get_for_id(content_type_id)
+                obj = ctype.get_object_for_this_type(pk=object_id)
+                orders = self.model.objects.reorder(obj,
+                                    request.POST.getlist('ids'),
+                                    gap=REORDER_GAP)
+        except (models.ObjectDoesNotExist, ValueError), e:
+            return self._json({'error': unicode(e)}, status=400)
+        return self._json({'orders': orders})
+
+admin.site.register(AttachedImage, AttachedImageAdmin)
+
+
+def inline_ordering(model):
+    ''' Returns stable ordering for images in paginated inline. '''
+    return list(model._meta.ordering) + ['-pk']
+
+
+class PaginatedImagesFormSet(BaseGenericInlineFormSet):
+    ''' Generic inline formset that displays only first ``page_size``
+        images. Other images are loaded by admin JS on demand and only
+        changed rows are submitted, so when the formset is bound only
+        submitted images are fetched and validated.
+    '''
+    page_size = 20
+    images_url = None
+    total_count = 0
+
+    def get_queryset(self):
+        if not hasattr(self, '_queryset'):
+            qs = super(PaginatedImagesFormSet, self).get_queryset()
+            if self.is_bound:
+                qs = self._submitted_images(qs)
+            else:
+                qs = qs.order_by(*inline_ordering(self.model))[:self.page_size]
+            self._queryset = qs
+        return self._queryset
+
+    def _submitted_images(self, qs):
+        pks = []
+        for i in range(self.initial_form_count()):
+            key = '%s-%s' % (self.add_prefix(i), self.model._meta.pk.name)
+            try:
+                pks.append(int(self.data.get(key)))
+            except (TypeError, ValueError):
+                pass
+        if not pks:
+            return qs.none()
+
+        # initial forms and their instances must be in the same order
+        qn = connection.ops.quote_name
+        column = '%s.%s' % (qn(self.model._meta.db_table),
+                            qn(self.model._meta.pk.column))
+        order = 'CASE %s %s END' % (column, ' '.join(
+            ['WHEN %d THEN %d' % (pk, i) for i, pk in enumerate(pks)]))
+        return qs.filter(pk__in=pks).extra(select={'submitted_order': order},
+                                           order_by=['submitted_order'])
+
+
+def attachedimage_form_factory(lang='en', debug=False, paginated=False):
     ''' Returns ModelForm class to be used in admin.
         'lang' is the language for GearsUploader (can be 'en' and 'ru' at the
-        moment).
+        moment). 'paginated' adds JS for paginated inline.
     '''
     yui = '' if debug else '.yui'
+    media_js = [
+          'generic_images/js/mootools-1.2.4-core-yc.js',
+          'generic_images/js/GearsUploader.%s%s.js' % (lang, yui,),
+          'generic_images/js/AttachedImageInline.js',
+          'generic_images/js/AttachedImagesHTML5Uploader.js',
+    ]
+    if paginated:
+        media_js.append('generic_images/js/AttachedImagesPaginatedInline.js')
+
     class _AttachedImageAdminForm(forms.ModelForm):
 
         caption = forms.CharField(label=_('Caption'), required=False)
 
         class Media:
-            js = [
-                  'generic_images/js/mootools-1.2.4-core-yc.js',
-                  'generic_images/js/GearsUploader.%s%s.js' % (lang, yui,),
-                  'generic_images/js/AttachedImageInline.js',
-            ]
+            js = media_js
 
         class Meta:
             model = AttachedImage
@@ -32,21 +317,71 @@ AttachedImageAdminForm = attachedimage_form_factory()
 ''' Form for AttachedImage model to be used in inline admin '''
 
 
-def attachedimages_inline_factory(lang='en', max_width='', debug=False):
+def attachedimages_inline_factory(lang='en', max_width='', debug=False,
+                                  page_size=None):
     '''  Returns InlineModelAdmin for attached images.
         'lang' is the language for GearsUploader (can be 'en' and 'ru' at the
         moment). 'max_width' is default resize width parameter to be set in
         widget.
+
+        If 'page_size' is set then only first 'page_size' images are
+        rendered, the next pages are loaded using "Load more images" button
+        and only changed rows are submitted. This is useful for objects with
+        thousands of images. :class:`AttachedImageAdmin` must be registered
+        in the admin site because it serves the pages.
     '''
 
     class _AttachedImagesInline(GenericTabularInline):
         model = AttachedImage
-        form = attachedimage_form_factory(lang, debug)
+        form = attachedimage_form_factory(lang, debug, bool(page_size))
         template = 'generic_images/attached_images_inline.html'
         max_w = max_width
+        if page_size:
+            formset = type('PaginatedImagesFormSet', (PaginatedImagesFormSet,),
+                           {'page_size': page_size})
+
+        def get_formset(self, request, obj=None, **kwargs):
+            FormSet = super(_AttachedImagesInline, self).get_formset(
+                                                    request, obj, **kwargs)
+            if obj is not None and obj.pk is not None:
+                ctype = content_types.get_for_model(obj)
+                try:
+                    FormSet.upload_url = reverse(
+                            'admin:generic_images_attachedimage_upload',
+                            args=[ctype.pk, obj.pk],
+                            current_app=self.admin_site.name)
+                    FormSet.new_images_url = reverse(
+                            'admin:generic_images_attachedimage_new',
+                            args=[ctype.pk, obj.pk],
+                            current_app=self.admin_site.name)
+                    FormSet.reorder_url = reverse(
+                            'admin:generic_images_attachedimage_reorder',
+                            args=[ctype.pk, obj.pk],
+                            current_app=self.admin_site.name)
+                    FormSet.last_image_id = self.model.objects.\
+                            for_model(obj, ctype).aggregate(
+                                                last=Max('pk'))['last'] or 0
+                except NoReverseMatch:
+                    # AttachedImageAdmin is not registered, HTML5
+                    # uploader is disabled and the page is reloaded
+                    # after uploads
+                    FormSet.upload_url = FormSet.new_images_url = None
+                    FormSet.reorder_url = None
+            if page_size and obj is not None and obj.pk is not None:
+                FormSet.images_url = reverse(
+                            'admin:generic_images_attachedimage_page',
+                            args=[ctype.pk, obj.pk],
+                            current_app=self.admin_site.name)
+                FormSet.total_count = self.model.objects.\
+                                            for_model(obj, ctype).count()
+            return FormSet
 
     return _AttachedImagesInline
 
+PaginatedAttachedImagesInline = attachedimages_inline_factory(page_size=20)
+''' InlineModelAdmin for objects with many attached images. It shows
+    20 images per page, see :func:`attachedimages_inline_factory`. '''
+
 AttachedImagesInline = attachedimages_inline_factory()
 ''' InlineModelAdmin for attached images.
     Adds multi-image uploader with progress bar, before-upload image
@@ -0,0 +1,260 @@
+#coding: utf-8
+'''
+ZIP archives of images built on the fly.
+
+The archive is generated while it is sent: nothing is written to disk and
+only a few chunks of image files are held in memory. Files are fetched from
+storage by background threads ``prefetch`` files ahead of the one being
+sent; each fetcher stops when it has ``max_chunks`` unsent chunks, so
+memory use is bounded by ``prefetch * max_chunks * chunk_size`` bytes
+regardless of the number and size of images. The first bytes are sent as
+soon as the first chunk of the first image is fetched.
+
+Files up to ``buffer_chunks * chunk_size`` bytes (1Mb by default) are read
+completely before their entry is started, so an image that can't be read
+is skipped and the archive stays valid. If reading of a bigger file fails
+in the middle, the error is logged to ``generic_images.archives`` logger
+and the stream is aborted: headers and a part of the file are already
+sent, the client gets a truncated archive.
+
+Entries are stored in deflate format without compression (photos don't
+compress) with sizes and CRC written after the data, so any unzip tool can
+read the stream. ZIP64 records are added when the archive is bigger than
+4Gb.
+'''
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from Queue import Queue, Full
+from multiprocessing.pool import ThreadPool
+
+from django.http import HttpResponse
+
+CHUNK_SIZE = 64 * 1024
+ZIP64_LIMIT = 0xFFFFFFFF
+
+logger = logging.getLogger('generic_images.archives')
+
+
+class _Fetcher(object):
+    ''' Reads storage file chunk by chunk into a bounded queue. '''
+
+    def __init__(self, storage, name, chunk_size, max_chunks, cancelled):
+        self.storage, self.name = storage, name
+        self.chunk_size = chunk_size
+        self.queue = Queue(max_chunks)
+        self.cancelled = cancelled
+
+    def _put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return True
+            except Full:
+                pass # the client is slow
+        return False
+
+    def _open(self):
+        bucket = getattr(self.storage, 'bucket', None)
+        if bucket is not None:
+            # S3BotoStorageFile downloads the whole key on read(),
+            # boto key is read by chunks
+            key = bucket.get_key(self.name)
+            if key is None:
+                raise IOError('No such S3 key: %s' % self.name)
+            return key
+        return self.storage.open(self.name, 'rb')
+
+    def run(self):
+        try:
+            f = self._open()
+            try:
+                while True:
+                    data = f.read(self.chunk_size)
+                    if not self._put(data) or not data:
+                        return
+            finally:
+                f.close()
+        except Exception, e:
+            self._put(e)
+
+    def chunks(self):
+        while True:
+            item = self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+            if not item:
+                return
+            yield item
+
+
+def _dos_time(timestamp):
+    t = time.localtime(timestamp)
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            (max(t.tm_year, 1980) - 1980) << 9 | (t.tm_mon << 5) | t.tm_mday)
+
+
+class ZipWriter(object):
+    ''' Produces ZIP format records for entries whose sizes are not known
+        in advance. '''
+
+    def __init__(self, compress_level=0):
+        self.compress_level = compress_level
+        self.offset = 0
+        self.entries = []
+
+    def _out(self, data):
+        self.offset += len(data)
+        return data
+
+    def entry(self, name, chunks, timestamp=None):
+        ''' Yields local header, data and data descriptor of the entry with
+            content from ``chunks`` iterable. '''
+        name = name.encode('utf-8')
+        dos_time, dos_date = _dos_time(timestamp or time.time())
+        offset = self.offset
+        flags = 0x08 | 0x800 # data descriptor, utf-8 name
+        yield self._out(struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, flags, 8,
+                                    dos_time, dos_date, 0, 0, 0, len(name), 0)
+                        + name)
+        crc, size, compressed_size = 0, 0, 0
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, -15)
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            data = compressor.compress(chunk)
+            if data:
+                compressed_size += len(data)
+                yield self._out(data)
+        data = compressor.flush()
+        compressed_size += len(data)
+        crc &= 0xFFFFFFFF
+        if size > ZIP64_LIMIT or compressed_size > ZIP64_LIMIT:
+            raise ValueError('%s is too big' % name)
+        yield self._out(data + struct.pack('<IIII', 0x08074b50, crc,
+                                           compressed_size, size))
+        self.entries.append((name, flags, dos_time, dos_date, crc,
+                             compressed_size, size, offset))
+
+    def close(self):
+        ''' Returns central directory and end records. '''
+        start = self.offset
+        records = []
+        for name, flags, dos_time, dos_date, crc, compressed_size, size, \
+                offset in self.entries:
+            extra = ''
+            if offset > ZIP64_LIMIT:
+                extra = struct.pack('<HHQ', 1, 8, offset)
+                offset = 0xFFFFFFFF
+            records.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50,
+                                       45 if extra else 20,
+                                       45 if extra else 20, flags, 8,
+                                       dos_time, dos_date, crc,
+                                       compressed_size, size, len(name),
+                                       len(extra), 0, 0, 0, 0, offset)
+                           + name + extra)
+        directory = ''.join(records)
+        size, count = len(directory), len(self.entries)
+        end = ''
+        if start + size > ZIP64_LIMIT or count > 0xFFFF:
+            zip64_end = start + size
+            end = struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0,
+                              count, count, size, start) + \
+                  struct.pack('<IIQI', 0x07064b50, 0, zip64_end, 1)
+            start, count = 0xFFFFFFFF, 0xFFFF
+        end += struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count,
+                           min(size, 0xFFFFFFFF), min(start, 0xFFFFFFFF), 0)
+        return self._out(directory + end)
+
+
+def archive_name(index, count, image):
+    ''' Returns file name of ``index``-th image (1-based) in the archive:
+        zero-padded index and extension of image file. '''
+    ext = os.path.splitext(image.image.name)[1].lower()
+    return '%0*d%s' % (len(str(count)), index, ext)
+
+
+def iter_zip(images, prefetch=4, chunk_size=CHUNK_SIZE, max_chunks=4,
+             name_getter=archive_name, compress_level=0, buffer_chunks=16):
+    '''
+    Yields ZIP archive with image files of ``images`` (list or queryset)
+    chunk by chunk. Images whose files can't be read are skipped (see the
+    module docs for files bigger than ``buffer_chunks`` chunks).
+
+    Example::
+
+        images = AttachedImage.objects.for_model(obj)
+        for data in iter_zip(images):
+            output.write(data)
+    '''
+    images = list(images)
+    cancelled = threading.Event()
+    pool = ThreadPool(max(1, prefetch))
+    writer = ZipWriter(compress_level)
+    fetchers = []
+
+    def start(image):
+        fetcher = _Fetcher(image.image.storage, image.image.name, chunk_size,
+                           max_chunks, cancelled)
+        pool.apply_async(fetcher.run)
+        fetchers.append(fetcher)
+
+    try:
+        for image in images[:prefetch]:
+            start(image)
+        index = 0
+        for position, image in enumerate(images):
+            fetcher = fetchers[position]
+            if position + prefetch < len(images):
+                start(images[position + prefetch])
+
+            chunks = fetcher.chunks()
+            buffered = []
+            try:
+                for chunk in chunks:
+                    buffered.append(chunk)
+                    if len(buffered) == buffer_chunks:
+                        break
+                else:
+                    chunks = iter([]) # the whole file is buffered
+            except Exception:
+                continue # missing or unreadable file
+            index += 1
+            timestamp = None
+            if getattr(image, 'updated_at', None) is not None:
+                timestamp = time.mktime(image.updated_at.timetuple())
+
+            def content(buffered=buffered, chunks=chunks,
+                        name=image.image.name):
+                for chunk in buffered:
+                    yield chunk
+                try:
+                    for chunk in chunks:
+                        yield chunk
+                except Exception:
+                    logger.exception('Reading of %s failed, ZIP archive '
+                                     'is truncated', name)
+                    raise
+
+            for data in writer.entry(name_getter(index, len(images), image),
+                                     content(), timestamp):
+                yield data
+        yield writer.close()
+    finally:
+        # the client can disconnect in the middle of the archive
+        cancelled.set()
+        pool.terminate()
+
+
+def zip_response(images, filename='images.zip', **kwargs):
+    ''' Returns HttpResponse that streams ZIP archive of ``images`` (see
+        :func:`iter_zip`). The archive is streamed only if middleware
+        doesn't access ``response.content`` (e.g. GZipMiddleware does). '''
+    response = HttpResponse(iter_zip(images, **kwargs),
+                            mimetype='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    response['X-Accel-Buffering'] = 'no' # nginx: send chunks immediately
+    return response
@@ -0,0 +1,321 @@
+#coding: utf-8
+'''
+Reproducible benchmarks for generic_images hot paths.
+
+Synthetic dataset (target objects are ``auth.User`` instances, images per
+object follow a skewed power-law distribution) is generated in a temporary
+test database, image files are stored in :class:`LatencyStorage` that
+emulates remote (S3) storage latency. Each benchmark is repeated and
+per-call latency percentiles and DB query counts are reported as JSON
+so results can be compared across commits and databases (run with
+settings for SQLite and for Postgres)::
+
+    $ manage.py benchmark_images --targets=10000 --images=1000000 --output=bench.json
+
+New benchmarks are registered with :func:`benchmark` decorator.
+'''
+import random
+import subprocess
+import time
+from cStringIO import StringIO
+
+from PIL import Image
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import Storage
+from django.db import connection
+
+from generic_images.models import AttachedImage
+from generic_images.managers import ImagesAndUserManager
+from generic_utils.contenttypes import content_types
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    ''' Registers benchmark function. The function takes :class:`Runner`
+        and calls :meth:`Runner.measure`. '''
+    def decorator(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+    return decorator
+
+
+class LatencyStorage(Storage):
+    ''' In-memory storage that sleeps ``latency`` seconds on every call. '''
+
+    def __init__(self, latency=0.02, base_url='http://storage.example.com/'):
+        self.latency = latency
+        self.base_url = base_url
+        self.files = {}
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _open(self, name, mode='rb'):
+        self._wait()
+        return ContentFile(self.files[name])
+
+    def _save(self, name, content):
+        self._wait()
+        content.seek(0)
+        self.files[name] = content.read()
+        return name
+
+    def get_available_name(self, name):
+        return name
+
+    def delete(self, name):
+        self._wait()
+        self.files.pop(name, None)
+
+    def exists(self, name):
+        self._wait()
+        return name in self.files
+
+    def size(self, name):
+        self._wait()
+        return len(self.files[name])
+
+    def listdir(self, path):
+        self._wait()
+        prefix = path.rstrip('/') + '/'
+        names = [name[len(prefix):] for name in self.files
+                 if name.startswith(prefix)]
+        return (sorted(set(n.split('/')[0] for n in names if '/' in n)),
+                sorted(n for n in names if '/' not in n))
+
+    def url(self, name):
+        return self.base_url + name
+
+
+def make_jpeg(width=1600, height=1200, seed=0):
+    ''' Returns JPEG content of a noisy (not very compressible) image. '''
+    rnd = random.Random(seed)
+    small = Image.new('RGB', (64, 48))
+    small.putdata([(rnd.randint(0, 255), rnd.randint(0, 255),
+                    rnd.randint(0, 255)) for i in xrange(64*48)])
+    buf = StringIO()
+    small.resize((width, height), Image.BICUBIC).save(buf, 'JPEG', quality=85)
+    return buf.getvalue()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values) * fraction))]
+
+
+class Runner(object):
+    ''' Creates the dataset and runs registered benchmarks. '''
+
+    def __init__(self, targets=10000, images=1000000, skew=3.0, repeat=200,
+                 latency=0.02, seed=0, log=None):
+        self.params = dict(targets=targets, images=images, skew=skew,
+                           repeat=repeat, latency=latency, seed=seed)
+        self.repeat = repeat
+        self.rnd = random.Random(seed)
+        self.storage = LatencyStorage(latency)
+        self.results = {}
+        self.log = log or (lambda message: None)
+
+    def create_dataset(self, chunk_size=5000):
+        params = self.params
+        User.objects.bulk_create([User(username='bench%d' % i)
+                                  for i in xrange(params['targets'])])
+        self.target_ids = list(User.objects.filter(username__startswith='bench').
+                               values_list('pk', flat=True))
+        ctype = content_types.get_for_model(User)
+
+        # power-law distribution: a few objects have most of the images
+        has_main = set()
+        created = 0
+        while created < params['images']:
+            batch = []
+            for i in xrange(min(chunk_size, params['images'] - created)):
+                index = int(len(self.target_ids) *
+                            self.rnd.random() ** params['skew'])
+                object_id = self.target_ids[index]
+                is_main = object_id not in has_main and self.rnd.random() < 0.8
+                if is_main:
+                    has_main.add(object_id)
+                created += 1
+                batch.append(AttachedImage(
+                    content_type=ctype, object_id=object_id, order=created,
+                    is_main=is_main, image='media/bench/%d.jpg' % created,
+                    width=1600, height=1200, file_size=300000,
+                    file_format='jpeg'))
+            AttachedImage.objects.bulk_create(batch)
+            self.log('%d images created\n' % created)
+        self.image_ids = list(AttachedImage.objects.values_list('pk', flat=True))
+
+    def random_target(self):
+        return User(pk=self.rnd.choice(self.target_ids))
+
+    def random_image(self):
+        return AttachedImage.objects.get(pk=self.rnd.choice(self.image_ids))
+
+    def measure(self, name, fn, setup=None, repeat=None):
+        ''' Calls ``fn(setup())`` ``repeat`` times and records latency and
+            number of queries (setup is not measured). '''
+        timings, queries = [], []
+        for i in xrange(repeat or self.repeat):
+            arg = setup() if setup else None
+            start_queries = len(connection.queries)
+            start = time.time()
+            fn(arg)
+            timings.append((time.time() - start) * 1000)
+            queries.append(len(connection.queries) - start_queries)
+            if len(connection.queries) > 10000:
+                del connection.queries[:]
+        self.results[name] = {
+            'calls': len(timings),
+            'mean_ms': sum(timings) / len(timings),
+            'p50_ms': percentile(timings, 0.5),
+            'p95_ms': percentile(timings, 0.95),
+            'max_ms': max(timings),
+            'queries_per_call': float(sum(queries)) / len(queries),
+        }
+        self.log('%s: %.3fms (p95 %.3fms)\n' % (name,
+                 self.results[name]['mean_ms'], self.results[name]['p95_ms']))
+
+    def run(self, names=None):
+        field = AttachedImage._meta.get_field('image')
+        old_storage, field.storage = field.storage, self.storage
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            for name, fn in BENCHMARKS:
+                if names and name not in names:
+                    continue
+                fn(self)
+        finally:
+            field.storage = old_storage
+            connection.use_debug_cursor = old_debug_cursor
+        return self.report()
+
+    def report(self):
+        try:
+            commit = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE).communicate()[0].strip()
+        except OSError:
+            commit = None
+        return {
+            'commit': commit,
+            'database': connection.vendor,
+            'params': self.params,
+            'results': self.results,
+        }
+
+
+@benchmark('for_model')
+def bench_for_model(runner):
+    runner.measure('for_model',
+                   lambda obj: list(AttachedImage.objects.for_model(obj)[:20]),
+                   runner.random_target)
+
+
+@benchmark('get_main_for')
+def bench_get_main_for(runner):
+    runner.measure('get_main_for', AttachedImage.objects.get_main_for,
+                   runner.random_target)
+
+
+@benchmark('inject_to')
+def bench_inject_to(runner):
+    def page():
+        return [runner.random_target() for i in range(50)]
+    runner.measure('inject_to',
+                   lambda objects: AttachedImage.injector.inject_to(
+                                        objects, 'main_image', is_main=True),
+                   page)
+
+
+@benchmark('select_with_main_images')
+def bench_select_with_main_images(runner):
+    manager = ImagesAndUserManager()
+    manager.model = User
+    def select(offset):
+        objects = manager.select_with_main_images(
+                        pk__gte=offset, username__startswith='bench', limit=50)
+        list(objects)
+    runner.measure('select_with_main_images', select,
+                   lambda: runner.rnd.choice(runner.target_ids))
+
+
+@benchmark('navigation')
+def bench_navigation(runner):
+    runner.measure('next', lambda image: image.next(), runner.random_image)
+    runner.measure('previous', lambda image: image.previous(),
+                   runner.random_image)
+    runner.measure('get_order_in_album',
+                   lambda image: image.get_order_in_album(),
+                   runner.random_image)
+
+
+@benchmark('save_delete')
+def bench_save_delete(runner):
+    content = make_jpeg()
+    # emulate ImageCountField: recalculate count on every save and delete
+    from generic_images.signals import image_saved, image_deleted
+    def recalculate(sender, instance, **kwargs):
+        AttachedImage.objects.for_model(instance.content_object,
+                                        instance.content_type).count()
+    image_saved.connect(recalculate, dispatch_uid='benchmark-count')
+    image_deleted.connect(recalculate, dispatch_uid='benchmark-count')
+    created = []
+    try:
+        def save(obj):
+            image = AttachedImage(content_object=obj)
+            image.image = SimpleUploadedFile('upload.jpg', content)
+            image.save()
+            created.append(image)
+        runner.measure('save', save, runner.random_target,
+                       repeat=max(1, runner.repeat // 10))
+        runner.measure('delete', lambda image: image.delete(), created.pop,
+                       repeat=len(created))
+    finally:
+        image_saved.disconnect(dispatch_uid='benchmark-count')
+        image_deleted.disconnect(dispatch_uid='benchmark-count')
+
+
+@benchmark('thumbnails')
+def bench_thumbnails(runner):
+    content = ContentFile(make_jpeg())
+    image = AttachedImage(image='media/bench/thumbs.jpg')
+    runner.measure('thumbnails',
+                   lambda arg: image.image.generate_thumbs(image.image.name,
+                                                           content),
+                   repeat=max(1, runner.repeat // 10))
+
+
+@benchmark('upload_batch')
+def bench_upload_batch(runner):
+    ''' Attaching a batch of uploaded photos: one by one (as admin formset
+        does) vs :meth:`AttachedImageManager.bulk_attach` (HTML5 uploader). '''
+    content = make_jpeg()
+    batch_size = 20
+    def uploads(obj):
+        return obj, [SimpleUploadedFile('upload%d.jpg' % i, content)
+                     for i in range(batch_size)]
+
+    def formset(args):
+        obj, files = args
+        for upload in files:
+            image = AttachedImage(content_object=obj, image=upload)
+            image.save()
+
+    def bulk(args):
+        obj, files = args
+        AttachedImage.objects.bulk_attach(obj, files)
+
+    repeat = max(1, runner.repeat // 50)
+    runner.measure('upload_batch_formset', formset,
+                   lambda: uploads(runner.random_target()), repeat=repeat)
+    runner.measure('upload_batch_bulk', bulk,
+                   lambda: uploads(runner.random_target()), repeat=repeat)
+    for name in ['upload_batch_formset', 'upload_batch_bulk']:
+        result = runner.results[name]
+        result['images_per_second'] = batch_size * 1000.0 / result['mean_ms']
@@ -13,6 +13,7 @@ from django.contrib.auth.models import User
 from composition.base import CompositionField
 from generic_images.models import AttachedImage
 from generic_images.signals import image_saved, image_deleted
+from generic_utils.instrumentation import instrumented
 
 
 def force_recalculate(obj):
@@ -61,12 +62,16 @@ class ImageCountField(CompositionField):
         
     '''
     def __init__(self, native=None):
-                        
+
+        @instrumented('image_count.recalculate')
+        def get_field_value(model, image, signal):
+            return AttachedImage.objects.get_for_model(model).count()
+
         self.internal_init(
             native = native or models.PositiveIntegerField(default=0, editable=False),
             trigger = {
                 'on': (image_saved, image_deleted,),
-                'do': lambda model, image, signal: AttachedImage.objects.get_for_model(model).count(),
+                'do': get_field_value,
                 'field_holder_getter': lambda image: image.content_object
             }
         )
@@ -91,6 +96,7 @@ class UserImageCountField(CompositionField):
     """
     def __init__(self, native=None, user_attr='user'):                        
         
+        @instrumented('user_image_count.recalculate')
         def get_field_value(model, image, signal):
             return AttachedImage.objects.get_for_model(getattr(model, user_attr)).count()
         
@@ -0,0 +1,67 @@
+#coding: utf-8
+'''
+Layouts of image files in storage.
+
+``date`` layout (default) stores files under
+``media/new_images/YYYY/MM/DD/``. All files uploaded in one day share one
+prefix, so on busy days this prefix becomes a hot S3 partition and a local
+directory can hold hundreds of thousands of files.
+
+``sharded`` layout stores files under ``media/img/ab/cd/`` where ``abcd``
+are the first hex digits of MD5 of the file name: keys are spread evenly
+over 65536 prefixes (with default depth 2) and each directory stays small.
+
+Layout of new uploads is set with ``GENERIC_IMAGES_UPLOAD_LAYOUT`` setting
+('date' or 'sharded'), depth of sharded layout is set with
+``GENERIC_IMAGES_SHARD_DEPTH`` (default 2). Existing files are moved to the
+sharded layout with ``relocate_images`` management command.
+'''
+import hashlib
+import os
+import time
+
+from django.conf import settings
+
+DATE_ROOT = 'media/new_images'
+SHARDED_ROOT = 'media/img'
+
+
+def upload_layout():
+    return getattr(settings, 'GENERIC_IMAGES_UPLOAD_LAYOUT', 'date')
+
+
+def shard_depth():
+    return getattr(settings, 'GENERIC_IMAGES_SHARD_DEPTH', 2)
+
+
+def date_path(file_name, ext):
+    return os.path.join(DATE_ROOT, time.strftime('%Y/%m/%d'), file_name + ext)
+
+
+def sharded_path(file_name, ext, depth=None, key=None):
+    ''' Returns ``media/img/<2 hex digits>/.../<file_name><ext>``. Digits
+        are taken from MD5 of ``key`` (``file_name`` by default). '''
+    digest = hashlib.md5((key or file_name).encode('utf-8')).hexdigest()
+    shards = [digest[i*2:i*2+2] for i in range(depth or shard_depth())]
+    return os.path.join(SHARDED_ROOT, *(shards + [file_name + ext]))
+
+
+def upload_path(file_name, ext, layout=None):
+    ''' Returns storage name for new file in ``layout`` (the one set in
+        settings by default). '''
+    if (layout or upload_layout()) == 'sharded':
+        return sharded_path(file_name, ext)
+    return date_path(file_name, ext)
+
+
+def is_sharded(name):
+    return name.startswith(SHARDED_ROOT + '/')
+
+
+def relocated_name(name, depth=None):
+    ''' Returns the name of file ``name`` in sharded layout. The base
+        name is kept so thumbnail names change the same way; shards are
+        computed from the whole old name, so files with the same base name
+        in different directories get different names. '''
+    file_name, ext = os.path.splitext(os.path.basename(name))
+    return sharded_path(file_name, ext, depth, key=name)
@@ -0,0 +1,64 @@
+#coding: utf-8
+from optparse import make_option
+from multiprocessing.pool import ThreadPool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Q
+
+from generic_images.managers import get_model_class_by_name
+from generic_images.metadata import read_image_metadata, fetch_image_content
+from generic_utils.querysets import keyset_chunks
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName]'
+    help = ('Fills width, height, file_size, file_format, placeholder and '
+            'perceptual hash fields for existing images (generic_images.AttachedImage by '
+            'default). Image files are fetched from storage in parallel.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=8,
+                    help='Number of parallel storage readers.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=500, help='Number of rows processed at once.'),
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Recompute metadata for images that already have it.'),
+    )
+
+    def handle(self, *args, **options):
+        model_name = args[0] if args else 'generic_images.AttachedImage'
+        model = get_model_class_by_name(model_name)
+        if model is None:
+            raise CommandError("Model '%s' is not found" % model_name)
+
+        queryset = model.objects.exclude(image='').only('pk', 'image')
+        if not options['all']:
+            queryset = queryset.filter(Q(width__isnull=True) |
+                                       Q(phash__isnull=True))
+
+        pool = ThreadPool(options['workers'])
+        done, failed = 0, 0
+        try:
+            for chunk in keyset_chunks(queryset, options['chunk_size']):
+                results = pool.map(_read_metadata, chunk)
+                with transaction.commit_on_success():
+                    for pk, metadata in results:
+                        if metadata is None:
+                            failed += 1
+                            continue
+                        model.objects.filter(pk=pk).update(**metadata)
+                        done += 1
+                self.stdout.write('%d images processed, %d failed\n' %
+                                  (done, failed))
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _read_metadata(image):
+    try:
+        return image.pk, read_image_metadata(fetch_image_content(image.image))
+    except Exception:
+        # missing or broken file shouldn't stop the backfill
+        return image.pk, None
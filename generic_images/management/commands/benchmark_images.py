@@ -0,0 +1,55 @@
+#coding: utf-8
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from generic_images.benchmarks import Runner, BENCHMARKS
+
+
+class Command(BaseCommand):
+    args = '[benchmark benchmark ...]'
+    help = ('Runs generic_images benchmarks on synthetic dataset in a '
+            'temporary test database and prints results as JSON. '
+            'Available benchmarks: %s.' % ', '.join(name for name, fn in BENCHMARKS))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--targets', type='int', dest='targets', default=10000,
+                    help='Number of objects images are attached to.'),
+        make_option('--images', type='int', dest='images', default=1000000,
+                    help='Number of images.'),
+        make_option('--skew', type='float', dest='skew', default=3.0,
+                    help='Skew of images-per-object distribution '
+                         '(1 is uniform, greater is more skewed).'),
+        make_option('--repeat', type='int', dest='repeat', default=200,
+                    help='Number of calls for each benchmark.'),
+        make_option('--latency', type='float', dest='latency', default=20,
+                    help='Emulated storage latency (ms).'),
+        make_option('--seed', type='int', dest='seed', default=0),
+        make_option('--output', dest='output', default=None,
+                    help='File to write JSON results to (default: stdout).'),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options.get('verbosity', 1))
+        log = self.stderr.write if verbosity > 1 else None
+        runner = Runner(targets=options['targets'], images=options['images'],
+                        skew=options['skew'], repeat=options['repeat'],
+                        latency=options['latency'] / 1000.0,
+                        seed=options['seed'], log=log)
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            runner.create_dataset()
+            report = runner.run(args)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        data = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(data)
+        else:
+            self.stdout.write(data + '\n')
@@ -0,0 +1,64 @@
+#coding: utf-8
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from generic_images.phash import HammingIndex, hamming_distance, HASH_BITS
+
+
+class Command(BaseCommand):
+    help = ('Benchmarks multi-index perceptual hash lookup against linear '
+            'scan on random hashes.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--size', type='int', dest='size', default=1000000,
+                    help='Number of indexed hashes.'),
+        make_option('--queries', type='int', dest='queries', default=1000,
+                    help='Number of lookups.'),
+        make_option('--distance', type='int', dest='distance', default=6,
+                    help='Max Hamming distance.'),
+        make_option('--seed', type='int', dest='seed', default=0),
+    )
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        size, distance = options['size'], options['distance']
+        hashes = [rnd.getrandbits(HASH_BITS) for i in xrange(size)]
+
+        start = time.time()
+        index = HammingIndex()
+        for key, value in enumerate(hashes):
+            index.add(value, key)
+        build_time = time.time() - start
+
+        # near-duplicate of a random stored hash: flip a few bits
+        queries = []
+        for i in xrange(options['queries']):
+            value = rnd.choice(hashes)
+            for bit in rnd.sample(range(HASH_BITS), rnd.randint(0, distance)):
+                value ^= 1 << bit
+            queries.append(value)
+
+        start = time.time()
+        found = sum(len(index.search(value, distance)) for value in queries)
+        index_time = time.time() - start
+
+        # linear scan is slow, so measure it on a few queries only
+        scan_queries = queries[:10]
+        start = time.time()
+        for value in scan_queries:
+            [key for key, stored in enumerate(hashes)
+                if hamming_distance(value, stored) <= distance]
+        scan_time = (time.time() - start) / len(scan_queries) * len(queries)
+
+        self.stdout.write(
+            'hashes: %d, queries: %d, max distance: %d\n'
+            'index build: %.2fs\n'
+            'index lookups: %.2fs (%.3fms per query, %d matches)\n'
+            'linear scan (estimated): %.2fs (%.3fms per query)\n' % (
+                size, len(queries), distance, build_time,
+                index_time, index_time * 1000 / len(queries), found,
+                scan_time, scan_time * 1000 / len(queries),
+            ))
@@ -0,0 +1,58 @@
+#coding: utf-8
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from generic_images.managers import get_model_class_by_name
+from generic_images.sitemaps import ImageSitemap, MAX_ENTRIES
+
+
+class Command(BaseCommand):
+    args = '<output directory>'
+    help = ('Writes image sitemap files of images (generic_images.'
+            'AttachedImage by default) and their index (see '
+            'generic_images.sitemaps). Images are read in chunks, so the '
+            'command runs with constant memory.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--model', dest='model',
+                    default='generic_images.AttachedImage',
+                    help='Image model (app_label.ModelName).'),
+        make_option('--base-url', dest='base_url', default='',
+                    help='Prefix of relative page and image URLs '
+                         '(e.g. http://example.com).'),
+        make_option('--index-url', dest='index_url', default=None,
+                    help='Prefix of sitemap file URLs in the index '
+                         '(--base-url by default).'),
+        make_option('--thumb', dest='thumb', default=None,
+                    help='List URLs of this thumbnail instead of originals.'),
+        make_option('--name', dest='name', default='sitemap-images',
+                    help='Name of the index file without extension.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=2000, help='Number of images fetched at once.'),
+        make_option('--max-entries', type='int', dest='max_entries',
+                    default=MAX_ENTRIES, help='Max entries in one file.'),
+        make_option('--gzip', action='store_true', dest='compress',
+                    default=False, help='Write gzipped sitemap files.'),
+    )
+
+    def handle(self, directory=None, **options):
+        if directory is None:
+            raise CommandError('Output directory is required')
+        model = get_model_class_by_name(options['model'])
+        if model is None:
+            raise CommandError("Model '%s' is not found" % options['model'])
+        thumb = options['thumb']
+        if thumb and thumb not in dict(model._meta.get_field('image').thumbs):
+            raise CommandError("Unknown thumbnail '%s'" % thumb)
+
+        sitemap = ImageSitemap(model.objects.all(), options['base_url'],
+                               thumb, options['chunk_size'],
+                               options['max_entries'])
+        started = time.time()
+        names = sitemap.write(directory, options['name'],
+                              options['index_url'], options['compress'])
+        self.stdout.write('%d sitemap files written in %.1fs: %s\n' % (
+                          len(names) - 1, time.time() - started,
+                          ', '.join(names)))
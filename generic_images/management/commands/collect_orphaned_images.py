@@ -0,0 +1,118 @@
+#coding: utf-8
+import os
+import time
+from optparse import make_option
+from multiprocessing.pool import ThreadPool
+
+from django.core.management.base import BaseCommand, CommandError
+
+from generic_images.managers import get_model_class_by_name
+from generic_images.layout import DATE_ROOT, SHARDED_ROOT, shard_depth
+from generic_images.orphans import OrphanFinder, iter_prefixes
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName ...]'
+    help = ('Deletes image files and thumbnails that are not referenced by '
+            'images (generic_images.AttachedImage by default; pass all models '
+            'that store files in the same storage). Storage is processed one '
+            'day prefix (%s/YYYY/MM/DD) or shard prefix (%s/xx/yy) at a time; '
+            'completed prefixes are written to the checkpoint file so '
+            'interrupted run can be resumed. Files whose modification time '
+            'is unknown are never deleted.' % (DATE_ROOT, SHARDED_ROOT))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--layout', dest='layout', default='date',
+                    help="Storage layout to process: 'date' or 'sharded'."),
+        make_option('--root', dest='root', default=None,
+                    help='Storage prefix with YYYY/MM/DD (or shard) folders.'),
+        make_option('--from', dest='start', default=None,
+                    help='First day (YYYY/MM/DD) or shard to process.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='File with the last completed prefix. Processing '
+                         'continues after it.'),
+        make_option('--grace-hours', type='float', dest='grace_hours',
+                    default=24, help="Files younger than this are kept "
+                                     "(their images can be not saved yet)."),
+        make_option('--workers', type='int', dest='workers', default=8,
+                    help='Number of parallel storage deletes.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=500, help='Number of keys checked at once.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False, help='Print orphans without deleting them.'),
+    )
+
+    def handle(self, *args, **options):
+        models = []
+        for name in args or ['generic_images.AttachedImage']:
+            model = get_model_class_by_name(name)
+            if model is None:
+                raise CommandError("Model '%s' is not found" % name)
+            models.append(model)
+        storage = models[0]._meta.get_field('image').storage
+        finder = OrphanFinder(models, storage, options['batch_size'],
+                              options['grace_hours'] * 3600)
+        verbosity = int(options.get('verbosity', 1))
+
+        if options['layout'] == 'sharded':
+            root, depth = SHARDED_ROOT, shard_depth()
+        elif options['layout'] == 'date':
+            root, depth = DATE_ROOT, 3
+        else:
+            raise CommandError("Unknown layout '%s'" % options['layout'])
+        root = (options['root'] or root).rstrip('/')
+        start, done = options['start'], None
+        checkpoint = options['checkpoint']
+        if checkpoint and os.path.exists(checkpoint) and not start:
+            with open(checkpoint) as f:
+                done = f.read().strip() or None
+                start = done
+
+        pool = ThreadPool(options['workers'])
+        totals = {'listed': 0, 'orphans': 0, 'deleted': 0}
+        started = time.time()
+        try:
+            for prefix in iter_prefixes(storage, root, depth, start):
+                relative = prefix[len(root)+1:]
+                if relative == done:
+                    continue
+                counts = self._process_prefix(finder, storage, pool, prefix,
+                                           options['dry_run'], verbosity)
+                for key in totals:
+                    totals[key] += counts[key]
+                self.stdout.write('%s: %d files, %d orphans, %d deleted\n' %
+                                  (relative, counts['listed'], counts['orphans'],
+                                   counts['deleted']))
+                if checkpoint and not options['dry_run']:
+                    with open(checkpoint + '.tmp', 'w') as f:
+                        f.write(relative)
+                    os.rename(checkpoint + '.tmp', checkpoint)
+        finally:
+            pool.close()
+            pool.join()
+        self.stdout.write('Total: %d files, %d orphans, %d deleted in %.1fs\n' %
+                          (totals['listed'], totals['orphans'],
+                           totals['deleted'], time.time() - started))
+
+    def _process_prefix(self, finder, storage, pool, prefix, dry_run, verbosity):
+        counts = {'listed': 0, 'orphans': 0, 'deleted': 0}
+        for batch, orphans in finder.find(prefix):
+            counts['listed'] += len(batch)
+            counts['orphans'] += len(orphans)
+            if verbosity > 1 or dry_run:
+                for name in orphans:
+                    self.stdout.write('%s\n' % name)
+            if orphans and not dry_run:
+                results = pool.map(lambda name: _delete(storage, name), orphans)
+                counts['deleted'] += sum(results)
+        return counts
+
+
+def _delete(storage, name):
+    try:
+        storage.delete(name)
+        return 1
+    except Exception:
+        # the file can be deleted concurrently; it will be checked again
+        # by the next run
+        return 0
@@ -0,0 +1,80 @@
+#coding: utf-8
+import sys
+import time
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+
+from generic_images.managers import get_model_class_by_name
+from generic_images.transfer import ImageExporter
+from generic_utils.contenttypes import content_types
+from generic_utils.querysets import keyset_chunks
+
+
+class Command(BaseCommand):
+    args = '<output file or ->'
+    help = ('Exports images (generic_images.AttachedImage by default) with '
+            'their metadata, files and thumbnails to tar stream (see '
+            'generic_images.transfer). Use - to write to stdout.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--model', dest='model',
+                    default='generic_images.AttachedImage',
+                    help='Image model (app_label.ModelName).'),
+        make_option('--object', dest='object', default=None,
+                    help='Export only images of this object '
+                         '(app_label.model:pk).'),
+        make_option('--content-type', dest='content_type', default=None,
+                    help='Export only images of objects of this model '
+                         '(app_label.model).'),
+        make_option('--workers', type='int', dest='workers', default=8,
+                    help='Number of parallel storage readers.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=200, help='Number of images in one manifest.'),
+        make_option('--no-thumbnails', action='store_false',
+                    dest='thumbnails', default=True,
+                    help="Don't export thumbnails (they are rendered on "
+                         "import)."),
+    )
+
+    def handle(self, output=None, **options):
+        if output is None:
+            raise CommandError('Output file is required')
+        model = get_model_class_by_name(options['model'])
+        if model is None:
+            raise CommandError("Model '%s' is not found" % options['model'])
+
+        queryset = model.objects.exclude(image='').select_related('user')
+        if options['object']:
+            label, pk = options['object'].split(':', 1)
+            queryset = queryset.filter(content_type=_content_type(label),
+                                       object_id=pk)
+        elif options['content_type']:
+            queryset = queryset.filter(
+                            content_type=_content_type(options['content_type']))
+
+        out = sys.stdout if output == '-' else open(output, 'wb')
+        # progress goes to stderr when the archive is written to stdout
+        log = sys.stderr if output == '-' else self.stdout
+        exporter = ImageExporter(out, model._meta.get_field('image'),
+                                 options['workers'], options['thumbnails'])
+        started = time.time()
+        try:
+            for chunk in keyset_chunks(queryset, options['chunk_size']):
+                exporter.write_chunk(chunk)
+                log.write('%d images exported (%.1f images/s)\n' %
+                          (exporter.exported,
+                           exporter.exported / (time.time() - started)))
+            exporter.close()
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+
+def _content_type(label):
+    try:
+        app_label, model = label.lower().split('.')
+        return content_types.get_by_natural_key(app_label, model)
+    except (ValueError, ContentType.DoesNotExist):
+        raise CommandError("Model '%s' is not found" % label)
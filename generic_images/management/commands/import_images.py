@@ -0,0 +1,65 @@
+#coding: utf-8
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from generic_images.managers import get_model_class_by_name
+from generic_images.management.commands.export_images import _content_type
+from generic_images.transfer import ImageImporter
+
+
+class Command(BaseCommand):
+    args = '<input file or ->'
+    help = ('Imports images exported by export_images command. Use - to '
+            'read from stdin. Images are attached to objects with the same '
+            'content types and ids as in the source unless --to is given.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--model', dest='model',
+                    default='generic_images.AttachedImage',
+                    help='Image model (app_label.ModelName).'),
+        make_option('--to', dest='to', default=None,
+                    help='Attach all images to this object '
+                         '(app_label.model:pk).'),
+        make_option('--workers', type='int', dest='workers', default=8,
+                    help='Number of parallel storage writers.'),
+        make_option('--render-thumbnails', action='store_false',
+                    dest='reuse_thumbnails', default=True,
+                    help='Render thumbnails instead of storing exported '
+                         'ones.'),
+        make_option('--no-signals', action='store_false', dest='send_signal',
+                    default=True, help="Don't send image_saved signals."),
+    )
+
+    def handle(self, input=None, **options):
+        if input is None:
+            raise CommandError('Input file is required')
+        model = get_model_class_by_name(options['model'])
+        if model is None:
+            raise CommandError("Model '%s' is not found" % options['model'])
+        target = None
+        if options['to']:
+            label, pk = options['to'].split(':', 1)
+            try:
+                target = _content_type(label).get_object_for_this_type(pk=pk)
+            except Exception:
+                raise CommandError("Object '%s' is not found" % options['to'])
+
+        importer = ImageImporter(model, options['workers'],
+                                 options['reuse_thumbnails'], target,
+                                 options['send_signal'])
+        started = time.time()
+        def progress(importer):
+            self.stdout.write('%d images imported, %d skipped '
+                              '(%.1f images/s)\n' % (importer.imported,
+                              importer.skipped,
+                              importer.imported / (time.time() - started)))
+
+        f = sys.stdin if input == '-' else open(input, 'rb')
+        try:
+            importer.run(f, progress)
+        finally:
+            if f is not sys.stdin:
+                f.close()
@@ -0,0 +1,21 @@
+#coding: utf-8
+from django.core.management.base import BaseCommand, CommandError
+
+from generic_images.usage import reconcile
+
+
+class Command(BaseCommand):
+    help = ('Recomputes storage usage counters of users and objects from '
+            'sizes of stored images of all image models with one aggregate '
+            'query per model and counter kind; counters are updated in '
+            'place while locked. Run it after images were changed bypassing '
+            'model methods (e.g. deleted by queryset) or thumbnails were '
+            'regenerated.')
+
+    def handle(self, *args, **options):
+        if args:
+            # counters sum images of all models
+            raise CommandError("Counters can't be recomputed for a part of "
+                               "image models, the command takes no arguments")
+        count = reconcile()
+        self.stdout.write('%d counters updated\n' % count)
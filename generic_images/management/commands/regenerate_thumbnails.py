@@ -0,0 +1,279 @@
+#coding: utf-8
+import json
+import os
+import random
+import time
+from optparse import make_option
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from generic_images.managers import get_model_class_by_name
+from generic_utils.querysets import keyset_chunks
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName]'
+    help = ('Renders missing and changed thumbnails of existing images '
+            '(generic_images.AttachedImage by default). Images are processed '
+            'in pk order by a pool of processes; only sizes that are missing '
+            'in storage or whose options were changed since the last '
+            'completed run (recorded in the checkpoint file) are rendered. '
+            'Interrupted run is resumed from the checkpoint.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=4,
+                    help='Number of rendering processes.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=500, help='Number of rows fetched at once.'),
+        make_option('--checkpoint', dest='checkpoint', default=None,
+                    help='JSON file with progress and thumbnail options of '
+                         'the last completed run.'),
+        make_option('--sizes', dest='sizes', default='',
+                    help='Comma-separated thumbnail names to render even if '
+                         'they exist.'),
+        make_option('--all', action='store_true', dest='all', default=False,
+                    help='Render all sizes of all images.'),
+        make_option('--max-writes', type='float', dest='max_writes',
+                    default=0, help='Max storage writes per second '
+                                    '(0 means no limit).'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False, help='Render thumbnails of a random '
+                    'sample of images without storing them and estimate '
+                    'the cost of the run.'),
+        make_option('--sample', type='int', dest='sample', default=100,
+                    help='Sample size for --dry-run.'),
+    )
+
+    def handle(self, *args, **options):
+        model_name = args[0] if args else 'generic_images.AttachedImage'
+        model = get_model_class_by_name(model_name)
+        if model is None:
+            raise CommandError("Model '%s' is not found" % model_name)
+        field = model._meta.get_field('image')
+        signature = field.thumbs_signature()
+
+        state = _load_state(options['checkpoint'])
+        if state.get('last_pk') is not None and state.get('current') == signature:
+            forced, last_pk = state['forced'], state['last_pk']
+            self.stdout.write('Resuming after pk=%s\n' % last_pk)
+        else:
+            forced, last_pk = _changed_sizes(state.get('specs'), signature), None
+        if options['all']:
+            forced = sorted(signature)
+        for name in filter(None, options['sizes'].split(',')):
+            if name not in signature:
+                raise CommandError("Unknown thumbnail '%s'" % name)
+            forced = sorted(set(forced) | set([name]))
+        if forced:
+            self.stdout.write('Sizes to render for all images: %s\n' %
+                              ', '.join(forced))
+
+        columns = ['pk', 'image']
+        if 'thumbnail_formats' in model._meta.get_all_field_names():
+            columns.append('thumbnail_formats')
+        queryset = model.objects.exclude(image='').values_list(*columns)
+        if last_pk is not None:
+            queryset = queryset.filter(pk__gt=last_pk)
+        total = queryset.count()
+
+        # worker processes are forked, they must not share DB connections
+        for connection in connections.all():
+            connection.close()
+        processes = max(1, options['processes'])
+        pool = Pool(processes, _init_worker, (model_name,
+                            options['max_writes'] / processes, options['dry_run']))
+        try:
+            if options['dry_run']:
+                self._estimate(pool, queryset, total, forced, options)
+            else:
+                self._run(pool, queryset, total, forced, state, signature,
+                          options)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _run(self, pool, queryset, total, forced, state, signature, options):
+        checkpoint = options['checkpoint']
+        verbosity = int(options.get('verbosity', 1))
+        started = time.time()
+        done = rendered = failed = 0
+        for chunk in keyset_chunks(queryset, options['chunk_size']):
+            formats_updates = {} # thumbnail_formats -> pks
+            for pk, names, size, error, formats in pool.imap_unordered(
+                                            _process, _tasks(chunk, forced), 8):
+                if error:
+                    failed += 1
+                    if verbosity > 1:
+                        self.stdout.write('pk=%s: %s\n' % (pk, error))
+                if formats is not None:
+                    formats_updates.setdefault(formats, []).append(pk)
+                rendered += len(names)
+            for formats, pks in formats_updates.items():
+                queryset.model.objects.filter(pk__in=pks).\
+                                update(thumbnail_formats=formats)
+            done += len(chunk)
+            if checkpoint:
+                _save_state(checkpoint, {'specs': state.get('specs'),
+                                         'current': signature,
+                                         'forced': forced,
+                                         'last_pk': chunk[-1][0]})
+            elapsed = time.time() - started
+            rate = done / elapsed if elapsed else 0
+            eta = (total - done) / rate if rate else 0
+            self.stdout.write('%d/%d images, %d thumbnails rendered, %d failed, '
+                              '%.1f images/s, ETA %s\n' % (done, total,
+                              rendered, failed, rate, _format_seconds(eta)))
+        if checkpoint:
+            _save_state(checkpoint, {'specs': signature})
+
+    def _estimate(self, pool, queryset, total, forced, options):
+        sample = _sample(queryset, options['sample'])
+        if not sample:
+            self.stdout.write('Nothing to do\n')
+            return
+        started = time.time()
+        results = pool.map(_process, _tasks(sample, forced), 1)
+        elapsed = time.time() - started
+
+        ok = [r for r in results if not r[3]]
+        factor = float(total) / len(sample)
+        images = sum(1 for r in ok if r[1]) * factor
+        renders = sum(len(r[1]) for r in ok) * factor
+        seconds = elapsed * factor
+        if options['max_writes']:
+            seconds = max(seconds, renders / options['max_writes'])
+        thumbs = len(queryset.model._meta.get_field('image').thumbs)
+        self.stdout.write(
+            'Images: %d (sample of %d, %d failed)\n'
+            'Images to render: ~%d\n'
+            'Thumbnails to render (storage writes): ~%d\n'
+            'Bytes to write: ~%d\n'
+            'Existence checks: %d, original downloads: ~%d\n'
+            'Time with %d processes: ~%s\n' % (
+                total, len(sample), len(results) - len(ok), images, renders,
+                sum(r[2] for r in ok) * factor,
+                total * (thumbs - len(forced)), images,
+                options['processes'], _format_seconds(seconds)))
+
+
+def _changed_sizes(previous, current):
+    if previous is None:
+        # unknown previous options: render only missing files
+        return []
+    return sorted(name for name, options in current.items()
+                  if previous.get(name) != options)
+
+
+def _load_state(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_state(path, state):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(path + '.tmp', path)
+
+
+def _sample(queryset, size):
+    ''' Returns up to ``size`` random rows of (pk, image) queryset without
+        ORDER BY RANDOM() over the whole table. '''
+    first = list(queryset.order_by('pk')[:1])
+    last = list(queryset.order_by('-pk')[:1])
+    if not first:
+        return []
+    rows = {}
+    for i in range(size):
+        pk = random.randint(first[0][0], last[0][0])
+        for row in queryset.filter(pk__gte=pk).order_by('pk')[:1]:
+            rows[row[0]] = row
+    return sorted(rows.values())
+
+
+def _format_seconds(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class _Throttle(object):
+    ''' Allows at most ``rate`` calls of :meth:`wait` per second. '''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_time = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.time()
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+        self.next_time = max(now, self.next_time) + self.interval
+
+
+class _WriteStorage(object):
+    ''' Storage proxy that throttles writes and counts written bytes. With
+        ``discard=True`` nothing is written or deleted. '''
+
+    def __init__(self, storage, throttle, discard=False):
+        self._storage = storage
+        self._throttle = throttle
+        self._discard = discard
+        self.written = 0
+
+    def __getattr__(self, name):
+        return getattr(self._storage, name)
+
+    def save(self, name, content):
+        self.written += content.size
+        if self._discard:
+            return name
+        self._throttle.wait()
+        return self._storage.save(name, content)
+
+    def delete(self, name):
+        if not self._discard:
+            self._storage.delete(name)
+
+
+_worker = {}
+
+
+def _init_worker(model_name, max_writes, dry_run):
+    _worker['model'] = get_model_class_by_name(model_name)
+    _worker['throttle'] = _Throttle(max_writes)
+    _worker['dry_run'] = dry_run
+
+
+def _tasks(rows, forced):
+    ''' Returns tasks for rows (pk, name[, thumbnail_formats]). '''
+    return [(row[0], row[1], forced, row[2] if len(row) > 2 else None)
+            for row in rows]
+
+
+def _process(task):
+    ''' Renders thumbnails of one image in worker process. Returns
+        (pk, rendered thumbnail names, written bytes, error, new value of
+        ``thumbnail_formats`` or None). '''
+    pk, name, forced, formats = task
+    field_file = _worker['model'](pk=pk, image=name).image
+    storage = field_file.storage
+    try:
+        names = [thumb for thumb, options in field_file.field.thumbs
+                 if thumb in forced or
+                    not storage.exists(field_file._calc_thumb_filename(thumb))]
+        if not names:
+            return pk, [], 0, None, None
+        write_storage = _WriteStorage(storage, _worker['throttle'],
+                                      _worker['dry_run'])
+        field_file.render_thumbs(names, write_storage)
+        if formats is not None:
+            formats = field_file.field.rendered_formats(names, formats)
+        return pk, names, write_storage.written, None, formats
+    except Exception, e:
+        # missing or broken file shouldn't stop the run
+        return pk, [], 0, '%s: %s' % (e.__class__.__name__, e), None
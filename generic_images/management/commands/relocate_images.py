@@ -0,0 +1,179 @@
+#coding: utf-8
+import time
+from collections import deque
+from optparse import make_option
+from multiprocessing.pool import ThreadPool
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from generic_images.layout import SHARDED_ROOT, relocated_name
+from generic_images.managers import get_model_class_by_name, \
+                                    bump_images_version
+from generic_images.models import ImageBlob
+from generic_utils.querysets import keyset_chunks
+
+
+class Command(BaseCommand):
+    args = '[app_label.ModelName]'
+    help = ('Moves files of images (generic_images.AttachedImage by default) '
+            'and their thumbnails to the sharded layout (%s/xx/yy/). Files '
+            'are copied in parallel, then image names are switched in one '
+            'UPDATE per chunk and old files are deleted after a delay, so the '
+            'site keeps working during relocation. Interrupted run can be '
+            'simply restarted.' % SHARDED_ROOT)
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=8,
+                    help='Number of parallel storage copies.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=200, help='Number of files switched at once.'),
+        make_option('--delete-delay', type='float', dest='delete_delay',
+                    default=300, help='Seconds to keep old files after the '
+                    'switch (pages rendered before it may still use them).'),
+        make_option('--keep-old', action='store_true', dest='keep_old',
+                    default=False, help="Don't delete old files."),
+    )
+
+    def handle(self, *args, **options):
+        model_name = args[0] if args else 'generic_images.AttachedImage'
+        model = get_model_class_by_name(model_name)
+        if model is None:
+            raise CommandError("Model '%s' is not found" % model_name)
+        field = model._meta.get_field('image')
+        self.model, self.storage = model, field.storage
+
+        queryset = model.objects.exclude(image='').\
+                        exclude(image__startswith=SHARDED_ROOT + '/').\
+                        values_list('pk', 'image', 'content_type', 'object_id')
+        total = queryset.count()
+        pool = ThreadPool(options['workers'])
+        pending = deque() # (deadline, old names) waiting for deletion
+        started = time.time()
+        moved = failed = 0
+        try:
+            for chunk in keyset_chunks(queryset, options['chunk_size']):
+                renames = dict((name, relocated_name(name))
+                               for pk, name, ct, obj in chunk)
+                # names taken by other images are not reused
+                taken = set(model.objects.filter(image__in=renames.values()).
+                            values_list('image', flat=True))
+                renames = dict((old, new) for old, new in renames.items()
+                               if new not in taken)
+                failed += len(taken)
+                copied = pool.map(self._copy_files, renames.items())
+                renames = dict(item for item, ok in zip(renames.items(), copied)
+                               if ok)
+                failed += len(copied) - len(renames)
+
+                switched = self._switch(renames)
+                moved += len(switched)
+                for ct, obj in set((ct, obj) for pk, name, ct, obj in chunk
+                                   if name in switched):
+                    # cached pages and ETags refer to old file URLs
+                    bump_images_version(ct, obj)
+                # names changed concurrently (e.g. image got a new file)
+                pool.map(self._delete_files,
+                         [new for old, new in renames.items()
+                          if old not in switched])
+                pending.append((time.time() + options['delete_delay'],
+                                switched))
+                self._purge(pool, pending, options['keep_old'], False)
+
+                elapsed = time.time() - started
+                self.stdout.write('%d/%d files relocated, %d failed, '
+                                  '%.1f files/s\n' % (moved, total, failed,
+                                  moved / elapsed if elapsed else 0))
+            self._purge(pool, pending, options['keep_old'], True)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _file_names(self, name):
+        ''' Returns names of the original, its thumbnails and their
+            variants. '''
+        return [name] + self.model(image=name).image.thumbnail_files()
+
+    def _copy_files(self, item):
+        old, new = item
+        try:
+            sources, targets = self._file_names(old), self._file_names(new)
+            if not self.storage.exists(old):
+                return False # broken image: leave it as is
+            for source, target in zip(sources, targets):
+                _copy(self.storage, source, target)
+            return True
+        except Exception:
+            return False
+
+    def _delete_files(self, name):
+        for name in self._file_names(name):
+            try:
+                self.storage.delete(name)
+            except Exception:
+                pass # orphans left here are removed by collect_orphaned_images
+
+    @transaction.commit_on_success
+    def _switch(self, renames):
+        ''' Replaces old names with new ones for images and blobs that still
+            have old names. Returns the set of old names that are not used
+            anymore. '''
+        if not renames:
+            return set()
+        olds = list(renames)
+        for model, column in [(self.model, 'image'), (ImageBlob, 'name')]:
+            qn = connection.ops.quote_name
+            column = qn(column)
+            params = []
+            for old in olds:
+                params.extend([old, renames[old]])
+            connection.cursor().execute(
+                'UPDATE %s SET %s = CASE %s %s END WHERE %s IN (%s)' % (
+                    qn(model._meta.db_table), column, column,
+                    ' '.join(['WHEN %s THEN %s'] * len(olds)), column,
+                    ', '.join(['%s'] * len(olds))),
+                params + olds)
+        # raw writes don't mark the transaction as dirty
+        transaction.set_dirty()
+        # the name could be assigned again by deduplication after the UPDATE
+        still_used = set(self.model.objects.filter(image__in=olds).
+                         values_list('image', flat=True))
+        new_names = set(self.model.objects.filter(
+                            image__in=renames.values()).
+                        values_list('image', flat=True))
+        return set(old for old in olds if old not in still_used and
+                   renames[old] in new_names)
+
+    def _purge(self, pool, pending, keep_old, wait):
+        while pending and (wait or pending[0][0] <= time.time()):
+            deadline, names = pending.popleft()
+            if keep_old or not names:
+                continue
+            if deadline > time.time():
+                time.sleep(deadline - time.time())
+            # an image loaded before the switch could be saved back since
+            names = set(names) - set(self.model.objects.filter(
+                            image__in=list(names)).values_list('image', flat=True))
+            pool.map(self._delete_files, list(names))
+
+
+def _copy(storage, source, target):
+    ''' Copies ``source`` file to ``target``. S3 keys are copied on server
+        side. Existing target of the same size (copied by interrupted run)
+        is kept, missing source (e.g. thumbnail) is skipped. '''
+    if not storage.exists(source):
+        return
+    if storage.exists(target):
+        if storage.size(target) == storage.size(source):
+            return
+        storage.delete(target) # partially copied
+    bucket = getattr(storage, 'bucket', None)
+    if bucket is not None:
+        bucket.copy_key(target, bucket.name, source, preserve_acl=True)
+        return
+    f = storage.open(source, 'rb')
+    try:
+        storage.save(target, ContentFile(f.read()))
+    finally:
+        f.close()
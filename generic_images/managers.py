@@ -1,8 +1,19 @@
-from django.db import models
-from django.contrib.contenttypes.models import ContentType
-from django.db.models import get_model
+from django.db import models, connection, transaction
+from django.contrib.auth.models import User
+from django.db.models import get_model, F, Max, Count
+from django.utils import timezone
 
+from generic_utils.contenttypes import content_types
 from generic_utils.managers import GenericModelManager
+from generic_images.signals import image_saved, images_reordered
+from generic_images.routers import pin, read_db_for_object
+from generic_utils.concurrency import submit, submit_task, gather
+from generic_images.phash import candidate_segments, hamming_distance,\
+                                 to_unsigned
+
+
+REORDER_GAP = 1024
+REORDER_BATCH_SIZE = 500
 
 
 def get_model_class_by_name(name):
@@ -11,6 +22,13 @@ def get_model_class_by_name(name):
     return model
 
 
+def bump_images_version(content_type_id, object_id):
+    ''' Increments version of images attached to the object
+        (see :class:`~generic_images.models.ImagesVersion`). '''
+    get_model('generic_images', 'ImagesVersion').objects.bump(content_type_id,
+                                                             object_id)
+
+
 class ImagesAndUserManager(models.Manager):
     """ Useful manager for models that have AttachedImage (or subclass) field
         and 'injector=GenericIngector()' manager.        
@@ -32,6 +50,17 @@ class ImagesAndUserManager(models.Manager):
         objects = self.get_query_set().filter(**kwargs)[:limit]
         self.image_model_class.injector.inject_to(objects,'main_image', is_main=True)
         return objects
+
+    def select_with_effective_main_images(self, limit=None, **kwargs):
+        ''' Like :meth:`select_with_main_images` but if no image of the object
+            is marked as main then the first image (with the highest order)
+            is used. Number of object's images is available as
+            ``object.images_count``. Only 3 sql queries are performed
+            regardless of the number of objects.
+        '''
+        objects = self.get_query_set().filter(**kwargs)[:limit]
+        self.image_model_class.objects.inject_effective_main_images(objects)
+        return objects
     
     def for_user_with_main_images(self, user, limit=None):
         return self.select_with_main_images(user=user, limit=limit)
@@ -50,6 +79,19 @@ class AttachedImageManager(GenericModelManager):
             Deprecated. Use `for_model` instead.
         '''
         return self.for_model(model) 
+
+    def for_model(self, model, content_type=None):
+        ''' Returns all images that are attached to given model. If
+            :class:`~generic_images.routers.ImageReplicaRouter` is used then
+            images are read from a replica unless images of the model were
+            changed recently. '''
+        content_type = content_type or content_types.get_for_model(model)
+        images = super(AttachedImageManager, self).for_model(model,
+                                                             content_type)
+        db = read_db_for_object(content_type.pk, model.pk)
+        if db is not None:
+            images = images.using(db)
+        return images
             
     def get_main_for(self, model):
         '''
@@ -59,4 +101,458 @@ class AttachedImageManager(GenericModelManager):
             return self.for_model(model).get(is_main=True)
         except models.ObjectDoesNotExist:
             return None
-            
+
+    def get_effective_main_for(self, model):
+        '''
+        Returns main image for given model or, if no image is marked as main,
+        the first image (with the highest order). Returns None if the model
+        has no images.
+        '''
+        images = self.for_model(model).order_by('-is_main', '-order', '-pk')
+        for image in images[:1]:
+            return image
+        return None
+
+    def effective_main_images(self, content_type, object_ids):
+        '''
+        Returns dict {object_id: (effective main image or None, number of
+        images)} for objects of ``content_type`` (see
+        :meth:`get_effective_main_for`). 2 queries are performed for any
+        number of objects: the first one counts images and finds the highest
+        order per object, the second one fetches main images and images
+        with these orders.
+        '''
+        images = self.get_query_set().filter(content_type=content_type,
+                                             object_id__in=object_ids)
+        stats = dict((object_id, (count, top)) for object_id, count, top in
+                     images.order_by().values_list('object_id').
+                            annotate(count=Count('pk'), top=Max('order')))
+        results = dict((object_id, (None, 0)) for object_id in object_ids)
+        if not stats:
+            return results
+
+        tops = set(top for count, top in stats.values())
+        candidates = images.filter(models.Q(is_main=True) |
+                                   models.Q(order__in=list(tops)))
+        best = {}
+        for image in candidates:
+            count, top = stats[image.object_id]
+            if not image.is_main and image.order != top:
+                continue # the order is the highest for another object
+            key = (image.is_main, image.order, image.pk)
+            current = best.get(image.object_id)
+            if current is None or key > current[0]:
+                best[image.object_id] = key, image
+
+        for object_id, (count, top) in stats.items():
+            results[object_id] = best[object_id][1], count
+        return results
+
+    def inject_effective_main_images(self, objects, field_name='main_image',
+                                     count_field='images_count',
+                                     get_inject_object=lambda obj: obj):
+        '''
+        Makes effective main image (see :meth:`get_effective_main_for`) of
+        each object accessible as ``field_name`` attribute and the number of
+        its images as ``count_field`` attribute of
+        ``get_inject_object(obj)``. Objects may be of different models;
+        2 queries per model are performed. Returns ``objects``.
+
+        Example::
+
+            posts = Post.objects.all()[:20]
+            AttachedImage.objects.inject_effective_main_images(posts)
+            # posts[i].main_image, posts[i].images_count
+        '''
+        targets_by_ctype = {}
+        for obj in objects:
+            target = get_inject_object(obj)
+            content_type = content_types.get_for_model(target)
+            targets_by_ctype.setdefault(content_type, []).append(target)
+
+        for content_type, targets in targets_by_ctype.items():
+            results = self.effective_main_images(
+                            content_type, list(set(t.pk for t in targets)))
+            for target in targets:
+                image, count = results[target.pk]
+                setattr(target, field_name, image)
+                setattr(target, count_field, count)
+        return objects
+
+    def aget_main_for(self, model):
+        ''' Returns AsyncResult with main image for given model (see
+            :mod:`generic_utils.concurrency`). '''
+        content_types.get_for_model(model) # warm the cache
+        return submit(self.get_main_for, model)
+
+    def bulk_attach(self, model, files, user=None, send_signal=True,
+                    background_writes=None):
+        '''
+        Attaches uploaded ``files`` (django File instances) to ``model`` and
+        returns the list of created images. Files and their thumbnails are
+        stored one by one but images are inserted using 1 query, ``order``
+        of all of them is set by 1 UPDATE (it is the image's pk, so
+        concurrent uploads get distinct orders) and ``image_saved`` signal
+        is sent once (so image count fields are recalculated once) instead
+        of doing all this for every image.
+
+        If ``background_writes`` is a list then thumbnails are stored in
+        background threads while next images are processed (AsyncResults
+        are appended to the list); rows are inserted when all writes are
+        finished.
+        '''
+        content_type = content_types.get_for_model(model)
+        pin(content_type.pk, model.pk)
+        max_pk = self.aggregate(m=Max('pk'))['m'] or 0
+
+        images, register_blobs = [], []
+        for content in files:
+            image = self.model(content_type=content_type, object_id=model.pk,
+                               user=user)
+            image.image = content
+            if image._ingest_image():
+                register_blobs.append(image)
+            image.image.background_writes = background_writes
+            image._store_image()
+            images.append(image)
+
+        if background_writes:
+            gather(*background_writes)
+        with transaction.commit_on_success():
+            self.bulk_create(images)
+            # bulk_create doesn't set pks: created rows are found by file
+            # names (equal names of older images are reused blobs)
+            created = self.filter(content_type=content_type,
+                            object_id=model.pk, pk__gt=max_pk,
+                            image__in=[image.image.name for image in images])
+            created.update(order=F(self.model._meta.pk.attname))
+            get_model('generic_images', 'StorageUsage').objects.add(
+                    collect_usage([image._usage_row() for image in images]))
+        images = list(created)
+        renamed = {} # stored name -> name of the file stored concurrently
+        for image in register_blobs:
+            name = image.image.name
+            renamed[name] = image._register_blob()
+        for image in images:
+            if image.image.name in renamed:
+                image.image = renamed[image.image.name]
+        bump_images_version(content_type.pk, model.pk)
+
+        if images and send_signal:
+            image_saved.send(sender=model.__class__, instance=images[0])
+        return images
+
+    def aattach(self, model, files, user=None, send_signal=True):
+        '''
+        Asynchronous :meth:`bulk_attach`: returns AsyncResult with the list
+        of created images. Image files are processed in background, their
+        thumbnails are stored concurrently (so storage latency of the
+        writes overlaps with each other and with rendering and DB queries
+        for the next images). ``files`` must stay open until the result is
+        ready.
+        '''
+        # reads of the caller that follow must see the images
+        pin(content_types.get_for_model(model).pk, model.pk)
+        return submit_task(self.bulk_attach, model, list(files), user,
+                           send_signal, background_writes=[])
+
+    def reorder(self, model, ordered_ids, gap=1, send_signal=True):
+        '''
+        Sets the order of images attached to ``model``. ``ordered_ids`` is
+        the list of image ids in display order (the first one is shown
+        first). Images that are not listed keep their relative order and
+        are placed after listed ones.
+
+        ``order`` of all images is rewritten with ``UPDATE ... CASE``
+        statements (1 statement per ``REORDER_BATCH_SIZE`` images) instead
+        of saving every image, so image_saved signal and image count
+        recalculation are not triggered. ``images_reordered`` signal is
+        sent once instead. ``gap`` is the difference between orders of
+        adjacent images (orders can become negative), gaps allow
+        :meth:`move` to change 1 row.
+
+        Returns dict {image id: new order}.
+        '''
+        content_type = content_types.get_for_model(model)
+        pin(content_type.pk, model.pk)
+        current = list(self.for_model(model, content_type).
+                       values_list('pk', 'order'))
+        current_set = set(pk for pk, order in current)
+        ordered_ids = [int(pk) for pk in ordered_ids]
+        listed = set(ordered_ids)
+        if not listed <= current_set:
+            raise ValueError('Images %s are not attached to %r' %
+                             (sorted(listed - current_set), model))
+        ids = ordered_ids + [pk for pk, order in current if pk not in listed]
+
+        # Default ordering is '-order'. Orders are counted down from the
+        # current top so new images (order=max(pk)+1) stay on top.
+        top = max([order for pk, order in current] + [len(ids)])
+        orders = dict((pk, top - i*gap) for i, pk in enumerate(ids))
+        self._update_orders(orders)
+        bump_images_version(content_type.pk, model.pk)
+        if send_signal:
+            images_reordered.send(sender=model.__class__, instance=model,
+                                  orders=orders)
+        return orders
+
+    def move(self, image, after=None, gap=REORDER_GAP, send_signal=True):
+        '''
+        Moves ``image`` right after ``after`` image (to the top if
+        ``after`` is None) in display order. If there is a gap between
+        orders of neighbours only ``image`` row is updated, otherwise all
+        images of the object are renumbered with :meth:`reorder` using
+        ``gap``. Returns dict {image id: new order} for changed images.
+        '''
+        pin(image.content_type_id, image.object_id)
+        siblings = self.filter(content_type=image.content_type_id,
+                               object_id=image.object_id).exclude(pk=image.pk)
+        if after is None:
+            upper = None
+            lower = siblings.aggregate(order=Max('order'))['order']
+        else:
+            upper = after.order
+            lower = siblings.filter(order__lt=upper).\
+                            aggregate(order=Max('order'))['order']
+
+        if upper is None:
+            # not more than needed: new images are placed above it
+            new_order = (lower or 0) + 1
+        elif lower is None:
+            new_order = upper - gap
+        elif upper - lower >= 2:
+            new_order = (upper + lower) // 2
+        else:
+            # no room between neighbours
+            ids = list(siblings.order_by('-order', 'pk').
+                       values_list('pk', flat=True))
+            position = ids.index(after.pk) + 1 if after is not None else 0
+            ids.insert(position, image.pk)
+            return self.reorder(image.content_object, ids, gap, send_signal)
+
+        orders = {image.pk: new_order}
+        self._update_orders(orders)
+        bump_images_version(image.content_type_id, image.object_id)
+        image.order = new_order
+        if send_signal:
+            obj = image.content_object
+            images_reordered.send(sender=obj.__class__, instance=obj,
+                                  orders=orders)
+        return orders
+
+    @transaction.commit_on_success
+    def _update_orders(self, orders):
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        pk_column = qn(opts.pk.column)
+        items = sorted(orders.items())
+        now = timezone.now()
+        updated_at = opts.get_field('updated_at').get_db_prep_save(
+                                                now, connection=connection)
+        for start in range(0, len(items), REORDER_BATCH_SIZE):
+            batch = items[start:start+REORDER_BATCH_SIZE]
+            if len(batch) == 1:
+                self.filter(pk=batch[0][0]).update(order=batch[0][1],
+                                                   updated_at=now)
+                continue
+            # ids and orders are integers, they are inlined so big
+            # batches don't hit the limit of query parameters
+            case = ' '.join(['WHEN %d THEN %d' % (pk, order)
+                             for pk, order in batch])
+            connection.cursor().execute(
+                'UPDATE %s SET %s = CASE %s %s END, %s = %%s WHERE %s IN (%s)' % (
+                    qn(opts.db_table), qn(opts.get_field('order').column),
+                    pk_column, case, qn(opts.get_field('updated_at').column),
+                    pk_column, ', '.join([str(pk) for pk, order in batch])),
+                [updated_at])
+            # raw writes don't mark the transaction as dirty, it wouldn't
+            # be committed otherwise
+            transaction.set_dirty()
+
+    def near_duplicates(self, image, max_distance=6, within='object'):
+        '''
+        Returns list of images that look like ``image`` (resized or
+        recompressed copies of the same photo), most similar first.
+        Each returned image has ``hamming_distance`` attribute: number of
+        different bits in perceptual hashes. ``within`` can be 'object'
+        (images attached to the same object), 'user' (images uploaded by the
+        same user) or 'global'.
+
+        Candidates are selected by indexed perceptual hash segments so the
+        lookup doesn't scan all images. ``max_distance`` up to 11 is cheap;
+        greater values make segment lookups much bigger.
+        '''
+        if image.phash is None:
+            return []
+        value = to_unsigned(image.phash)
+
+        lookups = models.Q()
+        for i, variants in enumerate(candidate_segments(value, max_distance)):
+            lookups |= models.Q(**{'phash_%d__in' % i: variants})
+
+        candidates = self.get_query_set().filter(lookups).exclude(pk=image.pk)
+        if within == 'object':
+            candidates = candidates.filter(content_type=image.content_type_id,
+                                           object_id=image.object_id)
+        elif within == 'user':
+            candidates = candidates.filter(user=image.user_id)
+        elif within != 'global':
+            raise ValueError("'within' must be 'object', 'user' or 'global'")
+
+        results = []
+        for candidate in candidates:
+            distance = hamming_distance(value, to_unsigned(candidate.phash))
+            if distance <= max_distance:
+                candidate.hamming_distance = distance
+                results.append(candidate)
+        results.sort(key=lambda candidate: candidate.hamming_distance)
+        return results
+
+
+class ImagesVersionManager(models.Manager):
+    ''' Manager for :class:`~generic_images.models.ImagesVersion`. '''
+
+    def bump(self, content_type_id, object_id):
+        now = timezone.now()
+        lookup = dict(content_type=content_type_id, object_id=object_id)
+        if self.filter(**lookup).update(version=F('version')+1,
+                                        updated_at=now):
+            return
+        content_type = content_types.get_for_id(content_type_id)
+        version, created = self.get_or_create(content_type=content_type,
+                                              object_id=object_id,
+                                              defaults={'version': 1,
+                                                        'updated_at': now})
+        if not created: # created concurrently
+            self.filter(**lookup).update(version=F('version')+1,
+                                         updated_at=now)
+
+    def get_for(self, content_type_id, object_id):
+        ''' Returns (version, updated_at) tuple. It is (0, None) if images
+            of the object were never changed. '''
+        try:
+            return self.filter(content_type=content_type_id,
+                               object_id=object_id).\
+                        values_list('version', 'updated_at')[0]
+        except IndexError:
+            return 0, None
+
+
+def collect_usage(rows, sign=1, changes=None):
+    ''' Adds storage usage changes for images to ``changes`` dict
+        {(scope, content_type_id, object_id): [images, bytes]} and returns
+        it. ``rows`` is a list of (content_type_id, object_id, user_id,
+        stored bytes) tuples, ``sign`` is 1 for added and -1 for removed
+        images. '''
+    if changes is None:
+        changes = {}
+    user_ct_id = None
+    for content_type_id, object_id, user_id, size in rows:
+        keys = [('object', content_type_id, object_id)]
+        if user_id is not None:
+            if user_ct_id is None:
+                user_ct_id = content_types.get_for_model(User).pk
+            keys.append(('user', user_ct_id, user_id))
+        for key in keys:
+            change = changes.setdefault(key, [0, 0])
+            change[0] += sign
+            change[1] += sign * (size or 0)
+    return changes
+
+
+class StorageUsageManager(models.Manager):
+    ''' Manager for :class:`~generic_images.models.StorageUsage`.
+        Counters are changed with single UPDATE statements so concurrent
+        uploads and deletes don't lose changes. '''
+
+    def add(self, changes):
+        ''' Applies ``changes`` collected by :func:`collect_usage`. '''
+        for (scope, content_type_id, object_id), (images, size) in \
+                changes.items():
+            if not images and not size:
+                continue
+            lookup = dict(scope=scope, content_type=content_type_id,
+                          object_id=object_id)
+            update = dict(images=F('images')+images, bytes=F('bytes')+size)
+            if self.filter(**lookup).update(**update):
+                continue
+            content_type = content_types.get_for_id(content_type_id)
+            usage, created = self.get_or_create(scope=scope,
+                                                content_type=content_type,
+                                                object_id=object_id,
+                                                defaults={'images': images,
+                                                          'bytes': size})
+            if not created: # created concurrently
+                self.filter(**lookup).update(**update)
+
+    def get_for(self, scope, content_type_id, object_id):
+        ''' Returns (images, bytes) tuple. '''
+        try:
+            return self.filter(scope=scope, content_type=content_type_id,
+                               object_id=object_id).\
+                        values_list('images', 'bytes')[0]
+        except IndexError:
+            return 0, 0
+
+    def for_object(self, obj):
+        ''' Returns (images, bytes) stored for images attached to ``obj``. '''
+        return self.get_for('object', content_types.get_for_model(obj).pk,
+                            obj.pk)
+
+    def for_user(self, user):
+        ''' Returns (images, bytes) stored for images uploaded by ``user``. '''
+        return self.get_for('user', content_types.get_for_model(User).pk,
+                            user.pk)
+
+
+class ImageBlobManager(models.Manager):
+    ''' Manager for reference-counted image files
+        (:class:`~generic_images.models.ImageBlob`).
+        All reference count changes are single UPDATE statements so
+        concurrent uploads and deletes don't lose references.
+    '''
+
+    def acquire(self, digest):
+        ''' Adds a reference to the file with given content ``digest``.
+            Returns file name or None if there is no such file yet.
+        '''
+        if self.filter(digest=digest, ref_count__gt=0).\
+                update(ref_count=F('ref_count')+1):
+            return self.filter(digest=digest).values_list('name', flat=True)[0]
+        return None
+
+    def register(self, digest, name):
+        ''' Registers just stored file ``name`` with 1 reference and returns
+            ``name``. If the file with the same content was registered
+            concurrently then a reference to that file is added and its name
+            is returned instead: the caller should use it and delete file
+            ``name``.
+        '''
+        while True:
+            blob, created = self.get_or_create(digest=digest,
+                                defaults={'name': name, 'ref_count': 1})
+            if created:
+                return name
+            shared = self.acquire(digest)
+            if shared is not None:
+                return shared
+            # the last reference was just released: take the row over
+            # (release() deletes it by the old name)
+            if self.filter(digest=digest, ref_count=0).\
+                    update(name=name, ref_count=1):
+                return name
+
+    def release(self, name):
+        ''' Drops a reference to the file ``name``. Returns True if the file
+            is not referenced anymore and should be deleted.
+        '''
+        while True:
+            if self.filter(name=name, ref_count__gt=1).\
+                    update(ref_count=F('ref_count')-1):
+                return False
+            if self.filter(name=name, ref_count=1).update(ref_count=0):
+                self.filter(name=name).delete()
+                return True
+            if not self.filter(name=name, ref_count__gt=0).exists():
+                # file is not shared (or it is being released concurrently)
+                return True
@@ -50,6 +50,229 @@ var AttachedImagesAdminUploader = new Class({
 
 });
 
+/*
+    Inserts rows for images created by uploaders into the inline table, so
+    the page doesn't have to be reloaded. New rows are cloned from the
+    empty form row and become initial forms of the formset.
+*/
+var AttachedImagesTable = new Class({
+
+    initialize: function(table){
+        this.table = table;
+        this.prefix = table.get('data-prefix');
+        this.newImagesUrl = table.get('data-new-images-url');
+        this.lastId = (table.get('data-last-id') || '0').toInt();
+        this.tbody = table.getElement('tbody');
+        this.emptyRow = $(this.prefix + '-empty');
+        this.form = table.getParent('form');
+    },
+
+    field: function(row, name){
+        return row.getElement('[name$=-' + name + ']');
+    },
+
+    rows: function(){
+        return this.tbody.getChildren('tr').filter(function(row){
+            return row.get('id') && !row.hasClass('empty-form');
+        });
+    },
+
+    /* loads images created after the page was rendered and inserts them */
+    fetchNew: function(callback){
+        var self = this;
+        new Request.JSON({
+            url: this.newImagesUrl,
+            method: 'get',
+            noCache: true,
+            onSuccess: function(data){
+                self.splice(data.images);
+                if (callback) callback(data.images);
+            }
+        }).send({data: {after: this.lastId}});
+    },
+
+    splice: function(images){
+        var self = this;
+        images.each(function(image){
+            self.lastId = Math.max(self.lastId, image.id);
+        });
+        // paginated inline manages its own rows and numbering
+        var paginated = this.table.retrieve('paginatedInline');
+        if (paginated)
+            return paginated.addImages(images);
+
+        var firstExtra = this.rows().filter(function(row){
+            var id = self.field(row, 'id');
+            return !id || !id.get('value');
+        })[0] || this.emptyRow;
+        images.each(function(image){
+            self.buildRow(image).inject(firstExtra, 'before');
+        });
+        this.renumber();
+    },
+
+    buildRow: function(image){
+        var row = this.emptyRow.clone(true, true);
+        row.removeClass('empty-form').addClass('has_original');
+        var self = this;
+        this.field(row, 'id').set('value', image.id);
+        $each(image.fields, function(value, name){
+            var input = self.field(row, name);
+            if (!input)
+                return;
+            if (input.get('type') == 'checkbox')
+                input.checked = !!value;
+            else
+                input.set('value', value);
+        });
+
+        var original = row.getElement('td.original');
+        var p = new Element('p').inject(original, 'top');
+        if (image.thumbnail)
+            new Element('img', {src: image.thumbnail}).inject(p);
+        new Element('a', {href: image.url, text: image.title}).inject(p);
+        return row;
+    },
+
+    renumberRow: function(row, index){
+        var re = new RegExp('(' + this.prefix + '-)[^-]+-');
+        var replacement = '$1' + index + '-';
+        row.getElements('*').each(function(el){
+            ['name', 'id', 'for'].each(function(attr){
+                var value = el.get(attr);
+                if (value && re.test(value))
+                    el.set(attr, value.replace(re, replacement));
+            });
+        });
+    },
+
+    /* initial forms must come first, numbers must be sequential */
+    renumber: function(){
+        var self = this, initial = 0;
+        var rows = this.rows();
+        rows.each(function(row, i){
+            self.renumberRow(row, i);
+            row.set('id', self.prefix + '-' + i);
+            var id = self.field(row, 'id');
+            if (id && id.get('value'))
+                initial++;
+        });
+        this.form.getElement('[name=' + this.prefix + '-TOTAL_FORMS]').
+                set('value', rows.length);
+        this.form.getElement('[name=' + this.prefix + '-INITIAL_FORMS]').
+                set('value', initial);
+    }
+});
+
+AttachedImagesTable.get = function(){
+    var table = $('attached-images-table');
+    if (!table)
+        return null;
+    var instance = table.retrieve('imagesTable');
+    if (!instance) {
+        instance = new AttachedImagesTable(table);
+        table.store('imagesTable', instance);
+    }
+    return instance;
+};
+
+window.AttachedImagesTable = AttachedImagesTable;
+
+
+/*
+    Drag-and-drop reordering of saved images. Rows are dragged by the
+    thumbnail cell. After a drop the new position is sent to the server
+    (only the moved image is changed there in most cases) and 'order'
+    inputs are updated with returned values.
+*/
+var ImagesDragReorder = new Class({
+
+    initialize: function(imagesTable){
+        this.imagesTable = imagesTable;
+        this.url = imagesTable.table.get('data-reorder-url');
+        var self = this;
+        // drag events are not supported by mootools 1.2 Element.addEvent
+        var listen = function(type, handler){
+            imagesTable.tbody.addEventListener(type, function(event){
+                var row = $(event.target).getParent('tr') ||
+                          (event.target.tagName == 'TR' ? $(event.target) : null);
+                if (row)
+                    handler(event, row);
+            }, false);
+        };
+        listen('mousedown', function(event, row){
+            var target = $(event.target);
+            var inThumbnail = target.match('td.original') ||
+                              target.getParent('td.original');
+            if (inThumbnail && self.imageId(row))
+                row.set('draggable', 'true');
+        });
+        listen('dragstart', function(event, row){
+            self.dragged = row;
+            row.addClass('dragging');
+            event.dataTransfer.effectAllowed = 'move';
+            event.dataTransfer.setData('text', self.imageId(row));
+        });
+        listen('dragover', function(event, row){
+            if (self.dragged && self.imageId(row))
+                event.preventDefault();
+        });
+        listen('drop', function(event, row){
+            event.preventDefault();
+            self.drop(row, event.clientY);
+        });
+        listen('dragend', function(event, row){
+            row.removeClass('dragging').set('draggable', 'false');
+            self.dragged = null;
+        });
+    },
+
+    imageId: function(row){
+        var input = this.imagesTable.field(row, 'id');
+        return input ? input.get('value') : '';
+    },
+
+    drop: function(target, y){
+        var row = this.dragged;
+        if (!row || row == target || !this.imageId(target))
+            return;
+        var coords = target.getCoordinates();
+        var where = y < coords.top + coords.height / 2 ? 'before' : 'after';
+        row.inject(target, where);
+
+        // the closest saved image above the dropped row
+        var after = row.getAllPrevious('tr').filter(function(prev){
+            return this.imageId(prev);
+        }, this)[0];
+
+        var self = this;
+        new Request.JSON({
+            url: this.url,
+            headers: {'X-CSRFToken': Cookie.read('csrftoken') || ''},
+            onSuccess: function(data){ self.updateOrders(data.orders); },
+            onFailure: function(){ window.location.reload(); }
+        }).post({image: this.imageId(row),
+                 after: after ? this.imageId(after) : ''});
+    },
+
+    updateOrders: function(orders){
+        var self = this;
+        this.imagesTable.rows().each(function(row){
+            var id = self.imageId(row);
+            if (id && orders[id] !== undefined)
+                self.imagesTable.field(row, 'order').set('value', orders[id]);
+        });
+    }
+});
+
+window.ImagesDragReorder = ImagesDragReorder;
+
+window.addEvent('domready', function(){
+    var imagesTable = AttachedImagesTable.get();
+    if (imagesTable && imagesTable.table.get('data-reorder-url'))
+        new ImagesDragReorder(imagesTable);
+});
+
 window.addEvent('domready', function(){
 
     if (!window.google || !google.gears)
@@ -82,7 +305,14 @@ window.addEvent('domready', function(){
             maxWidth: getMaxWidth(),
 
             onUploadComplete: function(){
-                setTimeout(function(){window.location.reload();},0);
+                var table = AttachedImagesTable.get();
+                if (!table || !table.newImagesUrl) {
+                    setTimeout(function(){window.location.reload();},0);
+                    return;
+                }
+                // images are created by the change view, only they are
+                // fetched and inserted into the table
+                table.fetchNew(function(){ $('thumbs').empty(); });
             },
             onBeforeProcess: function(){
                 this.options.maxWidth = getMaxWidth();
@@ -0,0 +1,249 @@
+(function($){  //$-safe plugin
+
+/*
+    HTML5 multi-image uploader for attached images inline.
+
+    Images wider than max width are resized in browser using canvas. Each
+    file is sent in chunks, several chunks (of one or different files) are
+    uploaded in parallel. Upload ids are derived from file properties so
+    if upload is interrupted (e.g. page is reloaded) and the same files are
+    selected again then only chunks not received by server are sent.
+    When all files are uploaded images are created with one request.
+
+    It is used when browser supports File API, canvas and XHR2 and
+    replaces Gears uploader.
+*/
+
+var HTML5ImagesUploader = new Class({
+
+    Implements: [Options, Events],
+
+    options: {
+        chunkSize: 1024 * 1024,
+        parallel: 4,
+        jpegQuality: 0.9
+        /* onComplete: function(data){} */
+    },
+
+    initialize: function(container, options){
+        this.setOptions(options);
+        this.container = container;
+        this.url = container.get('data-upload-url');
+        this.input = $('html5-files');
+        this.progress = $('html5-upload-progress');
+        this.status = $('html5-upload-status');
+
+        var self = this;
+        $('html5-upload-handler').addEvent('click', function(){
+            self.start(Array.prototype.slice.call(self.input.files));
+        });
+    },
+
+    maxWidth: function(){
+        if (!$('html5-resize-needed').checked)
+            return 0;
+        return $('html5-resize-width').get('value').toInt() || 0;
+    },
+
+    csrfToken: function(){
+        return Cookie.read('csrftoken') || '';
+    },
+
+    uploadId: function(file, maxWidth){
+        var key = [file.name, file.size, file.lastModified, maxWidth].join(':');
+        var hash = 5381;
+        for (var i = 0; i < key.length; i++)
+            hash = ((hash * 33) ^ key.charCodeAt(i)) >>> 0;
+        return 'u' + hash.toString(16) + '-' + file.size.toString(16);
+    },
+
+    /* calls callback with Blob of (possibly resized) image */
+    prepare: function(file, maxWidth, callback){
+        if (!maxWidth || !/^image\/(jpeg|png)$/.test(file.type))
+            return callback(file);
+        var self = this;
+        var img = new Image();
+        var url = URL.createObjectURL(file);
+        img.onload = function(){
+            URL.revokeObjectURL(url);
+            if (img.naturalWidth <= maxWidth)
+                return callback(file);
+            var canvas = document.createElement('canvas');
+            canvas.width = maxWidth;
+            canvas.height = Math.round(img.naturalHeight * maxWidth / img.naturalWidth);
+            canvas.getContext('2d').drawImage(img, 0, 0, canvas.width, canvas.height);
+            canvas.toBlob(function(blob){ callback(blob || file); },
+                          'image/jpeg', self.options.jpegQuality);
+        };
+        img.onerror = function(){
+            URL.revokeObjectURL(url);
+            callback(file);
+        };
+        img.src = url;
+    },
+
+    request: function(method, url, data, callback){
+        var xhr = new XMLHttpRequest();
+        xhr.open(method, url, true);
+        xhr.setRequestHeader('X-CSRFToken', this.csrfToken());
+        xhr.setRequestHeader('X-Requested-With', 'XMLHttpRequest');
+        xhr.onreadystatechange = function(){
+            if (xhr.readyState != 4)
+                return;
+            var response = null;
+            try { response = JSON.decode(xhr.responseText); } catch (e) {}
+            callback(xhr.status == 200 ? null : (xhr.status || 'network'), response);
+        };
+        xhr.send(data);
+        return xhr;
+    },
+
+    start: function(files){
+        if (!files.length || this.running)
+            return;
+        this.running = true;
+        this.uploads = [];
+        this.queue = [];
+        this.active = 0;
+        this.sentBytes = 0;
+        this.totalBytes = 0;
+        this.failed = false;
+        this.setStatus('Preparing...');
+
+        var self = this, pending = files.length, maxWidth = this.maxWidth();
+        files.each(function(file){
+            self.prepare(file, maxWidth, function(blob){
+                self.addUpload(file.name, blob, self.uploadId(file, maxWidth),
+                               function(){ if (--pending == 0) self.next(); });
+            });
+        });
+    },
+
+    addUpload: function(name, blob, uploadId, callback){
+        var self = this;
+        var upload = {
+            id: uploadId,
+            // resized images are always encoded as JPEG
+            name: blob instanceof File ? name : name.replace(/\.[^.]*$/, '') + '.jpg',
+            blob: blob,
+            total: Math.max(1, Math.ceil(blob.size / this.options.chunkSize))
+        };
+        this.uploads.push(upload);
+        this.totalBytes += blob.size;
+
+        // ask which chunks are already received (resume)
+        var url = this.url + '?upload_id=' + encodeURIComponent(uploadId);
+        this.request('GET', url, null, function(error, data){
+            var received = (!error && data && data.total == upload.total) ? data.received : [];
+            for (var i = 0; i < upload.total; i++) {
+                if (received.contains(i))
+                    self.sentBytes += self.chunkBlob(upload, i).size;
+                else
+                    self.queue.push({upload: upload, index: i});
+            }
+            callback();
+        });
+    },
+
+    chunkBlob: function(upload, index){
+        var size = this.options.chunkSize;
+        return upload.blob.slice(index * size, Math.min((index + 1) * size, upload.blob.size));
+    },
+
+    next: function(){
+        if (this.failed)
+            return;
+        if (!this.queue.length && !this.active)
+            return this.complete();
+        while (this.active < this.options.parallel && this.queue.length)
+            this.sendChunk(this.queue.shift(), 3);
+    },
+
+    sendChunk: function(task, retries){
+        var self = this;
+        var blob = this.chunkBlob(task.upload, task.index);
+        var data = new FormData();
+        data.append('upload_id', task.upload.id);
+        data.append('index', task.index);
+        data.append('total', task.upload.total);
+        data.append('chunk', blob, task.upload.name);
+
+        this.active++;
+        this.request('POST', this.url, data, function(error){
+            self.active--;
+            if (error) {
+                if (retries > 0)
+                    return self.sendChunk(task, retries - 1);
+                self.failed = true;
+                self.running = false;
+                self.setStatus('Upload failed (' + error + '), try again to resume');
+                return;
+            }
+            self.sentBytes += blob.size;
+            self.updateProgress();
+            self.next();
+        });
+    },
+
+    complete: function(){
+        var self = this;
+        var data = new FormData();
+        this.uploads.each(function(upload){
+            data.append('upload_id', upload.id);
+            data.append('name', upload.name);
+        });
+        this.setStatus('Creating images...');
+        this.request('POST', this.url + 'complete/', data, function(error, response){
+            self.running = false;
+            if (error) {
+                self.setStatus('Upload failed (' + error + ')');
+                return;
+            }
+            self.setStatus('');
+            self.input.set('value', '');
+            self.fireEvent('complete', [response]);
+        });
+    },
+
+    updateProgress: function(){
+        var percent = this.totalBytes ? Math.round(100 * this.sentBytes / this.totalBytes) : 100;
+        this.progress.set('value', percent);
+        this.setStatus(percent + '%');
+    },
+
+    setStatus: function(text){
+        this.status.set('text', text);
+    }
+});
+
+HTML5ImagesUploader.supported = function(){
+    return !!(window.FormData && window.File && window.Blob && window.URL &&
+              Blob.prototype.slice && HTMLCanvasElement.prototype.toBlob);
+};
+
+window.HTML5ImagesUploader = HTML5ImagesUploader;
+
+window.addEvent('domready', function(){
+    var container = $('html5-uploader');
+    if (!container || !HTML5ImagesUploader.supported())
+        return;
+
+    new HTML5ImagesUploader(container, {
+        onComplete: function(data){
+            var table = AttachedImagesTable.get();
+            if (table)
+                table.splice(data.images);
+            else
+                setTimeout(function(){window.location.reload();},0);
+        }
+    });
+
+    container.show();
+    // Gears uploader is not needed
+    if ($('gears-please-install'))
+        $('gears-please-install').hide();
+    if ($('gears-uploader'))
+        $('gears-uploader').hide();
+});
+
+})(document.id); // end $-safe plugin
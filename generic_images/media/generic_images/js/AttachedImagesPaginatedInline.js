@@ -0,0 +1,180 @@
+(function($){  //$-safe plugin
+
+/*
+    Paginated inline for attached images.
+
+    Only the first page of images is rendered by django. Next pages are
+    loaded from JSON endpoint (rows are cloned from the empty form row).
+    Before the form is submitted all unchanged rows are excluded and
+    remaining rows are renumbered, so the server handles only changed
+    images.
+*/
+
+var PaginatedImagesInline = new Class({
+
+    initialize: function(table){
+        this.table = table;
+        this.prefix = table.get('data-prefix');
+        this.url = table.get('data-images-url');
+        this.pageSize = table.get('data-page-size').toInt();
+        this.total = table.get('data-total').toInt();
+        this.tbody = table.getElement('tbody');
+        this.emptyRow = $(this.prefix + '-empty');
+        this.form = table.getParent('form');
+        this.button = $('load-more-images');
+        this.status = $('images-loaded-status');
+        this.offset = this.pageSize;
+        this.lazyCounter = 0;
+
+        var self = this;
+        // the page is re-rendered with validation errors: it contains only
+        // rows that were submitted, they should be submitted again
+        var resubmit = !!this.table.getElement('.errorlist');
+        this.rows().each(function(row){
+            self.watch(row);
+            if (resubmit)
+                row.addClass('dirty');
+        });
+        this.button.addEvent('click', function(){ self.loadPage(); });
+        this.form.addEvent('submit', function(){ self.prepareSubmit(); });
+        this.updateStatus();
+        table.store('paginatedInline', this);
+    },
+
+    rows: function(){
+        return this.tbody.getChildren('tr').filter(function(row){
+            return row.get('id') && !row.hasClass('empty-form');
+        });
+    },
+
+    watch: function(row){
+        row.getElements('input, select, textarea').addEvent('change', function(){
+            row.addClass('dirty');
+        });
+    },
+
+    field: function(row, name){
+        return row.getElement('[name$=-' + name + ']');
+    },
+
+    hasImage: function(id){
+        var self = this;
+        return this.rows().some(function(row){
+            var input = self.field(row, 'id');
+            return input && input.get('value') == String(id);
+        });
+    },
+
+    addRow: function(image){
+        if (this.hasImage(image.id))
+            return;
+        var index = 'lazy' + (this.lazyCounter++);
+        var row = this.emptyRow.clone(true, true);
+        this.renumber(row, index);
+        row.removeClass('empty-form').addClass('has_original');
+        row.set('id', this.prefix + '-' + index);
+
+        this.field(row, 'id').set('value', image.id);
+        var self = this;
+        $each(image.fields, function(value, name){
+            var input = self.field(row, name);
+            if (!input)
+                return;
+            if (input.get('type') == 'checkbox')
+                input.checked = !!value;
+            else
+                input.set('value', value);
+        });
+
+        var original = row.getElement('td.original');
+        var p = new Element('p').inject(original, 'top');
+        if (image.thumbnail)
+            new Element('img', {src: image.thumbnail}).inject(p);
+        new Element('a', {href: image.url, text: image.title}).inject(p);
+
+        row.inject(this.emptyRow, 'before');
+        this.watch(row);
+    },
+
+    /* adds just uploaded images */
+    addImages: function(images){
+        var self = this;
+        images.each(function(image){ self.addRow(image); });
+        // they are at the end of the list, loaded pages skip them
+        this.total += images.length;
+        this.updateStatus();
+    },
+
+    loadPage: function(){
+        var self = this;
+        this.button.set('disabled', true);
+        new Request.JSON({
+            url: this.url,
+            method: 'get',
+            noCache: true,
+            onSuccess: function(data){
+                data.images.each(function(image){ self.addRow(image); });
+                self.offset += data.images.length;
+                self.button.set('disabled', false);
+                self.updateStatus();
+            },
+            onFailure: function(){
+                self.button.set('disabled', false);
+            }
+        }).send({data: {offset: this.offset, limit: this.pageSize}});
+    },
+
+    updateStatus: function(){
+        var shown = Math.min(this.offset, this.total);
+        this.status.set('text', shown + ' / ' + this.total);
+        if (shown >= this.total)
+            this.button.hide();
+    },
+
+    renumber: function(row, index){
+        var re = new RegExp('(' + this.prefix + '-)[^-]+-');
+        var replacement = '$1' + index + '-';
+        row.getElements('*').each(function(el){
+            ['name', 'id', 'for'].each(function(attr){
+                var value = el.get(attr);
+                if (value && re.test(value))
+                    el.set(attr, value.replace(re, replacement));
+            });
+        });
+    },
+
+    prepareSubmit: function(){
+        var self = this;
+        var initial = [], extra = [];
+        this.rows().each(function(row){
+            var id = self.field(row, 'id');
+            if (id && id.get('value')) {
+                if (row.hasClass('dirty'))
+                    initial.push(row);
+            }
+            else
+                extra.push(row);
+        });
+
+        // rows that are not submitted are removed from the form
+        this.rows().each(function(row){
+            if (!initial.contains(row) && !extra.contains(row))
+                row.getElements('input, select, textarea').set('disabled', true);
+        });
+        initial.concat(extra).each(function(row, i){ self.renumber(row, i); });
+        this.emptyRow.getElements('input, select, textarea').set('disabled', true);
+
+        this.form.getElement('[name=' + this.prefix + '-TOTAL_FORMS]').
+                set('value', initial.length + extra.length);
+        this.form.getElement('[name=' + this.prefix + '-INITIAL_FORMS]').
+                set('value', initial.length);
+    }
+});
+
+window.addEvent('domready', function(){
+    var table = $('attached-images-table');
+    if (table && table.get('data-images-url'))
+        new PaginatedImagesInline(table);
+});
+
+})(document.id); // end $-safe plugin
@@ -0,0 +1,90 @@
+#coding: utf-8
+'''
+Helpers for extracting image metadata (dimensions, byte size, format,
+a tiny placeholder preview and perceptual hash) from image content. The values are meant to
+be computed once when the image is uploaded and stored in the database so
+that templates don't have to open image files from storage.
+'''
+import base64
+import hashlib
+from cStringIO import StringIO
+
+from PIL import Image
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+from generic_images.phash import dhash, hash_fields
+
+PLACEHOLDER_SIZE = getattr(settings, 'GENERIC_IMAGES_PLACEHOLDER_SIZE', 16)
+''' Max width and height of placeholder preview (in pixels). '''
+
+PLACEHOLDER_QUALITY = getattr(settings, 'GENERIC_IMAGES_PLACEHOLDER_QUALITY', 40)
+''' JPEG quality of placeholder preview. '''
+
+METADATA_FIELDS = ['width', 'height', 'file_size', 'file_format',
+                   'placeholder', 'phash', 'phash_0', 'phash_1', 'phash_2',
+                   'phash_3']
+''' Names of model fields filled by :func:`read_image_metadata`. '''
+
+
+def make_placeholder(image, size=PLACEHOLDER_SIZE, quality=PLACEHOLDER_QUALITY):
+    ''' Returns 'data:' URI with tiny JPEG preview of PIL ``image``.
+        The result is usually less than 1Kb and can be used as
+        low-quality image placeholder (``<img src="{{ image.placeholder }}">``)
+        while the real image is being loaded.
+    '''
+    preview = image.copy()
+    if preview.mode not in ('L', 'RGB'):
+        preview = preview.convert('RGB')
+    preview.thumbnail((size, size), Image.ANTIALIAS)
+    buf = StringIO()
+    preview.save(buf, 'JPEG', quality=quality)
+    return 'data:image/jpeg;base64,%s' % base64.b64encode(buf.getvalue())
+
+
+def read_image_metadata(content):
+    ''' Returns dict with :data:`METADATA_FIELDS` keys for image ``content``
+        (django File instance). ``content`` is rewinded before and after
+        reading.
+    '''
+    content.seek(0)
+    image = Image.open(content)
+    width, height = image.size
+    file_format = (image.format or '').lower()
+
+    # ask JPEG decoder to downscale while decoding: the placeholder is tiny
+    image.draft('RGB', (PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    metadata = {
+        'width': width,
+        'height': height,
+        'file_size': content.size,
+        'file_format': file_format,
+        'placeholder': make_placeholder(image),
+    }
+    metadata.update(hash_fields(dhash(image)))
+    content.seek(0)
+    return metadata
+
+
+def content_digest(content):
+    ''' Returns hex SHA-256 digest of ``content`` (django File instance).
+        The content is read chunk by chunk so big uploads that are stored in
+        temporary files are not loaded into memory.
+    '''
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+def fetch_image_content(field_file):
+    ''' Reads the whole file from storage in one request and returns it as
+        ContentFile. This is much faster than letting PIL seek over
+        remote (S3) file.
+    '''
+    field_file.open('rb')
+    try:
+        return ContentFile(field_file.read())
+    finally:
+        field_file.close()
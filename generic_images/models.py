@@ -1,20 +1,127 @@
 #coding: utf-8
-import os, time
+import os
 import random
 
 from django.db import models
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.core.files.storage import default_storage
 from django.db.models import Max
 from django.utils.translation import ugettext_lazy as _
 
 from generic_images.signals import image_saved, image_deleted
-from generic_images.managers import AttachedImageManager
+from generic_images.managers import AttachedImageManager, ImageBlobManager,\
+                                    ImagesVersionManager, StorageUsageManager,\
+                                    bump_images_version, collect_usage
+from generic_images.routers import pin
+from generic_images.layout import upload_path
+from generic_images.metadata import read_image_metadata, fetch_image_content,\
+                                    content_digest, METADATA_FIELDS
+from generic_utils.contenttypes import content_types
 from generic_utils.models import GenericModelBase
+from generic_images.thumbnails import ThumbnailsImageField
+from generic_utils.instrumentation import instrumented, instrument_storage
 from django.conf import settings
-from athumb.fields import ImageWithThumbsField
 from athumb.backends.s3boto import S3BotoStorage_AllPublic
-PUBLIC_MEDIA_BUCKET = S3BotoStorage_AllPublic(settings.AWS_STORAGE_BUCKET_NAME)
+PUBLIC_MEDIA_BUCKET = instrument_storage(
+                S3BotoStorage_AllPublic(settings.AWS_STORAGE_BUCKET_NAME))
+
+DEDUPLICATE_IMAGES = getattr(settings, 'GENERIC_IMAGES_DEDUPLICATE', False)
+
+
+class ImageBlob(models.Model):
+    '''
+        Stored image file that can be shared by several images with the same
+        content. It is used only if ``GENERIC_IMAGES_DEDUPLICATE`` setting
+        is True.
+
+        .. attribute:: digest
+
+            SHA-256 hex digest of file content.
+
+        .. attribute:: name
+
+            File name in storage.
+
+        .. attribute:: ref_count
+
+            Number of images that use the file. The file and its thumbnails
+            are deleted when the last image is deleted or gets another file.
+    '''
+    digest = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255, db_index=True)
+    ref_count = models.PositiveIntegerField(default=0)
+
+    objects = ImageBlobManager()
+
+    def __unicode__(self):
+        return u"%s (%d)" % (self.name, self.ref_count)
+
+
+class ImagesVersion(models.Model):
+    '''
+        Version of the set of images attached to an object. It is
+        incremented when any image of the object is saved, deleted or
+        reordered, so it can be used for HTTP validators (ETag,
+        Last-Modified) and for cache keys without reading the images.
+
+        .. attribute:: version
+
+            Number of changes.
+
+        .. attribute:: updated_at
+
+            Time of the last change.
+    '''
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField()
+
+    objects = ImagesVersionManager()
+
+    class Meta:
+        unique_together = ('content_type', 'object_id')
+
+    def __unicode__(self):
+        return u"%s:%s v%d" % (self.content_type_id, self.object_id,
+                               self.version)
+
+
+class StorageUsage(models.Model):
+    '''
+        Number and total size of stored images attached to an object
+        (``scope`` is 'object') or uploaded by a user (``scope`` is 'user',
+        ``content_type`` is User content type and ``object_id`` is user id).
+        Counters are changed when images are saved and deleted, so quotas
+        can be checked without scanning images. Images changed bypassing
+        model methods (e.g. by queryset ``delete()``) are counted again by
+        ``reconcile_storage_usage`` management command.
+
+        .. attribute:: images
+
+            Number of images.
+
+        .. attribute:: bytes
+
+            Total size of original files and their thumbnails.
+    '''
+    SCOPES = (('object', _('Object')), ('user', _('User')))
+
+    scope = models.CharField(max_length=10, choices=SCOPES)
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    images = models.IntegerField(default=0)
+    bytes = models.BigIntegerField(default=0)
+
+    objects = StorageUsageManager()
+
+    class Meta:
+        unique_together = ('scope', 'content_type', 'object_id')
+
+    def __unicode__(self):
+        return u"%s %s:%s %d bytes" % (self.scope, self.content_type_id,
+                                       self.object_id, self.bytes)
 
 
 class BaseImageModel(models.Model):
@@ -32,7 +139,7 @@ class BaseImageModel(models.Model):
     def _upload_path_wrapper(self, filename):
         return self.get_upload_path(filename)
 
-    image = ImageWithThumbsField(
+    image = ThumbnailsImageField(
         _('Image'),
         thumbnail_format='jpeg',
         upload_to=_upload_path_wrapper,
@@ -99,6 +206,49 @@ class AbstractAttachedImage(ReplaceOldImageModel, GenericModelBase):
             IntegerField to support ordered image sets.
             On creation it is set to max(id)+1.
 
+        .. attribute:: width, height, file_size, file_format, placeholder
+
+            Denormalized image metadata: dimensions in pixels, size of
+            original file in bytes, image format (e.g. 'jpeg') and tiny
+            'data:' URI preview. These fields are filled when the image is
+            uploaded, so templates can render layouts and lazy-loading
+            placeholders without opening image file from storage.
+            They are empty for images uploaded before the fields were added;
+            use ``backfill_image_metadata`` management command to fill them.
+
+        .. attribute:: content_hash
+
+            SHA-256 hex digest of image file. It is set only if
+            ``GENERIC_IMAGES_DEDUPLICATE`` setting is True. In this case
+            uploading a file that is already stored (for example, the same
+            photo attached to several objects) doesn't write it and its
+            thumbnails again: existing file is referenced instead.
+
+        .. attribute:: stored_size
+
+            Size of original file and its thumbnails in bytes. It is counted
+            in :class:`StorageUsage` of the object and the user. It is
+            empty for images uploaded before the field was added, their
+            ``file_size`` is counted instead.
+
+        .. attribute:: thumbnail_formats
+
+            Comma-separated formats (e.g. 'avif,webp') whose variants of
+            thumbnails are stored (see :mod:`generic_images.thumbnails`).
+            Only recorded formats are offered to browsers.
+
+        .. attribute:: updated_at
+
+            Time of the last change. Changes of the object's image set are
+            also tracked by :class:`ImagesVersion`.
+
+        .. attribute:: phash, phash_0, phash_1, phash_2, phash_3
+
+            Perceptual hash of the image (see :mod:`generic_images.phash`)
+            and its indexed 16-bit segments. They are filled on upload
+            (or by ``backfill_image_metadata`` command) and are used by
+            :meth:`~generic_images.managers.AttachedImageManager.near_duplicates`.
+
     '''
 
 
@@ -114,10 +264,41 @@ class AbstractAttachedImage(ReplaceOldImageModel, GenericModelBase):
 
     order = models.IntegerField(_('Order'), default=0)
 
+    width = models.PositiveIntegerField(_('Width'), null=True, blank=True,
+                                        editable=False)
+    height = models.PositiveIntegerField(_('Height'), null=True, blank=True,
+                                         editable=False)
+    file_size = models.PositiveIntegerField(_('File size'), null=True,
+                                            blank=True, editable=False)
+    file_format = models.CharField(_('File format'), max_length=10,
+                                   blank=True, editable=False)
+    placeholder = models.TextField(_('Placeholder'), blank=True,
+                                   editable=False)
+
+    content_hash = models.CharField(_('Content hash'), max_length=64,
+                                    blank=True, db_index=True, editable=False)
+
+    stored_size = models.PositiveIntegerField(_('Stored size'), null=True,
+                                              blank=True, editable=False)
+    thumbnail_formats = models.CharField(_('Thumbnail formats'),
+                                         max_length=50, blank=True,
+                                         editable=False)
+
+    phash = models.BigIntegerField(_('Perceptual hash'), null=True,
+                                   blank=True, editable=False)
+    phash_0 = models.IntegerField(null=True, editable=False, db_index=True)
+    phash_1 = models.IntegerField(null=True, editable=False, db_index=True)
+    phash_2 = models.IntegerField(null=True, editable=False, db_index=True)
+    phash_3 = models.IntegerField(null=True, editable=False, db_index=True)
+
+    updated_at = models.DateTimeField(_('Updated at'), auto_now=True,
+                                      null=True, editable=False)
+
     objects = AttachedImageManager()
     '''Default manager of :class:`~generic_images.managers.AttachedImageManager`
     type.'''
 
+    @instrumented('image.next')
     def next(self):
         ''' Returns next image for same content_object and None if image is
         the last. '''
@@ -128,6 +309,7 @@ class AbstractAttachedImage(ReplaceOldImageModel, GenericModelBase):
         except IndexError:
             return None
 
+    @instrumented('image.previous')
     def previous(self):
         ''' Returns previous image for same content_object and None if image
         is the first. '''
@@ -138,6 +320,7 @@ class AbstractAttachedImage(ReplaceOldImageModel, GenericModelBase):
         except IndexError:
             return None
 
+    @instrumented('image.get_order_in_album')
     def get_order_in_album(self, reversed_ordering=True):
         ''' Returns image order number. It is calculated as (number+1) of images
         attached to the same content_object whose order is greater
@@ -150,6 +333,114 @@ class AbstractAttachedImage(ReplaceOldImageModel, GenericModelBase):
                         filter(**{lookup: self.order}).count() + 1
 
 
+    def fill_metadata(self, content=None):
+        ''' Fills metadata fields (dimensions, size, format, placeholder and
+        perceptual hash) from ``content`` (django File instance). If ``content`` is
+        None then image file is fetched from storage. Instance is not saved.
+        '''
+        if content is None:
+            content = fetch_image_content(self.image)
+        for name, value in read_image_metadata(content).items():
+            setattr(self, name, value)
+
+
+    def _deduplicate_image(self):
+        ''' Makes newly uploaded image reference already stored file with the
+        same content if there is one. Returns True if existing file is reused.
+        '''
+        self.content_hash = content_digest(self.image)
+        name = ImageBlob.objects.acquire(self.content_hash)
+        if name is None:
+            return False
+
+        self.image = name # file and its thumbnails are already stored
+        self._reused_blob = True
+        try:
+            twin = self.__class__.objects.filter(content_hash=self.content_hash).\
+                        exclude(width=None)[0]
+            for field in METADATA_FIELDS + ['stored_size',
+                                            'thumbnail_formats']:
+                setattr(self, field, getattr(twin, field))
+        except IndexError:
+            pass
+        return True
+
+
+    def _ingest_image(self):
+        ''' Prepares newly uploaded image file for saving: makes the image
+        reference already stored file with the same content (if
+        deduplication is enabled) and fills metadata. Returns True if the
+        file should be registered with :meth:`_register_blob` after it is
+        stored.
+        '''
+        register_blob = False
+        if self.image and not self.image._committed:
+            if DEDUPLICATE_IMAGES:
+                register_blob = not self._deduplicate_image()
+            if not self.image._committed:
+                # new file is uploaded and its content is still at hand
+                self.fill_metadata(self.image)
+        return register_blob
+
+
+    def _store_image(self):
+        ''' Stores newly uploaded image file and its thumbnails (it is
+        done by ``pre_save`` of the field otherwise) and fills
+        ``stored_size`` and ``thumbnail_formats``.
+        '''
+        field_file = self.image
+        if not field_file or field_file._committed:
+            return
+        # save() assigns the name to the field, self.image is a new object
+        field_file.save(field_file.name, field_file, save=False)
+        if field_file.thumbnails_size is not None:
+            self.stored_size = (self.file_size or 0) + \
+                               field_file.thumbnails_size
+            self.thumbnail_formats = field_file.field.rendered_formats()
+
+
+    def _usage_row(self):
+        return (self.content_type_id, self.object_id, self.user_id,
+                self.stored_size or self.file_size)
+
+
+    def _register_blob(self):
+        ''' Registers just stored image file for sharing. If the same
+        content was stored by a concurrent upload, images that use the file
+        are switched to that file and the file is deleted. Returns the name
+        of the file that is used.
+        '''
+        own = self.image
+        name = ImageBlob.objects.register(self.content_hash, own.name)
+        if name != own.name:
+            self.__class__.objects.filter(image=own.name).update(image=name)
+            own.delete(save=False)
+            self.image = name
+        return name
+
+
+    def _release_image(self):
+        ''' Drops a reference to image file. The file and its thumbnails are
+        deleted if no other image uses it.
+        '''
+        if self.image and ImageBlob.objects.release(self.image.name):
+            self.image.delete(save=False)
+
+
+    def _replace_old_image(self):
+        if not DEDUPLICATE_IMAGES:
+            return super(AbstractAttachedImage, self)._replace_old_image()
+        try:
+            old_obj = self.__class__.objects.get(pk=self.pk)
+        except self.__class__.DoesNotExist:
+            return
+        if old_obj.image.name != self.image.name:
+            old_obj._release_image()
+        elif getattr(self, '_reused_blob', False):
+            # the same content is re-uploaded: don't count the reference twice
+            ImageBlob.objects.release(self.image.name)
+
+
     def _get_next_pk(self):
         max_pk = self.__class__.objects.aggregate(m=Max('pk'))['m'] or 0
         return max_pk+1
@@ -182,23 +473,25 @@ class AbstractAttachedImage(ReplaceOldImageModel, GenericModelBase):
     def get_upload_path(self, filename):
         ''' Override this in proxy subclass to customize upload path.
             Default upload path is
-            :file:`/media/images/<user.id>/<filename>.<ext>`
-            or :file:`/media/images/common/<filename>.<ext>` if user is not set.
+            :file:`/media/new_images/YYYY/MM/DD/<filename>.<ext>`
+            or :file:`/media/img/<shard>/<shard>/<filename>.<ext>` if
+            ``GENERIC_IMAGES_UPLOAD_LAYOUT`` is 'sharded' (see
+            :mod:`generic_images.layout`).
 
             ``<filename>`` is returned by
             :meth:`~generic_images.models.AbstractAttachedImage.get_file_name`
-            method. By default it is probable id of new image (it is
-            predicted as it is unknown at this stage).
+            method. By default it is a random string.
         '''
-        
-        user_folder = time.strftime('%Y/%m/%d')
         root, ext = os.path.splitext(filename)
-        return os.path.join('media', 'new_images', user_folder,
-                            self.get_file_name(filename) + ext)
+        return upload_path(self.get_file_name(filename), ext)
 
 
+    @instrumented('image.save')
     def save(self, *args, **kwargs):
         send_signal = getattr(self, 'send_signal', True)
+        # reads below and reads of the object's images that follow
+        # must not go to replicas
+        pin(self.content_type_id, self.object_id)
         if self.is_main:
             related_images = self.__class__.objects.filter(
                                                 content_type=self.content_type,
@@ -210,34 +503,58 @@ class AbstractAttachedImage(ReplaceOldImageModel, GenericModelBase):
             if not self.order: # order is not set
                 self.order = self._get_next_pk() # let it be max(pk)+1
 
+        register_blob = self._ingest_image()
+        self._store_image()
+
+        old_usage = []
+        if self.pk:
+            old_usage = self.__class__.objects.filter(pk=self.pk).\
+                    values_list('content_type', 'object_id', 'user',
+                                'stored_size', 'file_size')
+            old_usage = [row[:3] + (row[3] or row[4],) for row in old_usage]
         super(AbstractAttachedImage, self).save(*args, **kwargs)
+        self._reused_blob = False
+        # a plain edit (e.g. of caption) changes nothing here
+        StorageUsage.objects.add(collect_usage([self._usage_row()], 1,
+                                     collect_usage(old_usage, -1)))
+
+        if register_blob:
+            self._register_blob()
+        bump_images_version(self.content_type_id, self.object_id)
 
         if send_signal:
-            image_saved.send(sender = self.content_type.model_class(),
+            image_saved.send(sender = content_types.model_for_id(
+                                                    self.content_type_id),
                              instance = self)
 
 
+    @instrumented('image.delete')
     def delete(self, *args, **kwargs):
         send_signal = getattr(self, 'send_signal', True)
+        pin(self.content_type_id, self.object_id)
         super(AbstractAttachedImage, self).delete(*args, **kwargs)
+        StorageUsage.objects.add(collect_usage([self._usage_row()], -1))
+        if DEDUPLICATE_IMAGES:
+            self._release_image()
+        bump_images_version(self.content_type_id, self.object_id)
         if send_signal:
-            image_deleted.send(sender = self.content_type.model_class(),
+            image_deleted.send(sender = content_types.model_for_id(
+                                                    self.content_type_id),
                                instance = self)
 
 
     def __unicode__(self):
+        if self.pk is None:
+            return u"new AttachedImage"
         try:
-            if self.user:
+            if self.user_id:
                 return u"AttachedImage #%d for [%s] by [%s]" % (
                          self.pk, self.content_object, self.user)
             else:
                 return u"AttachedImage #%d for [%s]" % (
                         self.pk, self.content_object,)
-        except:
-            try:
-                return u"AttachedImage #%d" % (self.pk)
-            except TypeError:
-                return u"new AttachedImage"
+        except models.ObjectDoesNotExist:
+            return u"AttachedImage #%d" % (self.pk)
 
     class Meta:
         abstract=True
@@ -0,0 +1,205 @@
+#coding: utf-8
+'''
+Finding files in image storage that are not referenced by any image.
+
+Image files are stored under ``media/new_images/YYYY/MM/DD/`` or under
+``media/img/<shard>/<shard>/`` (see :mod:`generic_images.layout`) and each
+of them has thumbnails named ``<name>_<thumb>.<format>`` next to it.
+Files become orphans when images are deleted or get new files.
+
+Storage is listed one day (or shard) prefix at a time. S3 listing is
+streamed page by page, other storages are walked with ``listdir``. Listed
+keys are checked in batches: 1 query per batch (and model) fetches
+referenced names, so memory use doesn't depend on the number of files or
+images.
+'''
+import calendar
+import os
+import re
+import time
+
+from generic_images.layout import DATE_ROOT as DEFAULT_ROOT
+
+ORIGINAL_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.JPG', '.JPEG',
+                       '.PNG', '.GIF']
+''' Extensions tried for thumbnails whose original file is not listed. '''
+
+
+def _s3_bucket(storage):
+    return getattr(storage, 'bucket', None)
+
+
+def _s3_timestamp(value):
+    # boto returns ISO 8601 UTC string, e.g. '2010-10-19T11:25:50.000Z'
+    return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+def list_dirs(storage, path):
+    ''' Returns sorted names of subdirectories of ``path``. '''
+    path = path.rstrip('/') + '/'
+    bucket = _s3_bucket(storage)
+    if bucket is not None:
+        return sorted(prefix.name[len(path):].rstrip('/') for prefix
+                      in bucket.list(prefix=path, delimiter='/')
+                      if prefix.name.endswith('/'))
+    try:
+        return sorted(storage.listdir(path)[0])
+    except OSError:
+        return []
+
+
+def iter_files(storage, prefix):
+    ''' Yields (name, modification timestamp or None) for files under
+        ``prefix`` in lexicographic order without loading the whole
+        listing. '''
+    prefix = prefix.rstrip('/') + '/'
+    bucket = _s3_bucket(storage)
+    if bucket is not None:
+        # boto fetches 1000 keys per request while iterating
+        for key in bucket.list(prefix=prefix):
+            yield key.name, _s3_timestamp(key.last_modified)
+        return
+
+    try:
+        dirs, files = storage.listdir(prefix)
+    except OSError:
+        return
+    entries = [(name, False) for name in files] + [(name, True) for name in dirs]
+    for name, is_dir in sorted(entries):
+        path = prefix + name
+        if is_dir:
+            for item in iter_files(storage, path):
+                yield item
+            continue
+        try:
+            mtime = time.mktime(storage.modified_time(path).timetuple())
+        except (NotImplementedError, OSError):
+            mtime = None
+        yield path, mtime
+
+
+def iter_prefixes(storage, root, depth, start=None):
+    ''' Yields existing ``root/a/b/...`` prefixes ``depth`` levels deep in
+        order. Prefixes before ``start`` (e.g. 'YYYY/MM/DD') are skipped. '''
+    start_parts = start.split('/') if start else []
+
+    def walk(path, parts, ahead):
+        # ``ahead`` is False if the prefix is already known to be after start
+        for name in list_dirs(storage, path):
+            level = len(parts)
+            if ahead and level < len(start_parts):
+                if name < start_parts[level]:
+                    continue
+                next_ahead = name == start_parts[level]
+            else:
+                next_ahead = False
+            if level + 1 == depth:
+                yield '/'.join([root] + parts + [name])
+            else:
+                for prefix in walk('%s/%s' % (path, name), parts + [name],
+                                   next_ahead):
+                    yield prefix
+
+    return walk(root, [], bool(start_parts))
+
+
+def iter_day_prefixes(storage, root=DEFAULT_ROOT, start=None):
+    ''' Yields existing ``root/YYYY/MM/DD`` prefixes in order. Prefixes
+        before ``start`` (string 'YYYY/MM/DD') are skipped. '''
+    return iter_prefixes(storage, root, 3, start)
+
+
+class OrphanFinder(object):
+    ''' Finds unreferenced files. A file is referenced if it is an image
+        file of any of ``models`` or a thumbnail of such file. '''
+
+    def __init__(self, models, storage, batch_size=500, grace_seconds=86400,
+                 field_name='image'):
+        self.models = models
+        self.storage = storage
+        self.batch_size = batch_size
+        self.grace_seconds = grace_seconds
+        self.field_name = field_name
+        field = models[0]._meta.get_field(field_name)
+        # thumbnails are '<name without extension>_<thumb>.<format>',
+        # variants in other formats are named the same way
+        fmt = field.thumbnail_format
+        extensions = r'[^./]+'
+        if fmt:
+            extensions = '|'.join(re.escape(ext) for ext in
+                                  [fmt.lower()] + field.variant_extensions())
+        self.thumb_re = re.compile(r'^(.+)_(%s)\.(?:%s)$' % (
+            '|'.join(re.escape(thumb_name) for thumb_name, options
+                     in field.thumbs), extensions))
+
+    def split_thumbnail(self, name):
+        ''' Returns original name without extension if ``name`` looks like
+            a thumbnail and None otherwise. '''
+        match = self.thumb_re.match(name)
+        return match.group(1) if match else None
+
+    def _referenced(self, names):
+        referenced = set()
+        names = list(names)
+        for model in self.models:
+            for start in range(0, len(names), self.batch_size):
+                lookup = {'%s__in' % self.field_name:
+                                        names[start:start+self.batch_size]}
+                referenced.update(model._default_manager.filter(**lookup).
+                                  values_list(self.field_name, flat=True))
+        return referenced
+
+    def check_batch(self, keys, known_bases):
+        ''' Returns list of orphans among ``keys`` (list of (name, mtime)).
+            ``known_bases`` is a dict {base name: referenced} of originals
+            seen before, it is updated. '''
+        originals, thumbs = [], []
+        for name, mtime in keys:
+            base = self.split_thumbnail(name)
+            if base is None:
+                originals.append(name)
+            else:
+                thumbs.append((name, base))
+
+        candidates = set(originals)
+        original_bases = set(os.path.splitext(name)[0] for name in originals)
+        for name, base in thumbs:
+            if base not in known_bases and base not in original_bases:
+                # original file is missing from storage or wasn't listed
+                candidates.update(base + ext for ext in ORIGINAL_EXTENSIONS)
+        referenced = self._referenced(candidates)
+
+        for name in originals:
+            known_bases[os.path.splitext(name)[0]] = name in referenced
+        for name in referenced:
+            known_bases[os.path.splitext(name)[0]] = True
+
+        orphans = []
+        deadline = time.time() - self.grace_seconds
+        for name, mtime in keys:
+            if mtime is None or mtime > deadline:
+                continue # recent (upload can be in progress) or unknown age
+            base = self.split_thumbnail(name)
+            if base is None:
+                if name not in referenced:
+                    orphans.append(name)
+            elif not known_bases.get(base):
+                orphans.append(name)
+        return orphans
+
+    def find(self, prefix):
+        ''' Yields (batch of listed keys, orphans in this batch) for files
+            under ``prefix``. '''
+        known_bases = {}
+        batch = []
+        for item in iter_files(self.storage, prefix):
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                yield batch, self.check_batch(batch, known_bases)
+                batch = []
+                # thumbnails are listed right after their originals, only
+                # the latest originals are needed for the next batch
+                if len(known_bases) > self.batch_size:
+                    known_bases.clear()
+        if batch:
+            yield batch, self.check_batch(batch, known_bases)
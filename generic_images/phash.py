@@ -0,0 +1,125 @@
+#coding: utf-8
+'''
+Perceptual hashing for near-duplicate image detection.
+
+Each image gets 64-bit difference hash (dHash). Resized or recompressed
+copies of the same photo have hashes that differ in a few bits only, so
+near-duplicates are images whose hashes are within small Hamming distance.
+
+Hashes are indexed using multi-index hashing: the hash is split into
+4 16-bit segments that are stored (and indexed) separately. If two hashes
+are within distance ``d`` then at least one of their segments is within
+distance ``d // 4`` (pigeonhole principle). So candidates can be found with
+exact indexed lookups of a few segment variants instead of comparing
+against every stored hash.
+'''
+import itertools
+
+from PIL import Image
+
+HASH_BITS = 64
+SEGMENTS = 4
+SEGMENT_BITS = HASH_BITS // SEGMENTS
+SEGMENT_MASK = (1 << SEGMENT_BITS) - 1
+
+
+def dhash(image):
+    ''' Returns 64-bit difference hash (unsigned int) of PIL ``image``. '''
+    small = image.convert('L').resize((9, 8), Image.ANTIALIAS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in xrange(8):
+        for col in xrange(8):
+            left = pixels[row*9 + col]
+            right = pixels[row*9 + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming_distance(hash1, hash2):
+    ''' Returns number of different bits in 2 unsigned hashes. '''
+    return bin(hash1 ^ hash2).count('1')
+
+
+def to_signed(value):
+    ''' Converts unsigned 64-bit hash to signed value suitable for
+        BIGINT database column. '''
+    if value >= 1 << (HASH_BITS - 1):
+        value -= 1 << HASH_BITS
+    return value
+
+
+def to_unsigned(value):
+    ''' Reverse for :func:`to_signed`. '''
+    if value < 0:
+        value += 1 << HASH_BITS
+    return value
+
+
+def split_hash(value):
+    ''' Returns list of 16-bit segments of unsigned hash. '''
+    return [(value >> (i*SEGMENT_BITS)) & SEGMENT_MASK
+            for i in range(SEGMENTS)]
+
+
+def hash_fields(value):
+    ''' Returns dict with ``phash`` and ``phash_<N>`` model field values
+        for unsigned hash. '''
+    fields = {'phash': to_signed(value)}
+    for i, segment in enumerate(split_hash(value)):
+        fields['phash_%d' % i] = segment
+    return fields
+
+
+def segment_variants(segment, radius):
+    ''' Returns list of all 16-bit values within ``radius`` bits
+        from ``segment``. '''
+    variants = [segment]
+    for r in range(1, radius+1):
+        for bits in itertools.combinations(range(SEGMENT_BITS), r):
+            mask = 0
+            for bit in bits:
+                mask |= 1 << bit
+            variants.append(segment ^ mask)
+    return variants
+
+
+def candidate_segments(value, max_distance):
+    ''' Returns list of ``SEGMENTS`` lists. N-th list contains values that
+        N-th segment of a hash must have for the hash to possibly be within
+        ``max_distance`` from ``value``. Hash is a candidate if any of its
+        segments matches. '''
+    radius = max_distance // SEGMENTS
+    return [segment_variants(segment, radius) for segment in split_hash(value)]
+
+
+class HammingIndex(object):
+    ''' In-memory multi-index for unsigned hashes. It uses the same
+        segment lookups as :meth:`AttachedImageManager.near_duplicates`
+        and is useful when many lookups are performed against a fixed
+        set of hashes (and for benchmarking). '''
+
+    def __init__(self):
+        self.tables = [{} for i in range(SEGMENTS)]
+
+    def add(self, value, key):
+        for table, segment in zip(self.tables, split_hash(value)):
+            table.setdefault(segment, []).append((value, key))
+
+    def search(self, value, max_distance):
+        ''' Returns list of (distance, key) tuples for hashes within
+            ``max_distance`` from ``value`` sorted by distance. '''
+        seen = set()
+        results = []
+        for table, variants in zip(self.tables,
+                                   candidate_segments(value, max_distance)):
+            for variant in variants:
+                for candidate, key in table.get(variant, ()):
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    distance = hamming_distance(value, candidate)
+                    if distance <= max_distance:
+                        results.append((distance, key))
+        results.sort()
+        return results
@@ -0,0 +1,202 @@
+#coding: utf-8
+'''
+Database router that sends attached image reads to read replicas.
+
+Replica lag must not hide just uploaded images from the user who uploaded
+them, so after images of an object are written (saved, deleted, created
+in bulk or reordered) reads of images of this object are "pinned" to the
+primary database for ``GENERIC_IMAGES_PIN_SECONDS`` seconds (default 10).
+:class:`~generic_images.managers.AttachedImageManager` methods
+(``for_model``, ``get_main_for``, navigation) choose the database for the
+object they read. Other reads of images (e.g. ``inject_to`` for a list of
+objects) go to the primary while any object is pinned.
+
+Pins are kept per thread until they expire, they are not dropped at the
+end of request by themselves: without :class:`ReadYourWritesMiddleware` a
+pin also applies to following requests (of any user) served by the same
+thread and doesn't apply to requests served by other threads and
+processes. The middleware makes pins follow the user instead: pins of the
+request are restored from the session when it starts and are moved to the
+session (and cleared in the thread) when it ends, so they survive the
+redirect after upload and following requests served by other processes.
+Setup::
+
+    DATABASES = {
+        'default': {...},
+        'replica1': {...},
+        'replica2': {...},
+    }
+    DATABASE_ROUTERS = ['generic_images.routers.ImageReplicaRouter']
+    GENERIC_IMAGES_READ_REPLICAS = ['replica1', 'replica2']
+
+    MIDDLEWARE_CLASSES = (
+        ...
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'generic_images.routers.ReadYourWritesMiddleware',
+        ...
+    )
+'''
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from generic_utils.concurrency import register_thread_state
+
+SESSION_KEY = '_generic_images_pins'
+MAX_PINS = 1000
+
+_local = threading.local()
+
+
+def pin_seconds():
+    return getattr(settings, 'GENERIC_IMAGES_PIN_SECONDS', 10)
+
+
+def _pins():
+    try:
+        return _local.pins
+    except AttributeError:
+        _local.pins = {}
+        return _local.pins
+
+
+def _key(content_type_id, object_id):
+    return '%s:%s' % (content_type_id, object_id)
+
+
+def pin(content_type_id, object_id, seconds=None):
+    ''' Pins reads of images attached to the object to the primary
+        database. '''
+    if seconds is None:
+        seconds = pin_seconds()
+    pins = _pins()
+    if len(pins) > MAX_PINS:
+        set_pins(get_pins()) # drop expired pins (e.g. in long-running commands)
+        pins = _pins()
+    pins[_key(content_type_id, object_id)] = time.time() + seconds
+
+
+def is_pinned(content_type_id, object_id):
+    expires = _pins().get(_key(content_type_id, object_id))
+    return expires is not None and expires > time.time()
+
+
+def any_pinned():
+    now = time.time()
+    return any(expires > now for expires in _pins().values())
+
+
+def get_pins():
+    ''' Returns dict of active pins (it can be stored in session). '''
+    now = time.time()
+    return dict((key, expires) for key, expires in _pins().items()
+                if expires > now)
+
+
+def set_pins(pins):
+    _local.pins = dict(pins or {})
+
+
+def clear_pins():
+    _local.pins = {}
+
+# background tasks read with pins of the thread that submitted them
+register_thread_state(get_pins, set_pins)
+
+
+def replica_router():
+    ''' Returns configured :class:`ImageReplicaRouter` or None. '''
+    from django.db import router
+    for r in router.routers:
+        if isinstance(r, ImageReplicaRouter):
+            return r
+    return None
+
+
+def read_db_for_object(content_type_id, object_id):
+    ''' Returns database alias for reading images of the object or None if
+        replica routing is not configured. '''
+    r = replica_router()
+    if r is None:
+        return None
+    if is_pinned(content_type_id, object_id):
+        return r.primary
+    return r.replica()
+
+
+def _is_image_model(model):
+    from generic_images.models import AbstractAttachedImage
+    return issubclass(model, AbstractAttachedImage)
+
+
+class ImageReplicaRouter(object):
+    ''' Routes reads of attached images (models derived from
+        :class:`~generic_images.models.AbstractAttachedImage`) to
+        replicas listed in ``GENERIC_IMAGES_READ_REPLICAS`` setting unless
+        they are pinned to the primary. Other models are not routed. '''
+
+    def __init__(self, replicas=None, primary=None):
+        if replicas is None:
+            replicas = getattr(settings, 'GENERIC_IMAGES_READ_REPLICAS', [])
+        self.replicas = list(replicas)
+        self.primary = primary or DEFAULT_DB_ALIAS
+
+    def replica(self):
+        if not self.replicas:
+            return self.primary
+        return random.choice(self.replicas)
+
+    def db_for_read(self, model, **hints):
+        if not _is_image_model(model):
+            return None
+        instance = hints.get('instance')
+        if isinstance(instance, model):
+            if is_pinned(instance.content_type_id, instance.object_id):
+                return self.primary
+            return self.replica()
+        if any_pinned():
+            return self.primary
+        return self.replica()
+
+    def db_for_write(self, model, **hints):
+        if _is_image_model(model):
+            return self.primary
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas have the same data as the primary
+        databases = set([self.primary] + self.replicas)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        return None
+
+
+class ReadYourWritesMiddleware(object):
+    ''' Keeps image pins of the request in the session (if sessions are
+        enabled) so reads stay pinned in the following requests of the same
+        user. Pins of the thread are replaced with the session ones when
+        request starts and are cleared when it ends, so they don't leak to
+        requests of other users; without sessions pins last until the end
+        of request. '''
+
+    def process_request(self, request):
+        session = getattr(request, 'session', None)
+        set_pins(session.get(SESSION_KEY) if session is not None else None)
+
+    def process_response(self, request, response):
+        session = getattr(request, 'session', None)
+        pins = get_pins()
+        if session is not None:
+            if pins:
+                if session.get(SESSION_KEY) != pins:
+                    session[SESSION_KEY] = pins
+            elif SESSION_KEY in session:
+                del session[SESSION_KEY]
+        clear_pins()
+        return response
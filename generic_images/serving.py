@@ -0,0 +1,220 @@
+#coding: utf-8
+'''
+Serving of image files and thumbnails stored in local storage
+(``FileSystemStorage``), e.g. on-premises installations and CI.
+
+Files are served by ``generic_images_serve`` view (see
+``generic_images.urls``). URL of the file contains its key: a digest of the
+file name (and of thumbnail options for thumbnails). New file gets a new
+random name, so the content behind the URL never changes and responses
+are cached forever (``Cache-Control: immutable``). Request for an outdated
+key is redirected to the current URL.
+
+The view reads one column of one row by primary key and then hands the
+file off to the web server or sends it itself, depending on
+``GENERIC_IMAGES_SERVE_BACKEND`` setting:
+
+* ``'nginx'`` - ``X-Accel-Redirect`` to ``GENERIC_IMAGES_SERVE_ACCEL_PREFIX``
+  + file name (default prefix is ``/protected-media/``); nginx location
+  must be ``internal`` and ``alias`` the storage root::
+
+    location /protected-media/ {
+        internal;
+        alias /var/www/media/;
+    }
+
+* ``'xsendfile'`` - ``X-Sendfile`` with the absolute path (Apache
+  mod_xsendfile, lighttpd);
+
+* ``'python'`` (default) - the file is streamed by the view in 64Kb chunks
+  with support of single range requests (``Range: bytes=...``).
+
+If a thumbnail has stored variants in other formats (see
+:mod:`generic_images.thumbnails`) the most compact one listed in the
+``Accept`` header is sent, so plain ``<img>`` tags get WebP/AVIF too.
+
+Files in other storages (e.g. S3) are redirected to their storage URLs.
+'''
+import hashlib
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, HttpResponseNotModified, \
+                        HttpResponseRedirect, Http404
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag, urlquote
+
+from generic_images.thumbnails import VARIANT_FORMATS, best_format
+
+CHUNK_SIZE = 64 * 1024
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def serve_backend():
+    return getattr(settings, 'GENERIC_IMAGES_SERVE_BACKEND', 'python')
+
+
+def accel_prefix():
+    return getattr(settings, 'GENERIC_IMAGES_SERVE_ACCEL_PREFIX',
+                   '/protected-media/')
+
+
+def file_key(field, name, thumb=None):
+    ''' Returns the key of file ``name`` (or of its ``thumb`` thumbnail)
+        used in URLs and ETags. Thumbnail key changes with its options. '''
+    data = name.encode('utf-8')
+    if thumb is not None:
+        data += '|' + field.thumbs_signature()[thumb]
+    return hashlib.md5(data).hexdigest()[:12]
+
+
+def _url(pk, key, thumb):
+    kwargs = {'pk': pk, 'key': key}
+    if thumb is not None:
+        kwargs['thumb'] = thumb
+    return reverse('generic_images_serve', kwargs=kwargs)
+
+
+def serve_url(image, thumb=None):
+    ''' Returns URL of ``image`` file (or of its ``thumb`` thumbnail) served
+        by ``generic_images_serve`` view. '''
+    return _url(image.pk, file_key(image.image.field, image.image.name, thumb),
+                thumb)
+
+
+def _local_path(storage, name):
+    try:
+        return storage.path(name)
+    except NotImplementedError:
+        return None
+
+
+def _parse_range(header, size):
+    ''' Returns (first, last) byte positions of single range request, None
+        if the whole file should be sent (no range, several ranges or
+        malformed header) or False if the range is not satisfiable. '''
+    match = RANGE_RE.match(header or '')
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first: # the last N bytes
+        suffix = int(last)
+        if not suffix:
+            return False
+        return max(0, size - suffix), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size or first > last:
+        return False
+    return first, last
+
+
+def _iter_file(path, first, length):
+    f = open(path, 'rb')
+    try:
+        f.seek(first)
+        while length > 0:
+            data = f.read(min(CHUNK_SIZE, length))
+            if not data:
+                return
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def file_response(request, storage, name, key, content_type=None):
+    ''' Returns response that sends file ``name`` of local ``storage`` with
+        ETag ``key`` (see module docs for backends). '''
+    path = _local_path(storage, name)
+    if path is None:
+        return HttpResponseRedirect(storage.url(name))
+    etag = quote_etag(key)
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and key in parse_etags(if_none_match):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        response['Cache-Control'] = CACHE_CONTROL
+        return response
+
+    content_type = content_type or mimetypes.guess_type(name)[0] or \
+                   'application/octet-stream'
+    backend = serve_backend()
+    if backend == 'nginx':
+        # nginx sends the file (and handles ranges) itself
+        response = HttpResponse(mimetype=content_type)
+        response['X-Accel-Redirect'] = urlquote(accel_prefix() + name)
+    elif backend == 'xsendfile':
+        response = HttpResponse(mimetype=content_type)
+        response['X-Sendfile'] = path.encode('utf-8')
+    else:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            raise Http404
+        first, length, status = 0, size, 200
+        byte_range = _parse_range(request.META.get('HTTP_RANGE'), size)
+        if request.META.get('HTTP_IF_RANGE', etag) != etag:
+            byte_range = None # the client has another version
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+            return response
+        if byte_range is not None:
+            first, last = byte_range
+            length, status = last - first + 1, 206
+        response = HttpResponse(_iter_file(path, first, length),
+                                mimetype=content_type, status=status)
+        response['Content-Length'] = str(length)
+        response['Accept-Ranges'] = 'bytes'
+        if status == 206:
+            response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+    response['ETag'] = etag
+    response['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+def serve_image(request, model, pk, key, thumb=None):
+    ''' Serves file of image ``pk`` of ``model`` or its ``thumb`` thumbnail
+        (see :func:`file_response`). '''
+    field = model._meta.get_field('image')
+    if thumb is not None and thumb not in dict(field.thumbs):
+        raise Http404
+    has_formats = 'thumbnail_formats' in model._meta.get_all_field_names()
+    columns = ['image', 'thumbnail_formats'] if has_formats else ['image']
+    try:
+        row = model.objects.filter(pk=pk).values_list(*columns)[0]
+    except IndexError:
+        raise Http404
+    name = row[0]
+    if not name:
+        raise Http404
+    current_key = file_key(field, name, thumb)
+    if key != current_key:
+        # the image got another file
+        return HttpResponseRedirect(_url(pk, current_key, thumb))
+    if thumb is None:
+        return file_response(request, field.storage, name, key)
+    instance = model(image=name)
+    if has_formats:
+        instance.thumbnail_formats = row[1]
+    field_file = instance.image
+    formats = field_file.stored_formats(thumb)
+    fmt = best_format(request.META.get('HTTP_ACCEPT'), formats)
+    if fmt is None:
+        response = file_response(request, field.storage,
+                                 field_file._calc_thumb_filename(thumb), key)
+    else:
+        response = file_response(request, field.storage,
+                                 field_file._calc_variant_filename(thumb, fmt),
+                                 '%s-%s' % (key, fmt), VARIANT_FORMATS[fmt][1])
+    if formats:
+        patch_vary_headers(response, ['Accept'])
+    return response
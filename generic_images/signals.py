@@ -1,4 +1,5 @@
 import django.dispatch
 
 image_saved = django.dispatch.Signal(providing_args=["instance"])
-image_deleted = django.dispatch.Signal(providing_args=["instance"])
\ No newline at end of file
+image_deleted = django.dispatch.Signal(providing_args=["instance"])
+images_reordered = django.dispatch.Signal(providing_args=["instance", "orders"])
@@ -0,0 +1,192 @@
+#coding: utf-8
+'''
+Image sitemaps (sitemaps with ``<image:image>`` elements) for any number
+of images.
+
+:class:`ImageSitemap` reads images in keyset chunks as tuples of a few
+columns (model instances are not created), fetches objects images are
+attached to with one query per content type per chunk and computes image
+URLs from file names without storage or cache requests. Sitemap files are
+written as entries are produced and are split every 50000 entries (or 50Mb),
+so memory use doesn't depend on the number of images::
+
+    sitemap = ImageSitemap(AttachedImage.objects.all(),
+                           base_url='http://example.com', thumb='480x1500')
+    sitemap.write('/var/www/sitemaps')  # sitemap-images.xml is the index
+
+Images of one object that are in the same chunk are listed in one
+``<url>`` entry whose location is the object's page
+(``get_absolute_url()`` by default, objects without pages are skipped).
+'''
+import gzip
+import os
+from xml.sax.saxutils import escape
+
+from generic_images.models import AttachedImage
+from generic_utils.contenttypes import content_types
+from generic_utils.querysets import keyset_chunks
+
+MAX_ENTRIES = 50000
+MAX_FILE_SIZE = 50 * 1024 * 1024
+MAX_IMAGES_PER_ENTRY = 1000
+
+URLSET_START = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" '
+                'xmlns:image="http://www.google.com/schemas/sitemap-image/1.1">\n')
+URLSET_END = '</urlset>\n'
+
+
+class ImageSitemap(object):
+    ''' Builds image sitemap of images from ``queryset`` (of
+        AttachedImage or another image model). Image URLs are URLs of
+        ``thumb`` thumbnails (originals by default). Relative URLs are
+        prefixed with ``base_url``. Override :meth:`page_url` and
+        :meth:`get_target_queryset` to customize pages. '''
+
+    def __init__(self, queryset=None, base_url='', thumb=None,
+                 chunk_size=2000, max_entries=MAX_ENTRIES,
+                 max_file_size=MAX_FILE_SIZE):
+        if queryset is None:
+            queryset = AttachedImage.objects.all()
+        self.queryset = queryset.exclude(image='')
+        self.model = self.queryset.model
+        self.base_url = base_url.rstrip('/')
+        self.thumb = thumb
+        self.chunk_size = chunk_size
+        self.max_entries = max_entries
+        self.max_file_size = max_file_size
+
+    def get_target_queryset(self, model):
+        ''' Returns queryset objects of ``model`` are fetched from. '''
+        return model._default_manager.all()
+
+    def page_url(self, target):
+        ''' Returns URL of the page of ``target`` object or None if the
+            object shouldn't be listed. '''
+        get_absolute_url = getattr(target, 'get_absolute_url', None)
+        return get_absolute_url() if get_absolute_url else None
+
+    def image_url(self, name):
+        field_file = self.model(image=name).image
+        if self.thumb is None:
+            return field_file.url
+        # computed from the original URL, cached URLs aren't looked up
+        return field_file.generate_url(self.thumb, check_cache=False)
+
+    def _absolute(self, url):
+        if not url or '://' in url or url.startswith('//'):
+            return url
+        return '%s/%s' % (self.base_url, url.lstrip('/'))
+
+    def _fetch_targets(self, rows):
+        ''' Returns {(content type id, object id): object}. '''
+        ids_by_ctype = {}
+        for pk, name, ct_id, object_id, caption in rows:
+            ids_by_ctype.setdefault(ct_id, set()).add(object_id)
+        targets = {}
+        for ct_id, ids in ids_by_ctype.items():
+            model = content_types.model_for_id(ct_id)
+            if model is None: # stale content type
+                continue
+            for pk, target in self.get_target_queryset(model).\
+                                    in_bulk(list(ids)).items():
+                targets[ct_id, pk] = target
+        return targets
+
+    def iter_entries(self):
+        ''' Yields (page URL, [(image URL, caption)]) tuples. '''
+        rows = self.queryset.values_list('pk', 'image', 'content_type',
+                                         'object_id', 'caption')
+        for chunk in keyset_chunks(rows, self.chunk_size):
+            targets = self._fetch_targets(chunk)
+            pages, entries = {}, []
+            for pk, name, ct_id, object_id, caption in chunk:
+                key = ct_id, object_id
+                if key not in pages:
+                    target = targets.get(key)
+                    pages[key] = None
+                    if target is not None:
+                        page_url = self.page_url(target)
+                        if page_url:
+                            pages[key] = len(entries)
+                            entries.append((self._absolute(page_url), []))
+                index = pages[key]
+                if index is None:
+                    continue
+                page_url, images = entries[index]
+                if len(images) == MAX_IMAGES_PER_ENTRY:
+                    pages[key] = len(entries)
+                    images = []
+                    entries.append((page_url, images))
+                images.append((self._absolute(self.image_url(name)), caption))
+            for entry in entries:
+                yield entry
+
+    def _entry_xml(self, page_url, images):
+        parts = ['<url><loc>%s</loc>' % escape(page_url)]
+        for url, caption in images:
+            parts.append('<image:image><image:loc>%s</image:loc>' %
+                         escape(url))
+            if caption:
+                parts.append('<image:caption>%s</image:caption>' %
+                             escape(caption))
+            parts.append('</image:image>')
+        parts.append('</url>\n')
+        return u''.join(parts).encode('utf-8')
+
+    def iter_files(self):
+        ''' Yields sitemap files as iterators of XML chunks. Each iterator
+            must be consumed before the next one is requested. '''
+        entries = self.iter_entries()
+        # [the next entry]: it is shared by files
+        pending = [next(entries, None)]
+        while pending[0] is not None:
+            yield self._iter_file(entries, pending)
+
+    def _iter_file(self, entries, pending):
+        yield URLSET_START
+        count, size = 0, len(URLSET_START) + len(URLSET_END)
+        while pending[0] is not None:
+            data = self._entry_xml(*pending[0])
+            if count and (count == self.max_entries or
+                          size + len(data) > self.max_file_size):
+                break # the entry goes to the next file
+            count, size = count + 1, size + len(data)
+            yield data
+            pending[0] = next(entries, None)
+        yield URLSET_END
+
+    def write(self, directory, name='sitemap-images', index_url=None,
+              compress=False):
+        ''' Writes sitemap files ``<name>-1.xml``, ``<name>-2.xml``... and
+            sitemap index ``<name>.xml`` to ``directory``. URLs of sitemap
+            files in the index start with ``index_url`` (``base_url`` by
+            default). Files are gzipped if ``compress`` is True. Returns
+            names of the files. '''
+        ext = '.xml.gz' if compress else '.xml'
+        index_url = (index_url or self.base_url).rstrip('/')
+        names = []
+        for number, chunks in enumerate(self.iter_files()):
+            file_name = '%s-%d%s' % (name, number + 1, ext)
+            path = os.path.join(directory, file_name)
+            f = gzip.open(path, 'wb') if compress else open(path, 'wb')
+            try:
+                for data in chunks:
+                    f.write(data)
+            finally:
+                f.close()
+            names.append(file_name)
+
+        index_name = name + '.xml'
+        f = open(os.path.join(directory, index_name), 'wb')
+        try:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<sitemapindex xmlns="http://www.sitemaps.org/schemas/'
+                    'sitemap/0.9">\n')
+            for file_name in names:
+                f.write('<sitemap><loc>%s</loc></sitemap>\n' %
+                        escape('%s/%s' % (index_url, file_name)))
+            f.write('</sitemapindex>\n')
+        finally:
+            f.close()
+        return [index_name] + names
@@ -0,0 +1,345 @@
+#coding: utf-8
+'''
+Template tags for displaying attached images without N+1 queries.
+
+Tags don't query the database when they are rendered. They put lazy values
+into the context and register the object in per-render batch. Lookups are
+performed when the value is used for the first time: all objects registered
+so far are resolved together, 1 query per content type. If the object is
+an item of a list or evaluated queryset available in the context
+(e.g. the sequence of enclosing ``{% for %}`` loop) then all items of this
+list are resolved at once too, so loops don't need view changes::
+
+    {% load attached_images %}
+
+    {% for obj in object_list %}
+        {% main_image_for obj as img %}
+        {% if img %}<img src="{{ img.image.url }}">{% endif %}
+
+        {% images_for obj limit 4 as imgs %}
+        {% for image in imgs %}{{ image.caption }}{% endfor %}
+    {% endfor %}
+
+Cover image (main image or the first image if none is marked as main) and
+the number of images are fetched together, 2 queries per content type::
+
+    {% for obj in object_list %}
+        {% main_image_for obj fallback as cover %}
+        {% images_count_for obj as count %}
+        {% if cover %}<img src="{{ cover.image.url }}"> ({{ count }}){% endif %}
+    {% endfor %}
+
+'''
+from django import template
+from django.db import connection
+from django.db.models.query import QuerySet
+
+from generic_images.models import AttachedImage
+from generic_utils.contenttypes import content_types
+from generic_utils.templatetags import validate_params, InvalidParamsError
+
+register = template.Library()
+
+
+class ImageBatch(object):
+    ''' Collects objects whose images are requested during one template
+        render and fetches images for all of them at once. '''
+
+    def __init__(self, context):
+        self.context = context
+        # kinds are 'main', 'effective', 'count' and ('all', limit)
+        self.pending = {'main': {}, 'effective': {}, 'count': {}}
+        self.results = {'main': {}, 'effective': {}, 'count': {}}
+
+    @classmethod
+    def for_context(cls, context):
+        # stored on the context object itself (not in render_context) so
+        # included templates share the batch
+        batch = getattr(context, '_image_batch', None)
+        if batch is None:
+            batch = context._image_batch = cls(context)
+        return batch
+
+    def _key(self, obj):
+        return content_types.get_for_model(obj).pk, obj.pk
+
+    def add(self, kind, obj):
+        key = self._key(obj)
+        if key not in self.results.setdefault(kind, {}):
+            self.pending.setdefault(kind, {})[key] = obj
+
+    def get(self, kind, obj):
+        key = self._key(obj)
+        if key not in self.results.setdefault(kind, {}):
+            self.pending.setdefault(kind, {})[key] = obj
+            for sibling in self._find_siblings(obj):
+                self.add(kind, sibling)
+            self._resolve(kind)
+        return self.results[kind][key]
+
+    def _find_siblings(self, obj):
+        ''' Returns items of the first list or evaluated queryset in the
+            context that contains ``obj``. '''
+        for d in self.context.dicts:
+            for value in d.values():
+                if isinstance(value, QuerySet):
+                    # don't trigger queries for unevaluated querysets
+                    value = value._result_cache
+                if not isinstance(value, (list, tuple)):
+                    continue
+                if any(item is obj for item in value):
+                    return [item for item in value
+                            if item.__class__ is obj.__class__]
+        return []
+
+    def _resolve(self, kind):
+        if kind in ('effective', 'count'):
+            return self._resolve_effective()
+        pending, self.pending[kind] = self.pending[kind], {}
+        results = self.results[kind]
+        object_ids_by_ctype = {}
+        for ctype_id, object_id in pending:
+            results[ctype_id, object_id] = None if kind == 'main' else []
+            object_ids_by_ctype.setdefault(ctype_id, []).append(object_id)
+
+        for ctype_id, object_ids in object_ids_by_ctype.items():
+            images = AttachedImage.objects.filter(content_type=ctype_id,
+                                                  object_id__in=object_ids)
+            if kind != 'main':
+                images = self._limited(images.order_by('-order', '-pk'),
+                                       kind[1])
+            if kind == 'main':
+                for image in images.filter(is_main=True):
+                    results[ctype_id, image.object_id] = image
+            else:
+                for image in images:
+                    results[ctype_id, image.object_id].append(image)
+
+    def _limited(self, images, limit):
+        ''' Returns first ``limit`` images of each object: images are not
+            selected if ``limit`` or more images of the same object are
+            shown before them. '''
+        if limit is None:
+            return images
+        qn = connection.ops.quote_name
+        opts = AttachedImage._meta
+        table, order = qn(opts.db_table), qn(opts.get_field('order').column)
+        pk, ct = qn(opts.pk.column), qn(opts.get_field('content_type').column)
+        object_id = qn(opts.get_field('object_id').column)
+        return images.extra(where=[
+            '(SELECT COUNT(*) FROM %(table)s newer WHERE '
+            'newer.%(ct)s = %(table)s.%(ct)s AND '
+            'newer.%(object_id)s = %(table)s.%(object_id)s AND '
+            '(newer.%(order)s > %(table)s.%(order)s OR '
+            '(newer.%(order)s = %(table)s.%(order)s AND '
+            'newer.%(pk)s > %(table)s.%(pk)s))) < %%s' % dict(
+                table=table, ct=ct, object_id=object_id, order=order, pk=pk)],
+            params=[limit])
+
+    def _resolve_effective(self):
+        # cover images and counts are fetched by the same queries
+        pending = dict(self.pending['effective'], **self.pending['count'])
+        self.pending['effective'], self.pending['count'] = {}, {}
+        object_ids_by_ctype = {}
+        for ctype_id, object_id in pending:
+            object_ids_by_ctype.setdefault(ctype_id, []).append(object_id)
+
+        for ctype_id, object_ids in object_ids_by_ctype.items():
+            found = AttachedImage.objects.effective_main_images(ctype_id,
+                                                                object_ids)
+            for object_id, (image, count) in found.items():
+                self.results['effective'][ctype_id, object_id] = image
+                self.results['count'][ctype_id, object_id] = count
+
+
+class LazyMainImage(object):
+    ''' Proxy for main (or effective main) image of the object (or None). '''
+
+    def __init__(self, batch, obj, kind='main'):
+        self._batch, self._obj, self._kind = batch, obj, kind
+
+    def _get(self):
+        return self._batch.get(self._kind, self._obj)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self._get(), name)
+
+    def __nonzero__(self):
+        return self._get() is not None
+
+    def __unicode__(self):
+        image = self._get()
+        return unicode(image) if image is not None else u''
+
+
+class LazyImageList(object):
+    ''' Proxy for the list of object's images limited by ``limit``. '''
+
+    def __init__(self, batch, obj, limit):
+        self._batch, self._obj, self._limit = batch, obj, limit
+
+    def _get(self):
+        return self._batch.get(('all', self._limit), self._obj)
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
+    def __getitem__(self, index):
+        return self._get()[index]
+
+    def __nonzero__(self):
+        return bool(self._get())
+
+
+class LazyImagesCount(object):
+    ''' Proxy for the number of object's images. '''
+
+    def __init__(self, batch, obj):
+        self._batch, self._obj = batch, obj
+
+    def __int__(self):
+        return self._batch.get('count', self._obj)
+
+    def __cmp__(self, other):
+        return cmp(int(self), other)
+
+    def __hash__(self):
+        return hash(int(self))
+
+    def __nonzero__(self):
+        return int(self) != 0
+
+    def __unicode__(self):
+        return unicode(int(self))
+
+
+class MainImageNode(template.Node):
+    def __init__(self, obj, var_name, kind='main'):
+        self.obj = template.Variable(obj)
+        self.var_name = var_name
+        self.kind = kind
+
+    def render(self, context):
+        obj = self.obj.resolve(context)
+        if obj is None:
+            context[self.var_name] = None
+            return ''
+        batch = ImageBatch.for_context(context)
+        batch.add(self.kind, obj)
+        context[self.var_name] = LazyMainImage(batch, obj, self.kind)
+        return ''
+
+
+class ImagesCountNode(template.Node):
+    def __init__(self, obj, var_name):
+        self.obj = template.Variable(obj)
+        self.var_name = var_name
+
+    def render(self, context):
+        obj = self.obj.resolve(context)
+        if obj is None:
+            context[self.var_name] = 0
+            return ''
+        batch = ImageBatch.for_context(context)
+        batch.add('count', obj)
+        context[self.var_name] = LazyImagesCount(batch, obj)
+        return ''
+
+
+class ImagesNode(template.Node):
+    def __init__(self, obj, limit, var_name):
+        self.obj = template.Variable(obj)
+        self.limit = template.Variable(limit) if limit is not None else None
+        self.var_name = var_name
+
+    def render(self, context):
+        obj = self.obj.resolve(context)
+        limit = int(self.limit.resolve(context)) if self.limit else None
+        if obj is None:
+            context[self.var_name] = []
+            return ''
+        batch = ImageBatch.for_context(context)
+        batch.add(('all', limit), obj)
+        context[self.var_name] = LazyImageList(batch, obj, limit)
+        return ''
+
+
+@register.tag
+def main_image_for(parser, token):
+    '''
+    Puts main image of the object (or None) into context variable (None if
+    ``obj`` is None)::
+
+        {% main_image_for obj as img %}
+
+    With ``fallback`` the first image (with the highest order) is used if no
+    image is marked as main::
+
+        {% main_image_for obj fallback as img %}
+    '''
+    bits = token.split_contents()
+    if len(bits) == 5:
+        validate_params(bits, 4, {2: 'fallback', 3: 'as'})
+        return MainImageNode(bits[1], bits[4], 'effective')
+    validate_params(bits, 3, {2: 'as'})
+    return MainImageNode(bits[1], bits[3])
+
+
+@register.tag
+def images_count_for(parser, token):
+    '''
+    Puts the number of object's images into context variable::
+
+        {% images_count_for obj as count %}
+
+    Counts are fetched together with ``main_image_for obj fallback``.
+    '''
+    bits = token.split_contents()
+    validate_params(bits, 3, {2: 'as'})
+    return ImagesCountNode(bits[1], bits[3])
+
+
+@register.tag
+def images_for(parser, token):
+    '''
+    Puts list of object's images (optionally limited) into context
+    variable::
+
+        {% images_for obj as images %}
+        {% images_for obj limit 4 as images %}
+
+    The limit is applied by the database (to each object of the batch), so
+    only shown images are fetched. Nothing is fetched if ``obj`` is None.
+    '''
+    bits = token.split_contents()
+    if len(bits) == 4:
+        validate_params(bits, 3, {2: 'as'})
+        return ImagesNode(bits[1], None, bits[3])
+    if len(bits) != 6:
+        raise InvalidParamsError("'%s' tag takes 3 or 5 arguments" % bits[0])
+    validate_params(bits, 5, {2: 'limit', 4: 'as'})
+    return ImagesNode(bits[1], bits[3], bits[5])
+
+
+@register.simple_tag
+def picture(image, *thumb_names, **attrs):
+    '''
+    Renders ``<picture>`` element for the image (see
+    :meth:`~generic_images.thumbnails.ThumbnailsFieldFile.picture_html`)::
+
+        {% picture img '300x300' %}
+        {% picture img '300x300' '480x1500' sizes="(max-width: 600px) 100vw, 480px" class="photo" %}
+
+    ``alt`` defaults to the image caption. Nothing is rendered if ``img``
+    is None.
+    '''
+    if not image or not image.image:
+        return ''
+    alt = attrs.pop('alt', image.caption)
+    sizes = attrs.pop('sizes', None)
+    return image.image.picture_html(list(thumb_names), sizes, alt, **attrs)
@@ -1,14 +1,393 @@
 #coding: utf-8
 from django.test import TestCase
-from django.db import models
+from django.db import models, connection
+from django.conf.urls.defaults import patterns, include, url
+from django.contrib import admin
+from django.contrib.auth.models import User
 from generic_images.models import AttachedImage
+import generic_images.admin
+
+urlpatterns = patterns('', url(r'^admin/', include(admin.site.urls)))
 
 class DumbModel(models.Model):
     pass
 
-#class ImageOrderTest(TestCase):
-#    def setUp(self):
-#        self.model1 = DumbModel.objects.create()
-#        self.model2 = DumbModel.objects.create()
-#
-#        self.image1 = AttachedImage.objects.create()
\ No newline at end of file
+class ImageOrderTest(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create(username='owner')
+        self.images = []
+        for i in range(5):
+            image = AttachedImage(content_object=self.owner,
+                                  image='media/new_images/order%d.jpg' % i)
+            image.send_signal = False
+            image.save()
+            self.images.append(image)
+
+    def _displayed(self):
+        return list(AttachedImage.objects.for_model(self.owner).
+                    order_by('-order').values_list('pk', flat=True))
+
+    def test_reorder(self):
+        a, b, c, d, e = [image.pk for image in self.images]
+        orders = AttachedImage.objects.reorder(self.owner, [c, a])
+        self.assertEqual(sorted(orders), sorted([a, b, c, d, e]))
+        self.assertEqual(self._displayed()[:2], [c, a])
+        self.assertRaises(ValueError, AttachedImage.objects.reorder,
+                          self.owner, [a, 0])
+
+    def test_reorder_in_batches(self):
+        import generic_images.managers
+        ids = [image.pk for image in reversed(self.images)]
+        old_size = generic_images.managers.REORDER_BATCH_SIZE
+        generic_images.managers.REORDER_BATCH_SIZE = 2
+        try:
+            AttachedImage.objects.reorder(self.owner, ids)
+        finally:
+            generic_images.managers.REORDER_BATCH_SIZE = old_size
+        self.assertEqual(self._displayed(), ids)
+
+    def test_move_into_gap(self):
+        ids = [image.pk for image in self.images]
+        AttachedImage.objects.reorder(self.owner, ids, gap=10)
+        image = AttachedImage.objects.get(pk=ids[4])
+        after = AttachedImage.objects.get(pk=ids[0])
+        orders = AttachedImage.objects.move(image, after)
+        self.assertEqual(orders.keys(), [image.pk])
+        self.assertEqual(self._displayed(), [ids[0], ids[4]] + ids[1:4])
+
+        orders = AttachedImage.objects.move(image)
+        self.assertEqual(orders.keys(), [image.pk])
+        self.assertEqual(self._displayed()[0], image.pk)
+
+    def test_move_renumbers_without_gap(self):
+        from generic_images.managers import REORDER_GAP
+        ids = [image.pk for image in self.images]
+        AttachedImage.objects.reorder(self.owner, ids)
+        image = AttachedImage.objects.get(pk=ids[4])
+        after = AttachedImage.objects.get(pk=ids[1])
+        orders = AttachedImage.objects.move(image, after)
+        self.assertEqual(sorted(orders), sorted(ids))
+        expected = [ids[0], ids[1], ids[4], ids[2], ids[3]]
+        self.assertEqual(self._displayed(), expected)
+        orders = sorted(orders.values(), reverse=True)
+        self.assertEqual(orders[0] - orders[1], REORDER_GAP)
+
+
+class AdminChangelistQueriesTest(TestCase):
+    urls = 'generic_images.tests'
+
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com',
+                                                   'admin')
+        self.client.login(username='admin', password='admin')
+
+    def _add_images(self, count):
+        for i in range(count):
+            owner = User.objects.create(username='owner%d' % User.objects.count())
+            image = AttachedImage(content_object=owner, user=owner,
+                                  image='media/new_images/%d.jpg' % i)
+            image.send_signal = False
+            image.save()
+
+    def _changelist_queries(self):
+        old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            # connection.queries is reset when request is started
+            response = self.client.get('/admin/generic_images/attachedimage/')
+            self.assertEqual(response.status_code, 200)
+            return len(connection.queries)
+        finally:
+            connection.use_debug_cursor = old_debug_cursor
+
+    def test_query_count_doesnt_depend_on_page_size(self):
+        self._add_images(3)
+        small_page = self._changelist_queries()
+        self._add_images(30)
+        big_page = self._changelist_queries()
+        self.assertEqual(small_page, big_page)
+
+
+class ReplicaRoutingTest(TestCase):
+    ''' Image reads go to the replica (a separate SQLite database that
+        doesn't receive writes, so it emulates replication lag) unless
+        the object's images were changed recently. '''
+    replica = 'generic_images_replica'
+
+    def setUp(self):
+        from django.core.management import call_command
+        from django.db import connections, router
+        from generic_images.routers import ImageReplicaRouter, clear_pins
+        connections.databases[self.replica] = {
+            'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        connections.ensure_defaults(self.replica)
+        call_command('syncdb', database=self.replica, interactive=False,
+                     verbosity=0)
+        self.router = ImageReplicaRouter(replicas=[self.replica])
+        router.routers.insert(0, self.router)
+        clear_pins()
+        self.owner = User.objects.create(username='owner')
+
+    def tearDown(self):
+        from django.db import connections, router
+        from generic_images.routers import clear_pins
+        router.routers.remove(self.router)
+        clear_pins()
+        connections[self.replica].close()
+        del connections.databases[self.replica]
+        delattr(connections._connections, self.replica)
+
+    def _attach(self):
+        image = AttachedImage(content_object=self.owner,
+                              image='media/new_images/replica.jpg')
+        image.send_signal = False
+        image.save()
+        return image
+
+    def test_written_object_is_read_from_primary(self):
+        from generic_images.routers import get_pins, set_pins, clear_pins
+        image = self._attach()
+        self.assertEqual(list(AttachedImage.objects.for_model(self.owner)),
+                         [image])
+        self.assertEqual(image.next(), None)
+
+        # pins are restored from session by ReadYourWritesMiddleware
+        pins = get_pins()
+        clear_pins()
+        self.assertEqual(list(AttachedImage.objects.for_model(self.owner)), [])
+        set_pins(pins)
+        self.assertEqual(AttachedImage.objects.get_main_for(self.owner), None)
+        self.assertEqual(AttachedImage.objects.for_model(self.owner).count(), 1)
+
+    def test_reads_go_to_replica_when_nothing_is_pinned(self):
+        from generic_images.routers import clear_pins, pin
+        self._attach()
+        clear_pins()
+        self.assertEqual(AttachedImage.objects.for_model(self.owner).count(), 0)
+        self.assertEqual(AttachedImage.objects.count(), 0)
+        # other objects don't pin the owner but unscoped reads are pinned
+        pin(0, 0)
+        self.assertEqual(AttachedImage.objects.for_model(self.owner).count(), 0)
+        self.assertEqual(AttachedImage.objects.count(), 1)
+
+    def test_pins_expire(self):
+        from generic_images.routers import pin
+        image = self._attach()
+        pin(image.content_type_id, image.object_id, seconds=-1)
+        self.assertEqual(AttachedImage.objects.for_model(self.owner).count(), 0)
+
+
+class ContentTypeRegistryTest(TestCase):
+
+    def setUp(self):
+        from django.contrib.contenttypes.models import ContentType
+        from generic_utils.contenttypes import content_types
+        content_types.clear()
+        ContentType.objects.clear_cache()
+        self.registry = content_types
+
+    def test_content_types_are_loaded_once(self):
+        from django.contrib.contenttypes.models import ContentType
+        with self.assertNumQueries(1):
+            user_ct = self.registry.get_for_model(User)
+        with self.assertNumQueries(0):
+            image_ct = self.registry.get_for_model(AttachedImage)
+            self.assertEqual(self.registry.model_for_id(user_ct.pk), User)
+            self.assertEqual(self.registry.get_for_id(str(image_ct.pk)),
+                             image_ct)
+            self.assertEqual(ContentType.objects.get_for_model(User), user_ct)
+
+    def test_changed_content_types_are_reloaded(self):
+        from django.contrib.contenttypes.models import ContentType
+        stale = ContentType.objects.create(app_label='generic_images',
+                                           model='stale')
+        self.assertEqual(self.registry.model_for_id(stale.pk), None)
+        stale_id = stale.pk
+        stale.delete()
+        self.assertRaises(ContentType.DoesNotExist,
+                          self.registry.get_for_id, stale_id)
+
+
+class ImageDeduplicationTest(TestCase):
+    ''' Files of images with the same content are shared and reference
+        counted in ImageBlob rows. '''
+
+    def setUp(self):
+        import tempfile
+        import generic_images.models
+        from django.core.files.storage import FileSystemStorage
+        self.field = AttachedImage._meta.get_field('image')
+        self.old_storage = self.field.storage
+        self.old_deduplicate = generic_images.models.DEDUPLICATE_IMAGES
+        self.media_root = tempfile.mkdtemp()
+        self.storage = self.field.storage = FileSystemStorage(self.media_root)
+        generic_images.models.DEDUPLICATE_IMAGES = True
+        self.owner = User.objects.create(username='owner')
+
+    def tearDown(self):
+        import shutil
+        import generic_images.models
+        self.field.storage = self.old_storage
+        generic_images.models.DEDUPLICATE_IMAGES = self.old_deduplicate
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def _file(self, color):
+        from cStringIO import StringIO
+        from PIL import Image
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        buf = StringIO()
+        Image.new('RGB', (40, 30), color).save(buf, 'JPEG')
+        return SimpleUploadedFile('photo.jpg', buf.getvalue())
+
+    def _attach(self, color):
+        image = AttachedImage(content_object=self.owner)
+        image.image = self._file(color)
+        image.send_signal = False
+        image.save()
+        return image
+
+    def _refs(self, name):
+        from generic_images.models import ImageBlob
+        return list(ImageBlob.objects.filter(name=name).
+                    values_list('ref_count', flat=True))
+
+    def test_register_acquire_release(self):
+        from generic_images.models import ImageBlob
+        blobs = ImageBlob.objects
+        self.assertEqual(blobs.acquire('digest'), None)
+        self.assertEqual(blobs.register('digest', 'first.jpg'), 'first.jpg')
+        # stored concurrently: the registered file is used
+        self.assertEqual(blobs.register('digest', 'second.jpg'), 'first.jpg')
+        self.assertEqual(blobs.acquire('digest'), 'first.jpg')
+        self.assertEqual(self._refs('first.jpg'), [3])
+        self.assertFalse(blobs.release('first.jpg'))
+        self.assertFalse(blobs.release('first.jpg'))
+        self.assertTrue(blobs.release('first.jpg'))
+        self.assertEqual(self._refs('first.jpg'), [])
+
+        # the last reference is being released: the row is taken over
+        ImageBlob.objects.create(digest='digest', name='old.jpg', ref_count=0)
+        self.assertEqual(blobs.register('digest', 'new.jpg'), 'new.jpg')
+        self.assertEqual(self._refs('new.jpg'), [1])
+
+    def test_save_replace_delete(self):
+        first = self._attach('red')
+        second = self._attach('red')
+        name = first.image.name
+        self.assertEqual(second.image.name, name)
+        self.assertEqual(self._refs(name), [2])
+
+        first.image = self._file('blue')
+        first.save()
+        self.assertNotEqual(first.image.name, name)
+        self.assertEqual(self._refs(name), [1])
+        self.assertEqual(self._refs(first.image.name), [1])
+        self.assertTrue(self.storage.exists(name))
+
+        second.delete()
+        self.assertEqual(self._refs(name), [])
+        self.assertFalse(self.storage.exists(name))
+        new_name = first.image.name
+        first.delete()
+        self.assertFalse(self.storage.exists(new_name))
+
+    def test_concurrently_stored_file_is_shared(self):
+        import os
+        # files of one batch are stored before any of them is registered
+        images = AttachedImage.objects.bulk_attach(self.owner,
+                    [self._file('green'), self._file('green')],
+                    send_signal=False)
+        names = set(image.image.name for image in images)
+        self.assertEqual(len(names), 1)
+        name = names.pop()
+        self.assertEqual(self._refs(name), [2])
+        self.assertEqual(set(AttachedImage.objects.values_list('image',
+                                                               flat=True)),
+                         set([name]))
+        stored = os.listdir(os.path.dirname(self.storage.path(name)))
+        self.assertEqual(len([f for f in stored if f.endswith('.jpg')]), 1)
+
+
+class ImageTransferTest(TestCase):
+
+    def setUp(self):
+        import tempfile
+        import time
+        from django.core.files.storage import FileSystemStorage
+
+        class SlowStorage(FileSystemStorage):
+            # originals are written slower than thumbnails are rendered
+            def _save(self, name, content):
+                if name.endswith('.jpg'):
+                    time.sleep(0.2)
+                return super(SlowStorage, self)._save(name, content)
+
+        self.field = AttachedImage._meta.get_field('image')
+        self.old_storage = self.field.storage
+        self.media_root = tempfile.mkdtemp()
+        self.storage = self.field.storage = SlowStorage(self.media_root)
+        self.owner = User.objects.create(username='owner')
+        self.target = User.objects.create(username='target')
+
+    def tearDown(self):
+        import shutil
+        self.field.storage = self.old_storage
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def _attach(self, color):
+        from cStringIO import StringIO
+        from PIL import Image
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        buf = StringIO()
+        Image.new('RGB', (40, 30), color).save(buf, 'JPEG')
+        image = AttachedImage(content_object=self.owner)
+        image.image = SimpleUploadedFile('photo.jpg', buf.getvalue())
+        image.send_signal = False
+        image.save()
+
+    def _export(self, changed_thumb):
+        ''' Returns archive of owner's images where options of
+            ``changed_thumb`` differ from the current ones. '''
+        import json
+        import tarfile
+        from cStringIO import StringIO
+        from generic_images.transfer import ImageExporter, THUMBNAILS_MEMBER
+        out = StringIO()
+        exporter = ImageExporter(out, self.field, workers=2)
+        exporter.write_chunk(list(AttachedImage.objects.for_model(self.owner)))
+        exporter.close()
+
+        out.seek(0)
+        changed = StringIO()
+        source = tarfile.open(fileobj=out, mode='r')
+        archive = tarfile.open(fileobj=changed, mode='w')
+        for member in source:
+            data = source.extractfile(member).read()
+            if member.name == THUMBNAILS_MEMBER:
+                signature = json.loads(data)
+                signature[changed_thumb] = 'changed'
+                data = json.dumps(signature)
+                member.size = len(data)
+            archive.addfile(member, StringIO(data))
+        archive.close()
+        changed.seek(0)
+        return changed
+
+    def test_partially_reused_thumbnails(self):
+        from generic_images.transfer import ImageImporter
+        self._attach('red')
+        thumbs = [name for name, options in self.field.thumbs]
+        archive = self._export(thumbs[0])
+
+        # free workers render missing thumbnails while the original is
+        # still being written
+        importer = ImageImporter(AttachedImage, workers=4, target=self.target,
+                                 send_signal=False)
+        importer.run(archive)
+        self.assertEqual(importer.imported, 1)
+        for image in AttachedImage.objects.for_model(self.target):
+            for thumb in thumbs:
+                self.assertTrue(self.storage.exists(
+                                image.image._calc_thumb_filename(thumb)))
+
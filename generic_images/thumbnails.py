@@ -0,0 +1,334 @@
+#coding: utf-8
+'''
+Image field with thumbnails. It is athumb's ``ImageWithThumbsField`` with
+hooks used by generic_images (thumbnail rendering instrumentation,
+background storage writes and rendering of selected sizes for existing
+images).
+
+Thumbnails can be stored in modern formats besides the main one (JPEG):
+formats are listed in ``'formats'`` option of the thumbnail, e.g.
+``('300x300', {'size': (300, 300), 'formats': ['webp', 'avif']})``, or in
+``GENERIC_IMAGES_THUMBNAIL_VARIANTS`` setting for all thumbnails without
+the option. Variants are encoded from the same resized image, so the
+original is decoded and resized once per thumbnail. They are stored next
+to the main thumbnail as ``<name>_<thumb>.<format>``. Formats that
+Pillow can't encode (AVIF needs a plugin) are skipped.
+:meth:`ThumbnailsFieldFile.picture_html` (and ``{% picture %}`` template
+tag) renders ``<picture>`` element with ``<source>`` for each format.
+
+Formats whose variants were actually stored are recorded in
+``thumbnail_formats`` field of the image when thumbnails are rendered, so
+variants are offered only if their files exist, even if hosts have
+different Pillow builds or formats were added to options later.
+'''
+from cStringIO import StringIO
+
+from PIL import Image
+from athumb.fields import ImageWithThumbsField, ImageWithThumbsFieldFile,\
+                          THUMBNAIL_ENGINE
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.utils.html import conditional_escape
+from django.utils.safestring import mark_safe
+
+from generic_images.metadata import fetch_image_content
+from generic_utils.concurrency import submit
+from generic_utils.instrumentation import metrics
+
+VARIANT_FORMATS = {
+    # format: (PIL format, content type, quality)
+    'webp': ('WEBP', 'image/webp', 80),
+    'avif': ('AVIF', 'image/avif', 60),
+}
+VARIANT_PREFERENCE = ['avif', 'webp']
+''' Variant formats from the smallest files to the biggest ones. '''
+
+
+def can_encode(fmt):
+    ''' Returns True if installed Pillow can encode variant format ``fmt``. '''
+    Image.init()
+    return fmt in VARIANT_FORMATS and VARIANT_FORMATS[fmt][0] in Image.SAVE
+
+
+def best_format(accept, formats):
+    ''' Returns the variant format from ``formats`` that the client accepts
+        according to ``accept`` header (the most compact one), or None. '''
+    accepted = set()
+    for item in (accept or '').split(','):
+        params = [param.strip() for param in item.split(';')]
+        if 'q=0' not in params and 'q=0.0' not in params:
+            accepted.add(params[0].lower())
+    for fmt in VARIANT_PREFERENCE:
+        if fmt in formats and VARIANT_FORMATS[fmt][1] in accepted:
+            return fmt
+    return None
+
+
+class _BackgroundSaveStorage(object):
+    ''' Storage proxy that submits ``save`` calls to background threads.
+        AsyncResults are appended to ``writes`` list. '''
+
+    def __init__(self, storage, writes):
+        self._storage = storage
+        self._writes = writes
+
+    def __getattr__(self, name):
+        return getattr(self._storage, name)
+
+    def save(self, name, content):
+        self._writes.append(submit(self._storage.save, name, content))
+        return name
+
+
+class _SizeCountingStorage(object):
+    ''' Storage proxy that counts bytes passed to ``save``. '''
+
+    def __init__(self, storage):
+        self._storage = storage
+        self.written = 0
+
+    def __getattr__(self, name):
+        return getattr(self._storage, name)
+
+    def save(self, name, content):
+        self.written += content.size
+        return self._storage.save(name, content)
+
+
+class ThumbnailsFieldFile(ImageWithThumbsFieldFile):
+
+    background_writes = None
+    ''' If it is a list then thumbnails are rendered as usual but stored
+        in background threads, AsyncResults of storage writes are appended
+        to this list. '''
+
+    thumbnails_size = None
+    ''' Total size of thumbnails (in bytes) rendered when the file was
+        saved. '''
+
+    def thumb_options(self, thumb_name):
+        for name, options in self.field.thumbs:
+            if name == thumb_name:
+                return options
+        raise KeyError(thumb_name)
+
+    def _calc_variant_filename(self, thumb_name, fmt):
+        return '%s.%s' % (self._calc_thumb_filename(thumb_name).rsplit('.', 1)[0],
+                          fmt)
+
+    def thumbnail_files(self, thumb_names=None):
+        ''' Returns storage names of thumbnails ``thumb_names`` (all by
+            default) and of their variants. '''
+        if thumb_names is None:
+            thumb_names = [name for name, options in self.field.thumbs]
+        names = []
+        for thumb_name in thumb_names:
+            names.append(self._calc_thumb_filename(thumb_name))
+            # including formats this process can't encode: they could
+            # be stored by another host
+            names.extend(self._calc_variant_filename(thumb_name, fmt) for fmt
+                         in self.field.configured_formats(thumb_name))
+        return names
+
+    def stored_formats(self, thumb_name):
+        ''' Returns formats of stored variants of thumbnail ``thumb_name``:
+            the configured ones recorded in ``thumbnail_formats`` of the
+            instance (all encodable ones if the model has no such field). '''
+        recorded = getattr(self.instance, 'thumbnail_formats', None)
+        if recorded is None:
+            return self.field.variant_formats(thumb_name)
+        recorded = recorded.split(',')
+        return [fmt for fmt in self.field.configured_formats(thumb_name)
+                if fmt in recorded]
+
+    def generate_variant_url(self, thumb_name, fmt, **kwargs):
+        ''' Returns URL of ``fmt`` variant of thumbnail ``thumb_name``
+            (computed from the main thumbnail URL, see ``generate_url``). '''
+        url = self.generate_url(thumb_name, **kwargs)
+        path, sep, query = url.partition('?')
+        return '%s.%s%s%s' % (path.rsplit('.', 1)[0], fmt, sep, query)
+
+    def thumb_width(self, thumb_name):
+        ''' Returns width of thumbnail ``thumb_name`` computed from its
+            options and width and height of the original (if they are
+            known). '''
+        options = self.thumb_options(thumb_name)
+        width, height = options['size']
+        original_width = getattr(self.instance, 'width', None)
+        original_height = getattr(self.instance, 'height', None)
+        if not original_width or not original_height:
+            return width
+        upscale = options.get('upscale', True)
+        if options.get('crop'):
+            return width if upscale else min(width, original_width)
+        scale = min(float(width) / original_width,
+                    float(height) / original_height)
+        if not upscale:
+            scale = min(scale, 1)
+        return max(1, int(round(original_width * scale)))
+
+    def picture_html(self, thumb_names, sizes=None, alt='', **attrs):
+        ''' Returns ``<picture>`` element with thumbnails ``thumb_names``.
+            If there are several thumbnails then they are listed in
+            ``srcset`` attributes with their widths and ``sizes`` attribute
+            is added; the first thumbnail is the fallback ``src``. Variants
+            in other formats are listed in ``<source>`` elements (the most
+            compact format first). ``attrs`` are added to ``<img>``. URLs
+            are computed without storage requests. '''
+        def srcset(url_getter):
+            if len(thumb_names) == 1:
+                return url_getter(thumb_names[0])
+            return ', '.join('%s %dw' % (url_getter(name),
+                                         self.thumb_width(name))
+                             for name in thumb_names)
+
+        sizes_attr = ''
+        if sizes and len(thumb_names) > 1:
+            sizes_attr = ' sizes="%s"' % conditional_escape(sizes)
+        sources = []
+        formats = [self.stored_formats(name) for name in thumb_names]
+        for fmt in VARIANT_PREFERENCE:
+            if all(fmt in thumb_formats for thumb_formats in formats):
+                url_getter = lambda name: self.generate_variant_url(name, fmt)
+                sources.append('<source type="%s" srcset="%s"%s>' % (
+                                VARIANT_FORMATS[fmt][1],
+                                conditional_escape(srcset(url_getter)),
+                                sizes_attr))
+        img_attrs = ''.join(' %s="%s"' % (name, conditional_escape(value))
+                            for name, value in sorted(attrs.items()))
+        img = '<img src="%s"%s%s alt="%s"%s>' % (
+                conditional_escape(self.generate_url(thumb_names[0])),
+                ' srcset="%s"' % conditional_escape(srcset(self.generate_url))
+                    if len(thumb_names) > 1 else '',
+                sizes_attr, conditional_escape(alt or ''), img_attrs)
+        return mark_safe('<picture>%s%s</picture>' % (''.join(sources), img))
+
+    def _store_encoded(self, image, filename, fmt, quality=95):
+        buf = StringIO()
+        THUMBNAIL_ENGINE.write(image, buf, quality=quality, format=fmt)
+        self.storage.save(filename, ContentFile(buf.getvalue()))
+
+    def create_and_store_thumb(self, image, thumb_name, thumb_options):
+        ''' Resizes ``image`` once and stores the thumbnail and its variants
+            in other formats. '''
+        crop = thumb_options.get('crop')
+        if crop is True:
+            crop = 'center'
+        thumb = THUMBNAIL_ENGINE.create_thumbnail(image, thumb_options['size'],
+                            crop=crop, upscale=thumb_options.get('upscale', True))
+        self._store_encoded(thumb, self._calc_thumb_filename(thumb_name),
+                            self.get_thumbnail_format())
+        for fmt in self.field.variant_formats(thumb_name):
+            pil_format, content_type, quality = VARIANT_FORMATS[fmt]
+            self._store_encoded(thumb, self._calc_variant_filename(thumb_name,
+                                                                   fmt),
+                                pil_format, quality)
+
+    def delete(self, save=True):
+        for name in self.thumbnail_files():
+            self.storage.delete(name)
+        # athumb deletes main thumbnails (again) and the original
+        super(ThumbnailsFieldFile, self).delete(save)
+
+    def render_thumbs(self, thumb_names, storage=None, content=None,
+                      replace=True):
+        ''' Renders thumbnails ``thumb_names`` of the stored image and saves
+            them to ``storage`` (field storage by default) replacing existing
+            files (if ``replace`` is True). The original is fetched (unless its ``content`` is
+            passed) and decoded once; JPEG originals are decoded at reduced
+            scale if the biggest requested thumbnail is much smaller than
+            the original. '''
+        if content is None:
+            content = fetch_image_content(self)
+        content.seek(0)
+        image = Image.open(content)
+        sizes = [self.thumb_options(name)['size'] for name in thumb_names]
+        image.draft('RGB', (max(w for w, h in sizes), max(h for w, h in sizes)))
+        if image.mode not in ('L', 'RGB', 'RGBA'):
+            image = image.convert('RGBA')
+
+        field_storage = self.storage
+        if storage is not None:
+            self.storage = storage
+        try:
+            with metrics.timer('thumbnails.render'):
+                for name in thumb_names:
+                    # storages don't overwrite files, they pick another name
+                    for filename in self.thumbnail_files([name]):
+                        if replace and self.storage.exists(filename):
+                            self.storage.delete(filename)
+                    self.create_and_store_thumb(image, name,
+                                                self.thumb_options(name))
+        finally:
+            self.storage = field_storage
+
+    def generate_thumbs(self, name, content):
+        with metrics.timer('thumbnails.render'):
+            storage = self.storage
+            if self.background_writes is None:
+                counter = _SizeCountingStorage(storage)
+            else:
+                counter = _SizeCountingStorage(_BackgroundSaveStorage(
+                                            storage, self.background_writes))
+            self.storage = counter
+            try:
+                super(ThumbnailsFieldFile, self).generate_thumbs(name, content)
+            finally:
+                self.storage = storage
+            self.thumbnails_size = counter.written
+
+
+class ThumbnailsImageField(ImageWithThumbsField):
+    ''' ``ImageWithThumbsField`` using :class:`ThumbnailsFieldFile`. '''
+    attr_class = ThumbnailsFieldFile
+
+    def thumbs_signature(self):
+        ''' Returns {thumbnail name: string representation of its options}.
+            It is used to find thumbnails whose options were changed. '''
+        signature = {}
+        for name, options in self.thumbs:
+            items = sorted(options.items())
+            formats = self.variant_formats(name)
+            if formats and 'formats' not in options: # set in settings
+                items.append(('formats', formats))
+            signature[name] = repr(items)
+        return signature
+
+    def configured_formats(self, thumb_name):
+        ''' Returns formats of variants of thumbnail ``thumb_name`` listed in
+            its options or in settings. '''
+        options = dict(self.thumbs)[thumb_name]
+        return list(options.get('formats',
+                    getattr(settings, 'GENERIC_IMAGES_THUMBNAIL_VARIANTS', ())))
+
+    def variant_formats(self, thumb_name):
+        ''' Returns formats of variants of thumbnail ``thumb_name`` that can
+            be encoded. '''
+        return [fmt for fmt in self.configured_formats(thumb_name)
+                if can_encode(fmt)]
+
+    def rendered_formats(self, thumb_names=None, previous=''):
+        ''' Returns value of ``thumbnail_formats`` after thumbnails
+            ``thumb_names`` (all by default) are rendered by this process:
+            formats that all thumbnails configured with them have.
+            ``previous`` is the value before rendering. '''
+        rendered = set(thumb_names if thumb_names is not None else
+                       [name for name, options in self.thumbs])
+        previous = (previous or '').split(',')
+        formats = []
+        for fmt in sorted(VARIANT_FORMATS):
+            users = [name for name, options in self.thumbs
+                     if fmt in self.configured_formats(name)]
+            if not users:
+                continue
+            if can_encode(fmt):
+                stored = fmt in previous or rendered.issuperset(users)
+            else: # rendered thumbnails lost their variants
+                stored = fmt in previous and not rendered.intersection(users)
+            if stored:
+                formats.append(fmt)
+        return ','.join(formats)
+
+    def variant_extensions(self):
+        ''' Returns extensions that variants of thumbnails can have. '''
+        return sorted(VARIANT_FORMATS)
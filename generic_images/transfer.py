@@ -0,0 +1,380 @@
+#coding: utf-8
+'''
+Export and import of images with their metadata, e.g. for moving
+galleries between environments.
+
+Archive is a tar stream, so it can be piped between hosts::
+
+    thumbnails.json              options of exported thumbnails
+    manifest-000001.ndjson       first chunk of images: one JSON object per line
+    blobs/<dir>/<name>.jpg       image files of the chunk
+    blobs/<dir>/<name>_<thumb>.jpeg  and their thumbnails (optional)
+    manifest-000002.ndjson
+    ...
+
+Each manifest is followed by the files it refers to, so both export and
+import hold only one chunk of metadata and a few files in memory. Files
+are read (on export) and stored (on import) by a pool of threads.
+
+Import doesn't save images one by one: metadata is taken from the
+manifest, rows of a chunk are inserted with one query, ``order`` values are
+kept and ``image_saved`` signal is sent once per object. Thumbnails from
+the archive are stored as is if their options are the same as the
+current ones; other thumbnails are rendered.
+'''
+import hashlib
+import json
+import os
+import tarfile
+import time
+from collections import deque
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.base import ContentFile
+
+from generic_images.managers import bump_images_version, collect_usage
+from generic_images.metadata import METADATA_FIELDS, fetch_image_content
+from generic_images.models import DEDUPLICATE_IMAGES, ImageBlob, \
+                                  StorageUsage
+from generic_images.signals import image_saved
+from generic_utils.contenttypes import content_types
+
+FIELDS = ['caption', 'is_main', 'order', 'content_hash', 'stored_size'] + \
+         METADATA_FIELDS
+''' Image fields stored in manifest (besides the object, user and files). '''
+
+THUMBNAILS_MEMBER = 'thumbnails.json'
+
+
+def _blob_name(name):
+    ''' Returns archive name of stored file ``name``. ``<dir>`` is a digest
+        of the storage directory, so files with the same base name in
+        different directories don't clash. '''
+    directory, base_name = os.path.split(name)
+    digest = hashlib.md5(directory.encode('utf-8')).hexdigest()[:10]
+    return 'blobs/%s/%s' % (digest, base_name)
+
+
+class ImageExporter(object):
+    ''' Writes images to tar stream ``fileobj``. '''
+
+    def __init__(self, fileobj, field, workers=8, thumbnails=True):
+        self.tar = tarfile.open(fileobj=fileobj, mode='w|')
+        self.field = field
+        self.pool = ThreadPool(workers)
+        self.window = workers * 2
+        self.thumbnails = thumbnails
+        self.parts = 0
+        self.exported = 0
+        if thumbnails:
+            self._add(THUMBNAILS_MEMBER, json.dumps(field.thumbs_signature()))
+
+    def _add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        self.tar.addfile(info, StringIO(data))
+
+    def _thumbnail_names(self, image):
+        return dict((thumb, image.image._calc_thumb_filename(thumb))
+                    for thumb, options in self.field.thumbs)
+
+    def _record(self, image):
+        record = dict((name, getattr(image, name)) for name in FIELDS)
+        content_type = content_types.get_for_id(image.content_type_id)
+        record.update({
+            'content_type': [content_type.app_label, content_type.model],
+            'object_id': image.object_id,
+            'user': image.user.username if image.user_id else None,
+            'file': _blob_name(image.image.name),
+        })
+        if self.thumbnails:
+            record['thumbnails'] = dict(
+                            (thumb, _blob_name(name)) for thumb, name
+                            in self._thumbnail_names(image).items())
+        return record
+
+    def _fetch(self, image):
+        ''' Returns [(archive name, data)] for the image file and its
+            thumbnails. Missing files are skipped. '''
+        try:
+            files = [(_blob_name(image.image.name),
+                      fetch_image_content(image.image).read())]
+        except Exception:
+            return [] # the image is skipped on import
+        if self.thumbnails:
+            storage = image.image.storage
+            for thumb, name in sorted(self._thumbnail_names(image).items()):
+                try:
+                    f = storage.open(name, 'rb')
+                    try:
+                        files.append((_blob_name(name), f.read()))
+                    finally:
+                        f.close()
+                except Exception:
+                    pass # rendered on import
+        return files
+
+    def write_chunk(self, images):
+        self.parts += 1
+        self._add('manifest-%06d.ndjson' % self.parts,
+                  ''.join(json.dumps(self._record(image)) + '\n'
+                          for image in images))
+        unique, seen = [], set()
+        for image in images:
+            if image.image.name not in seen: # shared deduplicated file
+                seen.add(image.image.name)
+                unique.append(image)
+        for start in range(0, len(unique), self.window):
+            for files in self.pool.map(self._fetch,
+                                       unique[start:start+self.window]):
+                for name, data in files:
+                    self._add(name, data)
+        self.exported += len(images)
+
+    def close(self):
+        self.tar.close()
+        self.pool.close()
+        self.pool.join()
+
+
+class _Chunk(object):
+    def __init__(self, records):
+        self.records = records
+        self.originals = {} # archive name -> indexes of records
+        self.thumbs = {} # archive name -> (archive name of original, thumb)
+        self.names = {} # record index -> storage name
+        self.reused = set() # indexes of records that reuse stored files
+        self.stored_thumbs = {} # storage name -> set of thumb names
+        for index, record in enumerate(records):
+            self.originals.setdefault(record['file'], []).append(index)
+            for thumb, name in (record.get('thumbnails') or {}).items():
+                self.thumbs[name] = record['file'], thumb
+
+
+class ImageImporter(object):
+    ''' Imports images from tar stream written by :class:`ImageExporter`.
+        If ``target`` (a model instance) is given then all images are
+        attached to it; otherwise they are attached to objects with the same
+        content types and ids as in the source. Users are matched by
+        username. '''
+
+    def __init__(self, model, workers=8, reuse_thumbnails=True, target=None,
+                 send_signal=True):
+        self.model = model
+        self.field = model._meta.get_field('image')
+        self.storage = self.field.storage
+        self.pool = ThreadPool(workers)
+        self.window = workers * 2
+        self.reuse_thumbnails = reuse_thumbnails
+        self.reusable = set()
+        self.target = target
+        self.send_signal = send_signal
+        self.imported = self.skipped = 0
+        self._content_types = {}
+
+    def run(self, fileobj, progress=None):
+        ''' Imports images from ``fileobj``. ``progress`` is called after
+            each chunk. '''
+        tar = tarfile.open(fileobj=fileobj, mode='r|*')
+        chunk, self.pending = None, deque()
+        for member in tar:
+            if not member.isfile():
+                continue
+            data = tar.extractfile(member).read()
+            if member.name == THUMBNAILS_MEMBER:
+                exported = json.loads(data)
+                # variants in other formats aren't exported, thumbnails
+                # that have them are rendered
+                self.reusable = set(thumb for thumb, options in
+                                    self.field.thumbs_signature().items()
+                                    if exported.get(thumb) == options and
+                                       not self.field.variant_formats(thumb))
+            elif member.name.startswith('manifest-'):
+                if chunk is not None:
+                    self._finish(chunk)
+                    if progress:
+                        progress(self)
+                chunk = _Chunk([json.loads(line) for line in
+                                data.splitlines() if line.strip()])
+                self._prepare(chunk)
+            elif chunk is not None:
+                self._blob(chunk, member.name, data)
+        if chunk is not None:
+            self._finish(chunk)
+            if progress:
+                progress(self)
+        self.pool.close()
+        self.pool.join()
+
+    def _submit(self, fn, *args):
+        self.pending.append(self.pool.apply_async(fn, args))
+        # bounded memory: wait for the oldest writes
+        while len(self.pending) > self.window:
+            self.pending.popleft().get()
+
+    def _prepare(self, chunk):
+        if not DEDUPLICATE_IMAGES:
+            return
+        for index, record in enumerate(chunk.records):
+            if record.get('content_hash'):
+                name = ImageBlob.objects.acquire(record['content_hash'])
+                if name is not None:
+                    # file and its thumbnails are already stored
+                    chunk.names[index] = name
+                    chunk.reused.add(index)
+
+    def _blob(self, chunk, name, data):
+        if name in chunk.originals:
+            render = not (self.reuse_thumbnails and self.reusable)
+            for index in chunk.originals[name]:
+                if index in chunk.names:
+                    continue
+                instance = self.model()
+                storage_name = instance.get_upload_path(os.path.basename(name))
+                chunk.names[index] = storage_name
+                chunk.stored_thumbs[storage_name] = set()
+                if render:
+                    chunk.stored_thumbs[storage_name].update(
+                                        thumb for thumb, options in self.field.thumbs)
+                self._submit(self._store, storage_name, data, render)
+                if not DEDUPLICATE_IMAGES:
+                    continue
+                # the other records with this file share it
+                for other in chunk.originals[name]:
+                    chunk.names.setdefault(other, storage_name)
+        elif name in chunk.thumbs and self.reuse_thumbnails:
+            original, thumb = chunk.thumbs[name]
+            if thumb not in self.reusable:
+                return
+            for storage_name in set(chunk.names[index] for index
+                                    in chunk.originals[original]
+                                    if index in chunk.names):
+                if storage_name not in chunk.stored_thumbs:
+                    continue # reused deduplicated file
+                field_file = self.model(image=storage_name).image
+                self._submit(self.storage.save,
+                             field_file._calc_thumb_filename(thumb),
+                             ContentFile(data))
+                chunk.stored_thumbs[storage_name].add(thumb)
+
+    def _store(self, name, data, render):
+        content = ContentFile(data)
+        self.storage.save(name, content)
+        if render:
+            self.model(image=name).image.render_thumbs(
+                    [thumb for thumb, options in self.field.thumbs],
+                    content=content, replace=False)
+
+    def _render_missing(self, name, thumbs):
+        self.model(image=name).image.render_thumbs(thumbs, replace=False)
+
+    def _content_type(self, natural_key):
+        key = tuple(natural_key)
+        if key not in self._content_types:
+            try:
+                self._content_types[key] = \
+                            content_types.get_by_natural_key(*key)
+            except ContentType.DoesNotExist:
+                self._content_types[key] = None
+        return self._content_types[key]
+
+    def _drain(self):
+        while self.pending:
+            self.pending.popleft().get()
+
+    def _finish(self, chunk):
+        # originals must be stored before missing thumbnails are rendered
+        # from them
+        self._drain()
+        all_thumbs = [thumb for thumb, options in self.field.thumbs]
+        for name, stored in chunk.stored_thumbs.items():
+            missing = [thumb for thumb in all_thumbs if thumb not in stored]
+            if missing:
+                self._submit(self._render_missing, name, missing)
+        self._drain()
+
+        usernames = set(record['user'] for record in chunk.records
+                        if record.get('user'))
+        users = dict(User.objects.filter(username__in=list(usernames)).
+                     values_list('username', 'pk'))
+        if self.target is not None:
+            target_ct = content_types.get_for_model(self.target)
+
+        # variants of stored files are rendered here, reused files keep
+        # formats of their images
+        reused_formats = dict(self.model.objects.filter(
+                    image__in=[chunk.names[index] for index in chunk.reused]).
+                    values_list('image', 'thumbnail_formats'))
+        rendered_formats = self.field.rendered_formats()
+
+        images = []
+        for index, record in enumerate(chunk.records):
+            name = chunk.names.get(index)
+            if self.target is not None:
+                content_type, object_id = target_ct, self.target.pk
+            else:
+                content_type = self._content_type(record['content_type'])
+                object_id = record['object_id']
+            if name is None or content_type is None:
+                if index in chunk.reused:
+                    ImageBlob.objects.release(name)
+                self.skipped += 1
+                continue
+            image = self.model(content_type=content_type, object_id=object_id,
+                               user_id=users.get(record.get('user')),
+                               image=name)
+            for field in FIELDS:
+                if field in record:
+                    setattr(image, field, record[field])
+            image.thumbnail_formats = reused_formats.get(name, '') \
+                    if index in chunk.reused else rendered_formats
+            images.append(image)
+
+        objects = set((image.content_type.pk, image.object_id)
+                      for image in images)
+        main_objects = set()
+        for image in reversed(images):
+            if not image.is_main:
+                continue
+            key = image.content_type.pk, image.object_id
+            if key in main_objects:
+                # e.g. main images of several objects imported to target:
+                # the last one wins, as if images were saved one by one
+                image.is_main = False
+            main_objects.add(key)
+        for ct_id, object_id in main_objects:
+            self.model.objects.filter(content_type=ct_id, object_id=object_id).\
+                        update(is_main=False)
+        self.model.objects.bulk_create(images)
+        StorageUsage.objects.add(collect_usage([image._usage_row()
+                                                for image in images]))
+        if DEDUPLICATE_IMAGES:
+            registered = {} # stored name -> name of the used file
+            for image in images:
+                name = image.image.name
+                if name not in chunk.stored_thumbs or not image.content_hash:
+                    continue # reused file is already acquired
+                if name in registered:
+                    ImageBlob.objects.acquire(image.content_hash)
+                    image.image = registered[name]
+                else:
+                    registered[name] = image._register_blob()
+        for ct_id, object_id in objects:
+            bump_images_version(ct_id, object_id)
+        self.imported += len(images)
+
+        if self.send_signal and images:
+            # one signal per object, as with bulk_attach
+            created = self.model.objects.filter(
+                            image__in=[image.image.name for image in images])
+            sent = set()
+            for image in created:
+                key = image.content_type_id, image.object_id
+                if key in objects and key not in sent:
+                    sent.add(key)
+                    model = content_types.model_for_id(image.content_type_id)
+                    image_saved.send(sender=model, instance=image)
@@ -0,0 +1,136 @@
+#coding: utf-8
+'''
+Server side of resumable chunked uploads.
+
+Browser uploads each file as a sequence of numbered chunks (several chunks
+are sent in parallel). Chunks are written to temporary directory as soon
+as they arrive and are never kept in memory as a whole: only one chunk of
+one request is in memory at a time. When all chunks of the file are
+received the file is assembled by streaming chunks into one temporary file
+which is then stored as usual image file. If upload is interrupted browser
+asks which chunks were received and sends only the missing ones.
+
+Temporary directory is set with ``GENERIC_IMAGES_UPLOAD_TEMP_DIR`` setting
+(defaults to ``<FILE_UPLOAD_TEMP_DIR or system temp>/generic_images_uploads``).
+Stale uploads are removed with :meth:`ChunkedUploadStore.cleanup`.
+'''
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.files.base import File
+from PIL import Image
+
+UPLOAD_ID_RE = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+COPY_BUFFER_SIZE = 64 * 1024
+
+
+class InvalidUpload(ValueError):
+    pass
+
+
+def default_temp_dir():
+    base = getattr(settings, 'FILE_UPLOAD_TEMP_DIR', None) or tempfile.gettempdir()
+    return getattr(settings, 'GENERIC_IMAGES_UPLOAD_TEMP_DIR',
+                   os.path.join(base, 'generic_images_uploads'))
+
+
+class ChunkedUploadStore(object):
+    ''' Stores chunks of uploads of one user. Upload is identified by
+        client-generated ``upload_id``. '''
+
+    max_chunks = 10000
+
+    def __init__(self, user_id, temp_dir=None):
+        self.root = os.path.join(temp_dir or default_temp_dir(),
+                                 str(int(user_id or 0)))
+
+    def _path(self, upload_id):
+        if not UPLOAD_ID_RE.match(upload_id or ''):
+            raise InvalidUpload('Invalid upload id')
+        return os.path.join(self.root, upload_id)
+
+    def _chunk_path(self, upload_id, index):
+        return os.path.join(self._path(upload_id), '%05d.part' % index)
+
+    def write_chunk(self, upload_id, index, total, content):
+        ''' Stores chunk number ``index`` (0-based) of ``total`` chunks.
+            ``content`` is django File (e.g. UploadedFile). '''
+        if not 0 <= index < total <= self.max_chunks:
+            raise InvalidUpload('Invalid chunk number')
+        path = self._path(upload_id)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except OSError:
+                if not os.path.isdir(path): # created by parallel request
+                    raise
+        total_path = os.path.join(path, 'total')
+        if not os.path.exists(total_path):
+            with open(total_path, 'w') as f:
+                f.write(str(total))
+
+        # chunk becomes visible only when it is written completely
+        fd, tmp_path = tempfile.mkstemp(dir=path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            for data in content.chunks():
+                f.write(data)
+        os.rename(tmp_path, self._chunk_path(upload_id, index))
+
+    def total(self, upload_id):
+        try:
+            with open(os.path.join(self._path(upload_id), 'total')) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def received(self, upload_id):
+        ''' Returns sorted list of received chunk numbers. '''
+        try:
+            names = os.listdir(self._path(upload_id))
+        except OSError:
+            return []
+        return sorted(int(name[:-len('.part')]) for name in names
+                      if name.endswith('.part'))
+
+    def is_complete(self, upload_id):
+        total = self.total(upload_id)
+        return total is not None and self.received(upload_id) == range(total)
+
+    def assemble(self, upload_id, name):
+        ''' Returns django File with the content of complete upload. File
+            is assembled in temporary file chunk by chunk and should be
+            closed by caller. Raises :class:`InvalidUpload` if the file is
+            not an image PIL can read, so nothing is stored for it. '''
+        if not self.is_complete(upload_id):
+            raise InvalidUpload('Upload is not complete')
+        tmp = tempfile.NamedTemporaryFile(dir=self.root, suffix='.upload')
+        for index in range(self.total(upload_id)):
+            with open(self._chunk_path(upload_id, index), 'rb') as chunk:
+                shutil.copyfileobj(chunk, tmp, COPY_BUFFER_SIZE)
+        tmp.flush()
+        tmp.seek(0)
+        try:
+            # reads headers only, pixels are not decoded
+            Image.open(tmp).verify()
+        except Exception:
+            tmp.close()
+            raise InvalidUpload('%s is not an image' % os.path.basename(name))
+        tmp.seek(0)
+        return File(tmp, name=os.path.basename(name) or 'upload.jpg')
+
+    def delete(self, upload_id):
+        shutil.rmtree(self._path(upload_id), ignore_errors=True)
+
+    def cleanup(self, max_age=24*60*60):
+        ''' Removes uploads that were not changed for ``max_age`` seconds. '''
+        if not os.path.isdir(self.root):
+            return
+        deadline = time.time() - max_age
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path) and os.path.getmtime(path) < deadline:
+                shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,8 @@
+from django.conf.urls.defaults import *
+
+urlpatterns = patterns('generic_images.views',
+    url(r'^download/(?P<content_type_id>\d+)/(?P<object_id>\d+)/$',
+        'download_images', name='generic_images_download'),
+    url(r'^file/(?P<pk>\d+)/(?P<key>[0-9a-f]+)/(?:(?P<thumb>\w+)/)?$',
+        'serve_image', name='generic_images_serve'),
+)
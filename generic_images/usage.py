@@ -0,0 +1,153 @@
+#coding: utf-8
+'''
+Storage usage of users and objects and upload quotas.
+
+Number and total size (original files and thumbnails) of images attached
+to each object and uploaded by each user are kept in
+:class:`~generic_images.models.StorageUsage` rows. Counters are changed by
+single UPDATE statements when images are saved (including replacement of
+the file) and deleted, so a quota is checked with one small query before
+the upload instead of summing sizes of all images.
+
+Quotas are set in bytes with ``GENERIC_IMAGES_USER_QUOTA`` and
+``GENERIC_IMAGES_OBJECT_QUOTA`` settings (None means no limit).
+
+Images changed bypassing model methods (queryset ``delete()`` and
+``update()``, thumbnail regeneration) make counters drift; they are
+recomputed by ``reconcile_storage_usage`` management command.
+'''
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Q, get_models
+
+from generic_images.models import AbstractAttachedImage, StorageUsage
+from generic_utils.contenttypes import content_types
+
+RECONCILE_BATCH_SIZE = 1000
+
+
+class QuotaExceeded(ValueError):
+    pass
+
+
+def user_quota():
+    return getattr(settings, 'GENERIC_IMAGES_USER_QUOTA', None)
+
+
+def object_quota():
+    return getattr(settings, 'GENERIC_IMAGES_OBJECT_QUOTA', None)
+
+
+def check_quota(user, obj, incoming=0):
+    ''' Raises :class:`QuotaExceeded` if storing ``incoming`` more bytes
+        exceeds the quota of ``user`` or of ``obj`` images are attached to.
+        Both counters are read with one query. '''
+    limits = {}
+    if user is not None and user.pk and user_quota() is not None:
+        user_ct = content_types.get_for_model(User)
+        limits[('user', user_ct.pk, user.pk)] = user_quota()
+    if obj is not None and object_quota() is not None:
+        obj_ct = content_types.get_for_model(obj)
+        limits[('object', obj_ct.pk, obj.pk)] = object_quota()
+    if not limits:
+        return
+    lookup = Q(pk__in=[])
+    for scope, content_type_id, object_id in limits:
+        lookup |= Q(scope=scope, content_type=content_type_id,
+                    object_id=object_id)
+    used = dict(((scope, ct, oid), size) for scope, ct, oid, size in
+                StorageUsage.objects.filter(lookup).values_list(
+                    'scope', 'content_type', 'object_id', 'bytes'))
+    for key, limit in sorted(limits.items()):
+        if used.get(key, 0) + incoming > limit:
+            raise QuotaExceeded('Storage quota of the %s is exceeded '
+                                '(%d of %d bytes used)' %
+                                (key[0], used.get(key, 0), limit))
+
+
+def image_models():
+    ''' Returns installed concrete subclasses of
+        :class:`~generic_images.models.AbstractAttachedImage`. '''
+    return [model for model in get_models()
+            if issubclass(model, AbstractAttachedImage) and
+               not model._meta.proxy]
+
+
+def _aggregate(model, scope):
+    ''' Yields (content_type_id, object_id, images, bytes) counted by the
+        database with one query. '''
+    qn = connection.ops.quote_name
+    size = 'COALESCE(%s, %s, 0)' % (qn('stored_size'), qn('file_size'))
+    if scope == 'object':
+        group, where = [qn('content_type_id'), qn('object_id')], ''
+    else:
+        group = [qn('user_id')]
+        where = ' WHERE %s IS NOT NULL' % qn('user_id')
+        user_ct_id = content_types.get_for_model(User).pk
+    group = ', '.join(group)
+    cursor = connection.cursor()
+    cursor.execute('SELECT %s, COUNT(*), SUM(%s) FROM %s%s GROUP BY %s' % (
+                        group, size, qn(model._meta.db_table), where, group))
+    while True:
+        rows = cursor.fetchmany(RECONCILE_BATCH_SIZE)
+        if not rows:
+            return
+        for row in rows:
+            if scope == 'user':
+                row = (user_ct_id,) + tuple(row)
+            yield row
+
+
+@transaction.commit_on_success
+def reconcile():
+    ''' Recomputes all counters from images of all image models (a counter
+        of an object or a user sums images of every model, so they can't be
+        recomputed from a part of models). Counters are locked (``SELECT ... FOR UPDATE``) before
+        images are counted and are changed in place, so uploads and deletes
+        that happen meanwhile wait and then apply their changes on top of
+        recomputed values. Returns the number of counters. '''
+    current = {}
+    for pk, scope, content_type_id, object_id, images, size in \
+            StorageUsage.objects.select_for_update().values_list('pk',
+                    'scope', 'content_type', 'object_id', 'images', 'bytes'):
+        current[scope, content_type_id, object_id] = pk, images, size
+
+    totals = {}
+    for model in image_models():
+        for scope in ('object', 'user'):
+            for content_type_id, object_id, images, size in \
+                    _aggregate(model, scope):
+                total = totals.setdefault((scope, content_type_id,
+                                           int(object_id)), [0, 0])
+                total[0] += images
+                total[1] += int(size or 0)
+
+    stale = [pk for key, (pk, images, size) in current.items()
+             if key not in totals]
+    for start in range(0, len(stale), RECONCILE_BATCH_SIZE):
+        StorageUsage.objects.filter(
+                    pk__in=stale[start:start+RECONCILE_BATCH_SIZE]).delete()
+    missing = []
+    for key, (images, size) in totals.iteritems():
+        if key not in current:
+            missing.append((key, (images, size)))
+        elif current[key][1:] != (images, size):
+            StorageUsage.objects.filter(pk=current[key][0]).\
+                                update(images=images, bytes=size)
+    for start in range(0, len(missing), RECONCILE_BATCH_SIZE):
+        batch = missing[start:start+RECONCILE_BATCH_SIZE]
+        sid = transaction.savepoint()
+        try:
+            StorageUsage.objects.bulk_create([
+                    StorageUsage(scope=scope, content_type_id=content_type_id,
+                                 object_id=object_id, images=images,
+                                 bytes=size)
+                    for (scope, content_type_id, object_id), (images, size)
+                    in batch])
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # counters created by concurrent uploads: added to them
+            transaction.savepoint_rollback(sid)
+            StorageUsage.objects.add(dict(batch))
+    return len(totals)
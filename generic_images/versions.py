@@ -0,0 +1,49 @@
+#coding: utf-8
+'''
+Version of images attached to an object, for conditional GET support in
+:class:`~generic_utils.app_utils.PluggableSite` views::
+
+    site = PhotoAlbumSite(instance_name='user_images', queryset=User.objects.all(),
+                          version_getter=images_version_getter(User.objects.all()))
+
+Version is incremented when images are changed, so pages that depend on
+other data than images of the object shouldn't use it (or should use
+``version_getter`` that combines several versions).
+'''
+from generic_images.models import ImagesVersion
+from generic_utils.contenttypes import content_types
+
+
+def images_version_getter(queryset, lookup_field='pk', kwarg='object_id'):
+    ''' Returns ``version_getter`` for PluggableSite whose objects are
+        looked up in ``queryset`` by ``lookup_field`` using ``kwarg`` URL
+        parameter (defaults are the same as in
+        :func:`~generic_utils.app_utils.simple_getter`). Version is None
+        (so the view raises 404 instead of returning 304) if there is no
+        such object: its version row can outlive it. For ``pk`` lookups
+        version is fetched together with the existence check using 1 query
+        (2 if images of the object were never changed) without fetching
+        the object. '''
+    def version_getter(**kwargs):
+        object_id = kwargs.get(kwarg)
+        if object_id is None:
+            return None
+        content_type = content_types.get_for_model(queryset.model)
+        if lookup_field != 'pk':
+            try:
+                object_id = queryset.filter(**{lookup_field: object_id}).\
+                                values_list('pk', flat=True)[0]
+            except IndexError:
+                return None # view raises 404
+            return ImagesVersion.objects.get_for(content_type.pk, object_id)
+
+        objects = queryset.filter(pk=object_id)
+        versions = ImagesVersion.objects.filter(content_type=content_type.pk,
+                        object_id__in=objects.values('pk')).\
+                        values_list('version', 'updated_at')
+        for version in versions[:1]:
+            return version
+        if not objects.exists():
+            return None # view raises 404
+        return 0, None
+    return version_getter
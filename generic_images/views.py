@@ -0,0 +1,54 @@
+#coding: utf-8
+from django.conf import settings
+from django.contrib.auth.decorators import login_required
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import PermissionDenied
+from django.core.urlresolvers import get_callable
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from django.template.defaultfilters import slugify
+
+from generic_images.archives import zip_response
+from generic_images.models import AttachedImage
+from generic_images.serving import serve_image as _serve_image
+from generic_utils.contenttypes import content_types
+
+
+def can_download_images(user, obj):
+    ''' Default permission check of :func:`download_images`: only staff
+        users can download images. '''
+    return user.is_staff
+
+
+def download_permission():
+    ''' Returns the function that checks if ``user`` can download images of
+        ``obj``. It is set with ``GENERIC_IMAGES_DOWNLOAD_PERMISSION``
+        setting (dotted path), :func:`can_download_images` by default. '''
+    path = getattr(settings, 'GENERIC_IMAGES_DOWNLOAD_PERMISSION', None)
+    return get_callable(path) if path else can_download_images
+
+
+@login_required
+def download_images(request, content_type_id, object_id):
+    ''' Streams ZIP archive with all images attached to the object
+        (see :mod:`generic_images.archives`) to logged in users allowed
+        by :func:`download_permission`. '''
+    try:
+        content_type = content_types.get_for_id(content_type_id)
+    except ContentType.DoesNotExist:
+        raise Http404
+    model = content_types.model_for_id(content_type.pk)
+    if model is None: # stale content type
+        raise Http404
+    obj = get_object_or_404(model, pk=object_id)
+    if not download_permission()(request.user, obj):
+        raise PermissionDenied
+    images = AttachedImage.objects.for_model(obj, content_type)
+    filename = slugify(unicode(obj)) or 'images'
+    return zip_response(images, '%s.zip' % filename)
+
+
+def serve_image(request, pk, key, thumb=None):
+    ''' Serves file of AttachedImage or its thumbnail (see
+        :mod:`generic_images.serving`). '''
+    return _serve_image(request, AttachedImage, pk, key, thumb)
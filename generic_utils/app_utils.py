@@ -1,11 +1,52 @@
 #coding: utf-8
+import calendar
+from hashlib import md5
+
 from django.conf.urls.defaults import *
-from django.http import Http404
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, HttpResponseNotModified
 from django.core.urlresolvers import reverse
 from django.template import RequestContext
 from django.db import models
 from django.db.models.query import QuerySet
+from django.utils.cache import patch_vary_headers
 from django.utils.functional import wraps
+from django.utils.http import http_date, parse_http_date_safe, parse_etags,\
+                              quote_etag
+
+
+def _validators(request, site, version):
+    ''' Returns (etag, last_modified timestamp) for the page. Pages can
+        depend on the user (e.g. edit links) so user id is a part of ETag. '''
+    number, updated_at = version
+    user = getattr(request, 'user', None)
+    user_id = getattr(user, 'pk', None) or 0
+    etag = quote_etag('%s-%s-%s' % (site.instance_name, number, user_id))
+    last_modified = None
+    if updated_at is not None:
+        last_modified = calendar.timegm(updated_at.utctimetuple())
+    return etag, last_modified
+
+
+def _not_modified(request, etag, last_modified):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return '*' in etags or etag.strip('"') in etags
+    if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+    if if_modified_since and last_modified is not None:
+        since = parse_http_date_safe(if_modified_since.split(';')[0])
+        return since is not None and last_modified <= since
+    return False
+
+
+def _set_validators(response, etag, last_modified):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    patch_vary_headers(response, ['Cookie'])
+    return response
+
 
 def get_site_decorator(site_param='site', obj_param='obj', context_param='context'):
     ''' It is a function that returns decorator factory useful for PluggableSite
@@ -18,11 +59,26 @@ def get_site_decorator(site_param='site', obj_param='obj', context_param='contex
 
         For example usage please check photo_albums.views.
 
+        If the site has ``version_getter`` then GET requests are
+        conditional: ``version_getter`` is called with object lookup
+        parameters and the view is not called (and the object is not
+        fetched) if the client has the current version of the page
+        (``If-None-Match`` or ``If-Modified-Since`` headers), 304 response
+        is returned instead. ``cache_timeout`` parameter of the decorator
+        factory enables caching of rendered pages for anonymous users,
+        cache key includes the version (don't use it for pages with forms
+        because they contain CSRF tokens)::
+
+            @site_method(cache_timeout=600)
+            def show_album(request, album_site, object, context):
+                ...
+
         Btw, this decorator seems frightening for me. It feels that
         "views as PluggableSite methods" approach can easily make this decorator
         obsolete. But for now it just works.
     '''
     def site_method(**extra_params):
+        cache_timeout = extra_params.pop('cache_timeout', None)
         def decorator(fn):
             @wraps(fn)
             def wrapper(request, **kwargs):
@@ -39,7 +95,31 @@ def get_site_decorator(site_param='site', obj_param='obj', context_param='contex
                     params.update({key:value})
 
                 # Now there are only site.object_getter lookup parameters in
-                # kwargs. Get the object and compute common request context.
+                # kwargs. Check if the client has the current page.
+                version_getter = getattr(site, 'version_getter', None)
+                etag = cache_key = None
+                if version_getter is not None and \
+                        request.method in ('GET', 'HEAD'):
+                    version = version_getter(**kwargs)
+                    if version is not None:
+                        etag, last_modified = _validators(request, site,
+                                                          version)
+                        if _not_modified(request, etag, last_modified):
+                            return _set_validators(HttpResponseNotModified(),
+                                                   etag, last_modified)
+                        if cache_timeout and not (hasattr(request, 'user')
+                                          and request.user.is_authenticated()):
+                            cache_key = 'site_page:' + md5('%s|%s' % (
+                                    etag, request.get_full_path())).hexdigest()
+                            cached = cache.get(cache_key)
+                            if cached is not None:
+                                content, content_type = cached
+                                return _set_validators(
+                                        HttpResponse(content,
+                                                     content_type=content_type),
+                                        etag, last_modified)
+
+                # Get the object and compute common request context.
                 try:
                     obj = site.object_getter(**kwargs)
                 except models.ObjectDoesNotExist:
@@ -55,7 +135,14 @@ def get_site_decorator(site_param='site', obj_param='obj', context_param='contex
                                 obj_param: obj,
                                 context_param: context_instance
                              })
-                return fn(request, **params)
+                response = fn(request, **params)
+                if etag is not None and response.status_code == 200:
+                    if cache_key is not None and not response.cookies:
+                        cache.set(cache_key, (response.content,
+                                              response['Content-Type']),
+                                  cache_timeout)
+                    _set_validators(response, etag, last_modified)
+                return response
             return wrapper
         return decorator
     return site_method
@@ -85,6 +172,12 @@ class PluggableSite(object):
     ''' Base class for reusable apps.
         The approach is similar to django AdminSite.
         For usage case please check photo_albums app.
+
+        ``version_getter`` is an optional function that takes object lookup
+        parameters and returns (version, last modification datetime) tuple
+        of site pages for the object or None. It enables conditional GET
+        in views decorated by :func:`get_site_decorator`, see
+        :func:`generic_images.versions.images_version_getter`.
    '''
 
     def __init__(self,
@@ -97,7 +190,8 @@ class PluggableSite(object):
                  template_object_name = 'object',
                  has_edit_permission = lambda request, obj: True,
                  context_processors = None,
-                 object_getter = None):
+                 object_getter = None,
+                 version_getter = None):
 
         self.instance_name = instance_name
         self.extra_context = extra_context or {}
@@ -105,6 +199,7 @@ class PluggableSite(object):
         self.has_edit_permission = has_edit_permission
         self.template_object_name = template_object_name
         self.context_processors = context_processors
+        self.version_getter = version_getter
 
         if object_regex or lookup_field or (queryset is not None):
             if object_getter is not None:
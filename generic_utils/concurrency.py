@@ -0,0 +1,86 @@
+#coding: utf-8
+'''
+Background execution of blocking DB and storage calls.
+
+Methods with ``a`` prefix (``afor_model``, ``ainject_to``, etc.) run their
+synchronous counterparts in a process-wide thread pool and return
+``multiprocessing.pool.AsyncResult`` immediately, so a view can start
+several lookups (and storage writes) and wait for all of them at once::
+
+    images = AttachedImage.objects.afor_model(obj)
+    main = AttachedImage.objects.aget_main_for(other_obj)
+    images, main = gather(images, main)
+
+Each task closes DB connections of its worker thread when it is finished,
+so tasks don't keep transactions open. Thread-local state (e.g. read
+replica pins) can be passed to workers with :func:`register_thread_state`.
+
+Pool size is set with ``GENERIC_IMAGES_ASYNC_WORKERS`` setting (default 8).
+'''
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connections
+
+_pools = {}
+_pools_lock = threading.Lock()
+_thread_state = []
+
+
+def register_thread_state(get, set):
+    ''' Registers thread-local state that is copied to worker threads:
+        ``get()`` is called when the task is submitted, ``set(value)`` is
+        called in the worker before the task and ``set(None)`` after it. '''
+    _thread_state.append((get, set))
+
+
+def get_pool(name='io'):
+    ''' Returns process-wide ThreadPool. 'io' pool runs DB queries and
+        storage calls, 'tasks' pool runs functions that wait for 'io'
+        tasks (so they can't exhaust 'io' workers and deadlock). '''
+    pool = _pools.get(name)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(name)
+            if pool is None:
+                pool = ThreadPool(getattr(settings,
+                                          'GENERIC_IMAGES_ASYNC_WORKERS', 8))
+                _pools[name] = pool
+    return pool
+
+
+def _run(state, fn, args, kwargs):
+    for (get, set), value in zip(_thread_state, state):
+        set(value)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        for get, set in _thread_state:
+            set(None)
+        for connection in connections.all():
+            connection.close()
+
+
+def submit(fn, *args, **kwargs):
+    ''' Runs ``fn(*args, **kwargs)`` in 'io' pool. Returns AsyncResult. '''
+    return _submit('io', fn, args, kwargs)
+
+
+def submit_task(fn, *args, **kwargs):
+    ''' Like :func:`submit` but for functions that wait for
+        results of :func:`submit`. '''
+    return _submit('tasks', fn, args, kwargs)
+
+
+def _submit(pool_name, fn, args, kwargs):
+    state = [get() for get, set in _thread_state]
+    return get_pool(pool_name).apply_async(_run, (state, fn, args, kwargs))
+
+
+def gather(*results, **kwargs):
+    ''' Waits for AsyncResults and returns list of their values. The first
+        exception raised by a task is re-raised. ``timeout`` keyword
+        argument is passed to ``AsyncResult.get``. '''
+    timeout = kwargs.get('timeout')
+    return [result.get(timeout) for result in results]
@@ -0,0 +1,121 @@
+#coding: utf-8
+'''
+Process-wide registry of content types.
+
+Generic relations resolve content types all the time: managers filter by
+the content type of the model, signals are sent with the model class of
+the image's content type, template tags and injectors group objects by
+content type id. :data:`content_types` keeps id -> content type, model ->
+content type and id -> model class maps for the whole process. All content
+types are loaded with one query when the registry is used for the first
+time (or when :meth:`~ContentTypeRegistry.warm` is called, e.g. from
+``wsgi.py``), so later lookups don't query the database and don't call
+``model_class()``. Loaded content types are also put into the cache of
+``ContentType.objects``, so code that uses it directly benefits too.
+
+Content types that are created later (e.g. for a new model) are looked up
+on the first miss. The registry is cleared when a content type is saved or
+deleted and when the database is flushed or synced (as the cache of
+``ContentType.objects`` is), so tests that recreate content types see the
+new ids; :meth:`~ContentTypeRegistry.clear` can be called explicitly.
+'''
+import threading
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models.signals import post_save, post_delete, post_syncdb
+
+
+class ContentTypeRegistry(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        ''' Forgets all loaded content types. '''
+        with self._lock:
+            self._by_id = {}
+            self._by_key = {}
+            self._models = {}
+            self._warmed = False
+
+    def _add(self, content_type):
+        self._by_key[(content_type.app_label, content_type.model)] = \
+                                                            content_type
+        model = self._models[content_type.pk] = content_type.model_class()
+        # the last one: lookups by id check it first
+        self._by_id[content_type.pk] = content_type
+        if model is not None: # stale content types aren't cached by Django
+            ContentType.objects._add_to_cache(ContentType.objects.db,
+                                              content_type)
+
+    def warm(self):
+        ''' Loads all content types with one query. '''
+        content_types = list(ContentType.objects.all())
+        with self._lock:
+            for content_type in content_types:
+                self._add(content_type)
+            self._warmed = True
+
+    def _lookup(self, table, key, load):
+        try:
+            return table[key]
+        except KeyError:
+            pass
+        if not self._warmed:
+            self.warm()
+            if key in table:
+                return table[key]
+        content_type = load()
+        with self._lock:
+            self._add(content_type)
+        return content_type
+
+    def get_for_model(self, model):
+        ''' Returns ContentType of ``model`` (class or instance), creating
+            it if necessary. Proxy models have content types of their
+            concrete models, as with ``ContentType.objects``. '''
+        opts = model._meta.concrete_model._meta
+        return self._lookup(self._by_key,
+                            (opts.app_label, opts.object_name.lower()),
+                            lambda: ContentType.objects.get_for_model(model))
+
+    def get_for_id(self, content_type_id):
+        ''' Returns ContentType with id ``content_type_id``. Raises
+            ``ContentType.DoesNotExist`` for unknown ids. '''
+        content_type_id = int(content_type_id)
+        return self._lookup(self._by_id, content_type_id,
+                    lambda: ContentType.objects.get(pk=content_type_id))
+
+    def get_by_natural_key(self, app_label, model):
+        return self._lookup(self._by_key, (app_label, model),
+                    lambda: ContentType.objects.get(app_label=app_label,
+                                                    model=model))
+
+    def id_for_model(self, model):
+        return self.get_for_model(model).pk
+
+    def model_for_id(self, content_type_id):
+        ''' Returns model class of content type ``content_type_id`` or None
+            if the model is not installed anymore. '''
+        content_type = self.get_for_id(content_type_id)
+        try:
+            return self._models[content_type.pk]
+        except KeyError: # cleared concurrently
+            return content_type.model_class()
+
+
+content_types = ContentTypeRegistry()
+''' The registry used by generic_utils and generic_images. '''
+
+
+def _clear_registry(sender, **kwargs):
+    content_types.clear()
+
+post_save.connect(_clear_registry, sender=ContentType,
+                  dispatch_uid='generic_utils.contenttypes.save')
+post_delete.connect(_clear_registry, sender=ContentType,
+                    dispatch_uid='generic_utils.contenttypes.delete')
+# flush (e.g. between TransactionTestCase tests) recreates content types
+post_syncdb.connect(_clear_registry,
+                    dispatch_uid='generic_utils.contenttypes.syncdb')
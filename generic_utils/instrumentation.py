@@ -0,0 +1,288 @@
+#coding: utf-8
+'''
+Lightweight instrumentation for image operations.
+
+Operations (image save, injector lookups, thumbnail rendering, etc.) are
+wrapped with :func:`instrumented` decorator or :meth:`Metrics.timer`
+context manager. For each operation the following metrics are reported
+to the configured sinks:
+
+* ``<operation>.time`` - timing in ms;
+* ``<operation>.calls`` - counter;
+* ``<operation>.queries`` - number of DB queries (if queries are logged,
+  i.e. DEBUG is True or :class:`MetricsSummaryMiddleware` is used);
+* ``<operation>.storage_calls`` and ``<operation>.bytes_written`` - storage
+  activity (for storages wrapped by :func:`instrument_storage`).
+
+Sinks are configured with ``GENERIC_IMAGES_METRICS_SINKS`` setting (a list
+of dotted paths to sink classes), for example::
+
+    GENERIC_IMAGES_METRICS_SINKS = ['generic_utils.instrumentation.StatsdSink']
+    GENERIC_IMAGES_STATSD_ADDRESS = ('localhost', 8125)
+
+Sink is an object with ``timing(name, ms)`` and ``incr(name, value)``
+methods, so prometheus or other clients can be plugged in easily.
+When there are no sinks and no summary middleware, instrumented code
+runs with a single attribute check of overhead.
+'''
+import logging
+import socket
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+from django.utils.importlib import import_module
+
+logger = logging.getLogger('generic_images.metrics')
+
+MIDDLEWARE_PATH = 'generic_utils.instrumentation.MetricsSummaryMiddleware'
+
+
+class InMemoryCollector(object):
+    ''' Sink that keeps aggregated counters and timings in memory. '''
+
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def timing(self, name, ms):
+        self.timings[name] = self.timings.get(name, 0) + ms
+
+    def summary(self):
+        ''' Returns string like "image.save: 2 calls, 35.1ms, 8 queries". '''
+        operations = sorted(name[:-len('.calls')] for name in self.counters
+                            if name.endswith('.calls'))
+        parts = []
+        for op in operations:
+            part = '%s: %d calls, %.1fms' % (op, self.counters[op+'.calls'],
+                                             self.timings.get(op+'.time', 0))
+            for counter in ['queries', 'storage_calls', 'bytes_written']:
+                value = self.counters.get('%s.%s' % (op, counter))
+                if value:
+                    part += ', %d %s' % (value, counter.replace('_', ' '))
+            parts.append(part)
+        return '; '.join(parts)
+
+
+class StatsdSink(object):
+    ''' Sends metrics to statsd over UDP. Address is taken from
+        ``GENERIC_IMAGES_STATSD_ADDRESS`` setting and metric names are
+        prefixed with ``GENERIC_IMAGES_STATSD_PREFIX``. '''
+
+    def __init__(self):
+        self.address = getattr(settings, 'GENERIC_IMAGES_STATSD_ADDRESS',
+                               ('localhost', 8125))
+        self.prefix = getattr(settings, 'GENERIC_IMAGES_STATSD_PREFIX',
+                              'generic_images.')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, data):
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error:
+            pass # metrics must never break the application
+
+    def incr(self, name, value=1):
+        self._send('%s%s:%d|c' % (self.prefix, name, value))
+
+    def timing(self, name, ms):
+        self._send('%s%s:%.3f|ms' % (self.prefix, name, ms))
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    def __init__(self, metrics, operation):
+        self.metrics = metrics
+        self.operation = operation
+
+    def __enter__(self):
+        self.metrics._stack().append(self.operation)
+        self.queries = len(connection.queries)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = (time.time() - self.start) * 1000
+        self.metrics._stack().pop()
+        op = self.operation
+        self.metrics.timing(op+'.time', elapsed)
+        self.metrics.incr(op+'.calls')
+        queries = len(connection.queries) - self.queries
+        if queries > 0:
+            self.metrics.incr(op+'.queries', queries)
+        return False
+
+
+class Metrics(object):
+    ''' Dispatches metrics to configured sinks and to the collectors of
+        requests being processed (see :class:`MetricsSummaryMiddleware`). '''
+
+    def __init__(self, sinks=None):
+        self._local = threading.local()
+        if sinks is None:
+            paths = getattr(settings, 'GENERIC_IMAGES_METRICS_SINKS', ())
+            sinks = [_load_class(path)() for path in paths]
+        self.sinks = list(sinks)
+        self.configured = bool(self.sinks) or MIDDLEWARE_PATH in \
+                            getattr(settings, 'MIDDLEWARE_CLASSES', ())
+
+    @property
+    def enabled(self):
+        return bool(self.sinks) or bool(getattr(self._local, 'collectors', None))
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _targets(self):
+        return self.sinks + getattr(self._local, 'collectors', [])
+
+    def incr(self, name, value=1):
+        for sink in self._targets():
+            sink.incr(name, value)
+
+    def timing(self, name, ms):
+        for sink in self._targets():
+            sink.timing(name, ms)
+
+    def incr_current(self, name, value=1):
+        ''' Increments ``<current operation>.<name>`` counter. '''
+        stack = self._stack()
+        if stack:
+            self.incr('%s.%s' % (stack[-1], name), value)
+
+    def timer(self, operation):
+        ''' Returns context manager measuring ``operation``. '''
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, operation)
+
+    def push_collector(self, collector):
+        self._local.collectors = getattr(self._local, 'collectors', []) + [collector]
+
+    def pop_collector(self, collector):
+        self._local.collectors = [c for c in self._local.collectors
+                                  if c is not collector]
+
+metrics = Metrics()
+''' Process-wide :class:`Metrics` instance. '''
+
+
+def instrumented(operation):
+    ''' Decorator that measures each call of decorated function as
+        ``operation``. '''
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not metrics.enabled:
+                return fn(*args, **kwargs)
+            with _Timer(metrics, operation):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class InstrumentedStorage(object):
+    ''' Storage proxy that counts storage calls and written bytes for the
+        current operation. '''
+
+    def __init__(self, storage):
+        self.__dict__['_storage'] = storage
+
+    def __getattr__(self, name):
+        return getattr(self._storage, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._storage, name, value)
+
+    def _count(self, method, bytes_written=0):
+        if metrics.enabled:
+            metrics.incr('storage.%s' % method)
+            metrics.incr_current('storage_calls')
+            if bytes_written:
+                metrics.incr('storage.bytes_written', bytes_written)
+                metrics.incr_current('bytes_written', bytes_written)
+
+    def save(self, name, content):
+        self._count('save', getattr(content, 'size', 0))
+        return self._storage.save(name, content)
+
+    def open(self, name, mode='rb'):
+        self._count('open')
+        return self._storage.open(name, mode)
+
+    def delete(self, name):
+        self._count('delete')
+        return self._storage.delete(name)
+
+    def exists(self, name):
+        self._count('exists')
+        return self._storage.exists(name)
+
+    def size(self, name):
+        self._count('size')
+        return self._storage.size(name)
+
+    def listdir(self, path):
+        self._count('listdir')
+        return self._storage.listdir(path)
+
+
+def instrument_storage(storage):
+    ''' Returns :class:`InstrumentedStorage` proxy for ``storage`` if
+        metrics are configured and ``storage`` itself otherwise. '''
+    if metrics.configured:
+        return InstrumentedStorage(storage)
+    return storage
+
+
+class MetricsSummaryMiddleware(object):
+    ''' Collects metrics of each request and logs a summary to
+        'generic_images.metrics' logger. If
+        ``GENERIC_IMAGES_METRICS_HEADER`` setting is True then the summary
+        is also returned in ``X-Image-Metrics`` response header. DB queries
+        are logged during the request even if DEBUG is False so they can be
+        counted. '''
+
+    def process_request(self, request):
+        request._image_metrics = InMemoryCollector()
+        request._image_metrics_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        metrics.push_collector(request._image_metrics)
+
+    def process_response(self, request, response):
+        collector = getattr(request, '_image_metrics', None)
+        if collector is None:
+            return response
+        metrics.pop_collector(collector)
+        connection.use_debug_cursor = request._image_metrics_debug_cursor
+        del request._image_metrics
+
+        summary = collector.summary()
+        if summary:
+            logger.debug('%s %s', request.path, summary)
+            if getattr(settings, 'GENERIC_IMAGES_METRICS_HEADER', False):
+                response['X-Image-Metrics'] = summary
+        return response
+
+
+def _load_class(path):
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), class_name)
@@ -1,6 +1,9 @@
 
 from django.db import models
-from django.contrib.contenttypes.models import ContentType
+
+from generic_utils.concurrency import submit
+from generic_utils.contenttypes import content_types
+from generic_utils.instrumentation import instrumented
 
 
 def _pop_data_from_kwargs(kwargs):
@@ -9,6 +12,43 @@ def _pop_data_from_kwargs(kwargs):
     return ct_field, fk_field
 
 
+def fetch_content_objects(objects, ct_field='content_type', fk_field='object_id',
+                          cache_attr='_content_object_cache'):
+    ''' Fetches objects that generic-related ``objects`` are attached to
+        using one query per content type. Fetched objects are stored in
+        GenericForeignKey cache so accessing ``obj.content_object`` doesn't
+        hit the database. Objects that don't exist anymore are cached
+        as None.
+
+        Example::
+
+            images = list(AttachedImage.objects.all()[:100])
+            fetch_content_objects(images)
+            for image in images:
+                print image.content_object  # no queries here
+    '''
+    ids_by_ctype = {}
+    for obj in objects:
+        ct_id = getattr(obj, ct_field+'_id')
+        if ct_id is not None:
+            ids_by_ctype.setdefault(ct_id, set()).add(getattr(obj, fk_field))
+
+    fetched = {}
+    for ct_id, ids in ids_by_ctype.items():
+        model = content_types.model_for_id(ct_id)
+        if model is None: # stale content type
+            continue
+        for pk, target in model._default_manager.in_bulk(list(ids)).items():
+            fetched[ct_id, unicode(pk)] = target
+
+    for obj in objects:
+        ct_id = getattr(obj, ct_field+'_id')
+        if ct_id is not None:
+            key = ct_id, unicode(getattr(obj, fk_field))
+            setattr(obj, cache_attr, fetched.get(key))
+    return objects
+
+
 class RelatedInjector(models.Manager):
     """ Manager that can emulate ``select_related`` fetching
         reverse relations using 1 additional SQL query.
@@ -127,6 +167,7 @@ class GenericInjector(RelatedInjector):
         super(GenericInjector, self).__init__(fk_field, *args, **kwargs)
 
 
+    @instrumented('injector.inject_to')
     def inject_to(self, objects, field_name, get_inject_object = lambda obj: obj, **kwargs):
         '''
         ``objects`` is an iterable. Images (or other generic-related model instances)
@@ -151,13 +192,23 @@ class GenericInjector(RelatedInjector):
         '''
 
         try:
-            content_type = ContentType.objects.get_for_model(get_inject_object(objects[0]))
+            content_type = content_types.get_for_model(get_inject_object(objects[0]))
         except IndexError:
             return objects
 
         kwargs.update({self.ct_field: content_type})
         return super(GenericInjector, self).inject_to(objects, field_name, get_inject_object, **kwargs)
 
+    def ainject_to(self, objects, field_name, get_inject_object = lambda obj: obj, **kwargs):
+        ''' Runs :meth:`inject_to` in background thread
+            (see :mod:`generic_utils.concurrency`). Returns AsyncResult with
+            ``objects``. ``objects`` is evaluated in the calling thread. '''
+        objects = list(objects)
+        def inject():
+            self.inject_to(objects, field_name, get_inject_object, **kwargs)
+            return objects
+        return submit(inject)
+
 
 class GenericModelManager(models.Manager):
     """ Manager with for_model method.  """
@@ -168,7 +219,7 @@ class GenericModelManager(models.Manager):
 
     def for_model(self, model, content_type=None):
         ''' Returns all objects that are attached to given model '''
-        content_type = content_type or ContentType.objects.get_for_model(model)
+        content_type = content_type or content_types.get_for_model(model)
         kwargs = {
                     self.ct_field: content_type,
                     self.fk_field: model.pk
@@ -176,3 +227,10 @@ class GenericModelManager(models.Manager):
         objects = self.get_query_set().filter(**kwargs)
         return objects
 
+    def afor_model(self, model, content_type=None):
+        ''' Returns AsyncResult with the list of objects attached to given
+            model. Query is executed in background thread
+            (see :mod:`generic_utils.concurrency`). '''
+        content_type = content_type or content_types.get_for_model(model)
+        return submit(lambda: list(self.for_model(model, content_type)))
+
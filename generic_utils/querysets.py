@@ -0,0 +1,35 @@
+#coding: utf-8
+
+def keyset_chunks(queryset, chunk_size=1000, key='pk'):
+    ''' Iterates over ``queryset`` in chunks of ``chunk_size`` objects
+        ordered by ``key`` and yields lists of objects.
+
+        Each chunk is fetched with ``key > last_seen_key`` condition instead
+        of OFFSET so the cost of fetching a chunk doesn't grow with table
+        size and only one chunk is held in memory at a time. ``key`` must be
+        unique (primary key by default).
+
+        ``queryset`` may also be ``values_list`` or ``values`` queryset
+        if the first selected column (or 'key' entry) is the ``key``.
+    '''
+    queryset = queryset.order_by(key)
+    last_key = None
+    while True:
+        chunk_qs = queryset
+        if last_key is not None:
+            chunk_qs = chunk_qs.filter(**{key+'__gt': last_key})
+        chunk = list(chunk_qs[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last_key = _get_key(chunk[-1], key)
+
+
+def _get_key(item, key):
+    if isinstance(item, dict):
+        return item[key]
+    if isinstance(item, tuple):
+        return item[0]
+    return getattr(item, key)
@@ -20,7 +20,9 @@ setup(
                          "Documentation is here: http://django-generic-images.googlecode.com/hg/docs/_build/html/index.html",
 
       license = 'MIT license',
-      packages=['generic_images', 'generic_utils'],
+      packages=['generic_images', 'generic_images.management',
+                'generic_images.management.commands',
+                'generic_images.templatetags', 'generic_utils'],
       package_data={'generic_images': [
                                         'locale/en/LC_MESSAGES/*',
                                         'locale/ru/LC_MESSAGES/*',
@@ -29,7 +31,7 @@ setup(
                                         'media/generic_images/js/*'
                                       ]},
 
-      requires = ['django (>=1.1)'],
+      requires = ['django (>=1.4)'],
 
       classifiers=[
           'Development Status :: 3 - Alpha',